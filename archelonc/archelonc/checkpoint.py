@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Remember how far through the shell's history file we have uploaded,
+so updates only read what was appended since.
+"""
+from __future__ import absolute_import, unicode_literals
+import base64
+import hashlib
+import json
+import os
+import zlib
+
+# Rolling hash of the anchor's lines, over their CRCs
+HASH_BASE = 1000003
+HASH_MODULUS = 2 ** 61 - 1
+# Bytes of each line's digest kept to recognize lines already sent
+SENT_HASH_SIZE = 8
+
+
+def _line_hash(line):
+    """
+    Hash of one line of history, without its newline.
+    """
+    return zlib.crc32(line) & 0xffffffff
+
+
+def _sent_hash(line):
+    """
+    Digest of one line of history that has been sent, long enough
+    that a new command is all but never taken for one of them.
+    """
+    return hashlib.sha1(line).digest()[:SENT_HASH_SIZE]
+
+
+def _window_hash(hashes):
+    """
+    Rolling hash of a run of line hashes.
+    """
+    value = 0
+    for line_hash in hashes:
+        value = (value * HASH_BASE + line_hash) % HASH_MODULUS
+    return value
+
+
+class HistoryCheckpoint(object):
+    """Byte offset we have read a history file up to, and an anchor
+    to recognize that spot by.
+
+    The anchor is a rolling hash of the ``ANCHOR_LINES`` lines just
+    before the offset.  When the history is only appended to, those
+    lines are still right before the offset and everything after it
+    is new.  When the shell has cut the oldest lines off to keep the
+    file under ``HISTFILESIZE``, or the file was replaced, the anchor
+    is searched for backwards from where it can be at the latest,
+    reading more of the file only while it isn't found.  Cutting lines
+    off the start only moves it back, by at least as much as the file
+    shrank.  If it can't be found at all, or turns up more than once
+    because the same commands were run over and over, the whole file
+    is read again.  Every command sent counts another use of it on the
+    server, so the lines that were already before the offset, kept as
+    digests in ``sent``, are left out of that read.  A command run
+    again since then is left out with them, which misses one use
+    rather than counting one for everything in the history.  Either
+    way an update usually costs about as much as the lines added
+    since the last one.
+
+    Reading doesn't move the checkpoint until :py:meth:`save` is
+    called, so lines that failed to upload are read again next time,
+    unless they are saved as ``unsent`` to send on their own.
+    """
+    # Lines the anchor hashes
+    ANCHOR_LINES = 16
+    # Bytes to read before the offset or from the end at first
+    READ_SIZE = 64 * 1024
+    # Digests of sent lines to keep before only keeping those of the
+    # lines still in the history
+    SENT_LIMIT = 100000
+
+    def __init__(self, path):
+        """Load the checkpoint saved at ``path``, if there is one.
+
+        Args:
+            path (str): File the checkpoint is kept in
+        """
+        self.path = path
+        self.offset = 0
+        self.size = 0
+        self.anchor = None
+        self.anchor_lines = 0
+        self.sent = set()
+        self.unsent = []
+        self.pending = None
+        self.exists = False
+        try:
+            with open(path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            self.offset = state['offset']
+            self.anchor = state['anchor']
+            self.anchor_lines = state['anchor_lines']
+            # Checkpoints from before the size, digests and unsent
+            # commands were kept
+            self.size = state.get('size', self.offset)
+            sent = base64.b64decode(state.get('sent', ''))
+            self.sent = set(
+                sent[x:x + SENT_HASH_SIZE]
+                for x in range(0, len(sent), SENT_HASH_SIZE)
+            )
+            self.unsent = state.get('unsent', [])
+            self.exists = True
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def _anchor_before(self, history_file, end):
+        """
+        Hash of the anchor's worth of lines ending at ``end``, which
+        must be at the start of a line, and how many lines it has.
+        """
+        data = b''
+        start = end
+        while start > 0 and data.count(b'\n') <= self.ANCHOR_LINES:
+            start = max(0, start - self.READ_SIZE)
+            history_file.seek(start)
+            data = history_file.read(end - start)
+        lines = data.split(b'\n')[:-1]
+        if start > 0:
+            # The first piece may start part way through a line
+            lines = lines[1:]
+        lines = lines[-self.ANCHOR_LINES:]
+        return _window_hash(_line_hash(line) for line in lines), len(lines)
+
+    @staticmethod
+    def _sent_before(history_file, end):
+        """
+        Digests of the lines before ``end``.
+        """
+        history_file.seek(0)
+        data = history_file.read(end)
+        return set(_sent_hash(line) for line in data.split(b'\n'))
+
+    def _latest(self, size):
+        """
+        Furthest on the anchor can be in a file that is now ``size``
+        bytes long.
+        """
+        return self.offset - max(0, self.size - size)
+
+    def _find_anchor(self, history_file, size):
+        """
+        Offset of the end of the only run of lines matching the anchor
+        where it could be, or ``None`` if the file doesn't have one or
+        has more than one.
+        """
+        # pylint: disable=too-many-locals
+        count = self.anchor_lines
+        power = pow(HASH_BASE, count - 1, HASH_MODULUS)
+        latest = self._latest(size)
+        read_size = self.READ_SIZE
+        while latest > 0:
+            start = max(0, latest - read_size)
+            history_file.seek(start)
+            data = history_file.read(latest - start)
+            position = start
+            if start > 0:
+                skip = data.find(b'\n') + 1
+                data, position = data[skip:], start + skip
+            found = []
+            window = []
+            value = 0
+            for line in data.split(b'\n')[:-1]:
+                position += len(line) + 1
+                line_hash = _line_hash(line)
+                if len(window) == count:
+                    value = (value - window.pop(0) * power) % HASH_MODULUS
+                window.append(line_hash)
+                value = (value * HASH_BASE + line_hash) % HASH_MODULUS
+                if len(window) == count and value == self.anchor:
+                    found.append(position)
+            if len(found) > 1:
+                # Either could be where we left off, and guessing the
+                # newer one wrong would skip the commands between them
+                return None
+            if found or start == 0:
+                return found[0] if found else None
+            read_size *= 4
+        return None
+
+    def read(self, history_path):
+        """Read the complete lines added to a history file since the
+        checkpoint.
+
+        A last line without a newline yet is left for next time, and
+        when the whole file has to be read again, so are the lines that
+        were sent before.
+
+        Args:
+            history_path (str): The shell's history file
+        Returns:
+            list: New lines of history, decoded and stripped
+        """
+        with open(history_path, 'rb') as history_file:
+            history_file.seek(0, os.SEEK_END)
+            size = history_file.tell()
+            start = 0
+            if self.offset and self.anchor_lines:
+                if self.offset <= self._latest(size) and self._anchor_before(
+                        history_file, self.offset
+                ) == (self.anchor, self.anchor_lines):
+                    start = self.offset
+                else:
+                    start = self._find_anchor(history_file, size) or 0
+            history_file.seek(start)
+            data = history_file.read(size - start)
+            end = start + data.rfind(b'\n') + 1
+            anchor, anchor_lines = self._anchor_before(history_file, end)
+            lines = data[:end - start].split(b'\n')
+            hashes = [_sent_hash(line) for line in lines]
+            if start == 0:
+                lines = [
+                    line for line, line_hash in zip(lines, hashes)
+                    if line_hash not in self.sent
+                ]
+                sent = set(hashes)
+            else:
+                sent = self.sent.union(hashes)
+                if len(sent) > self.SENT_LIMIT:
+                    sent = self._sent_before(history_file, end)
+        self.pending = (end, size, anchor, anchor_lines, sent)
+        return [line.decode('UTF-8', 'replace').strip() for line in lines]
+
+    def mark(self, history_path):
+        """Move the checkpoint to the end of a history file, as if all
+        of it had been read.
+
+        Args:
+            history_path (str): The shell's history file
+        """
+        with open(history_path, 'rb') as history_file:
+            history_file.seek(0, os.SEEK_END)
+            size = history_file.tell()
+            # Leave a last line without a newline yet to be read
+            start = max(0, size - self.READ_SIZE)
+            history_file.seek(start)
+            end = start + history_file.read().rfind(b'\n') + 1
+            anchor, anchor_lines = self._anchor_before(history_file, end)
+            sent = self._sent_before(history_file, end)
+        self.pending = (end, size, anchor, anchor_lines, sent)
+
+    def save(self, unsent=()):
+        """Save where the last read or mark got to, replacing the
+        checkpoint file in one step so it is never half written.
+
+        Args:
+            unsent (list): Commands that were read but couldn't be
+                added, to send next time without the ones that were
+        """
+        if self.pending is None:
+            return
+        (
+            self.offset, self.size, self.anchor, self.anchor_lines,
+            self.sent
+        ) = self.pending
+        self.unsent = list(unsent)
+        self.pending = None
+        temp = '{0}.tmp'.format(self.path)
+        with open(temp, 'w') as checkpoint_file:
+            json.dump({
+                'offset': self.offset,
+                'size': self.size,
+                'anchor': self.anchor,
+                'anchor_lines': self.anchor_lines,
+                'sent': base64.b64encode(
+                    b''.join(sorted(self.sent))
+                ).decode('ascii'),
+                'unsent': self.unsent,
+            }, checkpoint_file)
+        os.rename(temp, self.path)
+        self.exists = True
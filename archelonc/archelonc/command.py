@@ -4,16 +4,21 @@ Command line entry points for the archelon client.
 """
 from __future__ import absolute_import, unicode_literals
 import codecs
-from difflib import Differ
 import os
-import shutil
 import sys
 
+from archelonc.checkpoint import HistoryCheckpoint
+from archelonc.importer import HistoryImporter
 from archelonc.search import Search
 from archelonc.data import WebHistory, ArcheloncException
 
 LARGE_UPDATE_COUNT = 50
+# Copy of the history updates used to diff against
 HISTORY_FILE = os.path.expanduser('~/.archelon_history')
+# How far through the history updates have got
+CHECKPOINT_FILE = os.path.expanduser('~/.archelon_checkpoint')
+# Chunks of an unfinished import that were uploaded
+IMPORT_CHECKPOINT_FILE = os.path.expanduser('~/.archelon_import')
 UNCONFIGURED_ERROR = ("Archelon isn't configured for Web history,"
                       " check `ARCHELON_URL` and `ARCHELON_TOKEN`"
                       " environment variables.")
@@ -21,8 +26,11 @@ UNCONFIGURED_ERROR = ("Archelon isn't configured for Web history,"
 
 def print_b(data):
     """Prints UTF decoded bytes with newline to ``sys.stdout``."""
-    data = str(data) + '\n'
-    sys.stdout.write(data.encode('UTF-8'))
+    data = '{0}\n'.format(data).encode('UTF-8')
+    # Bytes go to the buffer under Python 3
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+    output.write(data)
+    output.flush()
 
 
 def _get_web_setup():
@@ -45,10 +53,31 @@ def search_form():
     Search().run()
 
 
+def _legacy_history():
+    """
+    Commands in the copy of the history that updates used to diff
+    against, if it is still around.
+    """
+    if not os.path.exists(HISTORY_FILE):
+        return None
+    with codecs.open(HISTORY_FILE, encoding='UTF-8') as cached:
+        return set(line.strip() for line in cached)
+
+
 def update():
     """
-    Capture diff between stored history and new history and upload
-    the delta.
+    Upload the commands added to the shell's history since the last
+    update.
+
+    Only what was appended since the checkpoint is read, see
+    :py:class:`archelonc.checkpoint.HistoryCheckpoint`, and the
+    checkpoint is only moved once the server has answered.  Sending a
+    command the server already added counts another use of it, so
+    when only some fail, the checkpoint moves past all of them and
+    keeps just the failed ones to send next time.  Commands a spooling
+    server has ``queued`` are as good as added.  The first update
+    after upgrading from the copy of the history that used to be
+    diffed against uploads what isn't in that copy.
     """
     web_history = _get_web_setup()
     # If we aren't setup for Web usage, just bomb out.
@@ -59,39 +88,33 @@ def update():
     current_hist_file = os.path.expanduser(
         os.environ.get('HISTFILE', '~/.bash_history')
     )
-    # Create our diff file if it doesn't exist
-    if not os.path.exists(HISTORY_FILE):
-        open(HISTORY_FILE, 'a').close()
-
-    # Compare the current history to our previously stored one,
-    # upload any additions and copy the file over.
-    commands = {}
-    with codecs.open(HISTORY_FILE, encoding='UTF-8') as cached, \
-            codecs.open(current_hist_file, encoding='UTF-8') as current:
-        differ = Differ()
-        results = differ.compare(cached.readlines(), current.readlines())
-
-        # use diff lib "codes" to see if we need to upload differences
-        for diff in results:
-            if diff[:2] == '+ ' or diff[:2] == '? ':
-                if diff[2:-1]:
-                    commands[diff[2:-1]] = None
+    checkpoint = HistoryCheckpoint(CHECKPOINT_FILE)
+    uploaded = None if checkpoint.exists else _legacy_history()
+    commands = set(
+        x for x in checkpoint.unsent + checkpoint.read(current_hist_file)
+        if x and not (uploaded and x in uploaded)
+    )
 
     # Warn if we are doing a large upload
-    num_commands = len(list(commands.keys()))
+    num_commands = len(commands)
     if num_commands > LARGE_UPDATE_COUNT:
         print_b('Beginning upload of {} history items. '
                 'This may take a while...\n'.format(num_commands))
 
     try:
         success = True
-        commands = [x for x in list(commands.keys()) if x]
         # To ease testing, sort commands
-        commands.sort()
+        commands = sorted(commands)
         if len(commands) > 0:
             success, response = web_history.bulk_add(
                 commands
             )
+            summary = response[0] if isinstance(response, tuple) else None
+            if isinstance(summary, dict) and summary.get('failed'):
+                checkpoint.save(
+                    unsent=[commands[x] for x in summary['failed']]
+                )
+                success = False
     except ArcheloncException as ex:
         print_b(ex)
         sys.exit(3)
@@ -100,12 +123,17 @@ def update():
             response
         ))
         sys.exit(2)
-    shutil.copy(current_hist_file, HISTORY_FILE)
+    checkpoint.save()
 
 
 def import_history():
     """
     Import current shell's history into server
+
+    The history is streamed up in chunks from several threads, see
+    :py:class:`archelonc.importer.HistoryImporter`, reporting progress
+    as it goes.  If the import fails, running it again carries on
+    from the chunks that were already uploaded.
     """
     web_history = _get_web_setup()
     if not web_history:
@@ -119,15 +147,9 @@ def import_history():
         hist_file = sys.argv[1]
 
     hist_file_path = os.path.expanduser(hist_file)
-    with codecs.open(hist_file_path, encoding='UTF-8') as history_file:
-        commands = {}
-        for line in history_file:
-            command = line.strip()
-            if not command:
-                continue
-            commands[command] = None
+    importer = HistoryImporter(_get_web_setup, IMPORT_CHECKPOINT_FILE, print_b)
     try:
-        success, response = web_history.bulk_add(list(commands.keys()))
+        success, response = importer.run(hist_file_path)
     except ArcheloncException as ex:
         print_b(ex)
         sys.exit(4)
@@ -137,9 +159,11 @@ def import_history():
             response
         ))
         sys.exit(6)
-    # Make copy of imported history so we only have to track
-    # changes from here on out when archelon is invoked
-    shutil.copy(hist_file_path, HISTORY_FILE)
+    # Check point the end of the imported history so we only have to
+    # track changes from here on out when archelon is invoked
+    checkpoint = HistoryCheckpoint(CHECKPOINT_FILE)
+    checkpoint.mark(hist_file_path)
+    checkpoint.save()
 
 
 def export_history():
@@ -161,16 +185,11 @@ def export_history():
     if len(sys.argv) == 2:
         output_file = open(sys.argv[1], 'wb')
         stdout = False
-    page = 0
     try:
-        results = web_history.all(page)
+        web_history.export(output_file)
     except ArcheloncException as ex:
         print_b(ex)
         sys.exit(5)
-    while len(results) > 0:
-        output_file.write('\n'.join(results).encode('UTF-8'))
-        output_file.write('\n'.encode('UTF-8'))
-        page += 1
-        results = web_history.all(page)
-    if not stdout:
-        output_file.close()
+    finally:
+        if not stdout:
+            output_file.close()
@@ -6,7 +6,9 @@ from __future__ import print_function, absolute_import, unicode_literals
 from abc import ABCMeta, abstractmethod
 import codecs
 from collections import OrderedDict
+import json
 import os
+import zlib
 
 import requests
 import six
@@ -24,7 +26,16 @@ class ArcheloncConnectionException(ArcheloncException):
 
 class ArcheloncAPIException(ArcheloncException):
     """API exception occurred."""
-    pass
+
+    def __init__(self, message, status_code=None):
+        """Keep the status code of the response, if there was one.
+
+        Args:
+            message (str): What went wrong
+            status_code (int): HTTP status the server responded with
+        """
+        super(ArcheloncAPIException, self).__init__(message)
+        self.status_code = status_code
 
 
 class HistoryBase(six.with_metaclass(ABCMeta, object)):
@@ -103,6 +114,12 @@ class WebHistory(HistoryBase):
     Use RESTful API to do searches against archelond.
     """
     SEARCH_URL = '/api/v1/history'
+    EXPORT_URL = '/api/v1/history/export'
+    IMPORT_URL = '/api/v1/history/import'
+    # Bytes of the export to read at a time
+    EXPORT_CHUNK_SIZE = 64 * 1024
+    # Commands to compress and send at a time when importing
+    IMPORT_CHUNK_SIZE = 500
 
     def __init__(self, url, token):
         """
@@ -113,8 +130,20 @@ class WebHistory(HistoryBase):
             url=url.rstrip('/'),
             endpoint=self.SEARCH_URL
         )
+        self.export_url = '{url}{endpoint}'.format(
+            url=url.rstrip('/'),
+            endpoint=self.EXPORT_URL
+        )
+        self.import_url = '{url}{endpoint}'.format(
+            url=url.rstrip('/'),
+            endpoint=self.IMPORT_URL
+        )
         self.session = requests.Session()
         self.session.headers = {'Authorization': 'token {}'.format(token)}
+        # Cursors the server gave us, keyed by query and page
+        self.cursors = {}
+        # Whether the server has the import endpoint, until it 404s
+        self.importable = True
 
     def _connection_error(self):
         """
@@ -139,29 +168,59 @@ class WebHistory(HistoryBase):
             ArcheloncAPIException
         """
         raise ArcheloncAPIException(
-            'Error in API Call ({0.status_code}): {0.text}'.format(response)
+            'Error in API Call ({0.status_code}): {0.text}'.format(response),
+            response.status_code
         )
 
-    def search_forward(self, term, page=0):
+    def _get_page(self, params, page):
         """
-        Return a list of commmands that is in forward
-        time order. i.e oldest first.
+        Get a page of commands for the query in ``params``.
+
+        When the server handed us a cursor with the page before this
+        one, it is sent instead of the page number so the server can
+        pick up where it left off rather than counting its way back
+        to this page.
 
+        Args:
+            params (dict): Query parameters other than the page
+            page (int): Page number to get
         Raises:
             ArcheloncConnectionException
             ArcheloncAPIException
+        Returns:
+            list: The commands on the page
         """
+        key = tuple(sorted(params.items()))
+        if page == 0:
+            self.cursors = {}
+        cursor = self.cursors.get((key, page))
+        query = dict(params)
+        if cursor:
+            query['cursor'] = cursor
+        else:
+            query['p'] = page
         try:
-            response = self.session.get(
-                self.url,
-                params={'q': term, 'p': page}
-            )
+            response = self.session.get(self.url, params=query)
         except requests.exceptions.ConnectionError:
             self._connection_error()
 
         if response.status_code != 200:
             self._api_error(response)
-        return [x['command'] for x in response.json()['commands']]
+        body = response.json()
+        if body.get('cursor'):
+            self.cursors[(key, page + 1)] = body['cursor']
+        return [x['command'] for x in body['commands']]
+
+    def search_forward(self, term, page=0):
+        """
+        Return a list of commmands that is in forward
+        time order. i.e oldest first.
+
+        Raises:
+            ArcheloncConnectionException
+            ArcheloncAPIException
+        """
+        return self._get_page({'q': term}, page)
 
     def search_reverse(self, term, page=0):
         """
@@ -172,17 +231,7 @@ class WebHistory(HistoryBase):
             ArcheloncConnectionException
             ArcheloncAPIException
         """
-        try:
-            response = self.session.get(
-                self.url,
-                params={'q': term, 'o': 'r', 'p': page}
-            )
-        except requests.exceptions.ConnectionError:
-            self._connection_error()
-
-        if response.status_code != 200:
-            self._api_error(response)
-        return [x['command'] for x in response.json()['commands']]
+        return self._get_page({'q': term, 'o': 'r'}, page)
 
     def add(self, command):
         """
@@ -199,14 +248,16 @@ class WebHistory(HistoryBase):
             )
         except requests.exceptions.ConnectionError:
             self._connection_error()
-        if response.status_code != 201:
+        # The server may queue the command and accept it for later
+        if response.status_code not in (201, 202):
             self._api_error(response)
         else:
             return True, None
 
     def bulk_add(self, commands):
         """
-        Post a list of commands
+        Post a list of commands, asking for a summary of how many were
+        added instead of a response for every command.
 
         Args:
             commands (list): List of commands to add to server.
@@ -217,34 +268,104 @@ class WebHistory(HistoryBase):
         try:
             response = self.session.post(
                 self.url,
+                params={'response': 'summary'},
                 json={'commands': commands}
             )
         except requests.exceptions.ConnectionError:
             self._connection_error()
-        if response.status_code != 200:
+        if response.status_code not in (200, 202):
             self._api_error(response)
         else:
             return True, (response.json(), response.status_code)
 
-    def all(self, page):
+    def _import_body(self, commands):
         """
-        Return the entire data set available, one page at a time
+        Gzipped newline delimited JSON of the commands, compressed a
+        chunk at a time as the request is sent.
+        """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        lines = []
+        for command in commands:
+            lines.append(json.dumps(command))
+            if len(lines) == self.IMPORT_CHUNK_SIZE:
+                yield compressor.compress(
+                    ('\n'.join(lines) + '\n').encode('UTF-8')
+                )
+                lines = []
+        if lines:
+            yield compressor.compress(
+                ('\n'.join(lines) + '\n').encode('UTF-8')
+            )
+        yield compressor.flush()
+
+    def import_commands(self, commands):
+        """
+        Stream commands to the server's import endpoint, compressing
+        them as the request is sent.  Servers without the import
+        endpoint are sent them with :py:meth:`bulk_add` instead.
 
+        Args:
+            commands (iterable): Commands to add to server.
         Raises:
             ArcheloncConnectionException
             ArcheloncAPIException
+        Returns:
+            dict: The server's summary, with counts of the commands
+                ``received`` and ``added`` (or ``queued``), and the
+                positions of any that were ``invalid`` or ``failed``.
         """
+        # Kept to send again if the server doesn't have the endpoint
+        commands = list(commands)
+        if not self.importable:
+            return self._bulk_summary(commands)
         try:
-            response = self.session.get(
-                self.url,
-                params={'p': page}
+            response = self.session.post(
+                self.import_url,
+                data=self._import_body(commands),
+                headers={
+                    'Content-Type': 'application/x-ndjson',
+                    'Content-Encoding': 'gzip',
+                }
             )
         except requests.exceptions.ConnectionError:
             self._connection_error()
-
-        if response.status_code != 200:
+        if response.status_code == 404:
+            self.importable = False
+            return self._bulk_summary(commands)
+        if response.status_code not in (200, 202):
             self._api_error(response)
-        return [x['command'] for x in response.json()['commands']]
+        return response.json()
+
+    def _bulk_summary(self, commands):
+        """
+        Add commands with :py:meth:`bulk_add`, for servers from before
+        the import endpoint, summarized like an import.  Servers from
+        before summaries respond for every command, and those are
+        counted up instead.
+        """
+        summary = self.bulk_add(commands)[1][0]
+        if 'responses' in summary:
+            failed = [
+                index for index, item in enumerate(summary['responses'])
+                if item['status_code'] not in (200, 201, 202)
+            ]
+            summary = {
+                'received': len(commands),
+                'added': len(commands) - len(failed),
+                'failed': failed,
+            }
+        summary.setdefault('invalid', [])
+        return summary
+
+    def all(self, page):
+        """
+        Return the entire data set available, one page at a time
+
+        Raises:
+            ArcheloncConnectionException
+            ArcheloncAPIException
+        """
+        return self._get_page({}, page)
 
     def delete(self, command):
         """
@@ -280,3 +401,59 @@ class WebHistory(HistoryBase):
         )
         if response.status_code != 200:
             self._api_error(response)
+
+    def export(self, output_file):
+        """
+        Write every command to ``output_file``, one per line, as the
+        server streams them to us.  Servers without the export
+        endpoint are paged through with :py:meth:`all` instead.
+
+        Args:
+            output_file (file): Binary file to write the commands to
+        Raises:
+            ArcheloncConnectionException
+            ArcheloncAPIException
+        Returns:
+            int: The number of commands written
+        """
+        try:
+            response = self.session.get(self.export_url, stream=True)
+        except requests.exceptions.ConnectionError:
+            self._connection_error()
+        if response.status_code == 404:
+            response.close()
+            return self._export_pages(output_file)
+        if response.status_code != 200:
+            self._api_error(response)
+
+        count = 0
+        try:
+            for line in response.iter_lines(
+                    chunk_size=self.EXPORT_CHUNK_SIZE
+            ):
+                if not line:
+                    continue
+                command = json.loads(line.decode('UTF-8'))['command']
+                output_file.write(command.encode('UTF-8') + b'\n')
+                count += 1
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError):
+            self._connection_error()
+        finally:
+            response.close()
+        return count
+
+    def _export_pages(self, output_file):
+        """
+        Export a page at a time, for servers from before streaming.
+        """
+        count = 0
+        page = 0
+        results = self.all(page)
+        while len(results) > 0:
+            output_file.write('\n'.join(results).encode('UTF-8'))
+            output_file.write('\n'.encode('UTF-8'))
+            count += len(results)
+            page += 1
+            results = self.all(page)
+        return count
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Import a history file in chunks, uploaded in parallel, that a rerun
+can pick up from where a failed import left off.
+"""
+from __future__ import absolute_import, unicode_literals
+import codecs
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+from six.moves import queue  # pylint: disable=import-error
+
+from archelonc.data import (
+    ArcheloncAPIException, ArcheloncConnectionException
+)
+
+
+def read_chunks(path, chunk_size):
+    """Stream the unique commands of a history file in chunks.
+
+    Args:
+        path (str): History file to read
+        chunk_size (int): Commands in each chunk
+    Returns:
+        generator: ``(index, commands)`` of each chunk, in order
+    """
+    seen = set()
+    chunk = []
+    index = 0
+    with codecs.open(path, encoding='UTF-8') as history_file:
+        for line in history_file:
+            command = line.strip()
+            if not command or command in seen:
+                continue
+            seen.add(command)
+            chunk.append(command)
+            if len(chunk) == chunk_size:
+                yield index, chunk
+                index += 1
+                chunk = []
+    if chunk:
+        yield index, chunk
+
+
+def _digest(commands, previous=''):
+    """
+    Hash of a chunk's commands, chained onto the chunks before it.
+    """
+    return hashlib.sha1(
+        (previous + '\n' + '\n'.join(commands)).encode('UTF-8')
+    ).hexdigest()
+
+
+class ImportCheckpoint(object):
+    """Chunks of a history file the server has acknowledged.
+
+    Chunks finish out of order, so the checkpoint has how many chunks
+    from the start are all done (``through``), with a hash chained
+    over their commands to tell whether the file still starts the
+    same way, and the hashes of the chunks done past those.
+    """
+
+    def __init__(self, path, history_path, chunk_size):
+        """Load the checkpoint at ``path`` if it is for the same
+        import, or start a new one.
+
+        Args:
+            path (str): File the checkpoint is kept in
+            history_path (str): History file being imported
+            chunk_size (int): Commands in each chunk
+        """
+        self.path = path
+        self.history_path = os.path.realpath(history_path)
+        self.chunk_size = chunk_size
+        self.reset()
+        try:
+            with open(path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if (state['history_path'], state['chunk_size']) == (
+                    self.history_path, self.chunk_size
+            ):
+                self.through = state['through']
+                self.digest = state['digest']
+                self.done = dict(
+                    (int(index), digest)
+                    for index, digest in state['done'].items()
+                )
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def reset(self):
+        """
+        Forget every chunk.
+        """
+        self.through = 0
+        self.digest = ''
+        self.done = {}
+
+    def ack(self, index, commands):
+        """Note that a chunk was uploaded and save.
+
+        Args:
+            index (int): Chunk number
+            commands (list): The chunk's commands
+        """
+        self.done[index] = _digest(commands)
+        # Chain on each chunk's hash once every chunk before it is done
+        while self.through in self.done:
+            self.digest = _digest([self.done.pop(self.through)], self.digest)
+            self.through += 1
+        self.save()
+
+    def save(self):
+        """
+        Replace the checkpoint file in one step so it is never half
+        written.
+        """
+        temp = '{0}.tmp'.format(self.path)
+        with open(temp, 'w') as checkpoint_file:
+            json.dump({
+                'history_path': self.history_path,
+                'chunk_size': self.chunk_size,
+                'through': self.through,
+                'digest': self.digest,
+                'done': dict(
+                    (str(index), digest)
+                    for index, digest in self.done.items()
+                ),
+            }, checkpoint_file)
+        os.rename(temp, self.path)
+
+    def remove(self):
+        """
+        Delete the checkpoint once the import is finished.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class HistoryImporter(object):
+    """Upload a history file ``CHUNK_SIZE`` commands at a time from
+    ``WORKERS`` threads, each chunk gzipped to the server's import
+    endpoint with :py:meth:`archelonc.data.WebHistory.import_commands`.
+
+    Commands are read as they are needed, with only a couple of chunks
+    per worker waiting to be sent.  Chunks that fail to connect or get
+    a server error are retried ``RETRIES`` times, waiting twice as
+    long each time from ``BACKOFF`` seconds, give or take half, and so
+    are the commands of a chunk the server says it failed to add.  A
+    chunk is only acknowledged once all of its commands are added.
+    Every acknowledged chunk is checkpointed, so running the import again
+    skips what was uploaded as long as the start of the file hasn't
+    changed, and progress is reported every ``PROGRESS_INTERVAL``
+    seconds.
+    """
+    CHUNK_SIZE = 500
+    WORKERS = 4
+    RETRIES = 5
+    BACKOFF = 0.5
+    PROGRESS_INTERVAL = 5
+
+    def __init__(self, web_history_factory, checkpoint_path, report):
+        """Set up the import.
+
+        Args:
+            web_history_factory (function): Returns the
+                :py:class:`archelonc.data.WebHistory` for each worker
+                to upload with
+            checkpoint_path (str): File to checkpoint progress in
+            report (function): Called with each progress message
+        """
+        self.web_history_factory = web_history_factory
+        self.checkpoint_path = checkpoint_path
+        self.report = report
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.checkpoint = None
+        self.error = None
+        self.failure = None
+        self.sent = 0
+        self.added = 0
+        self.queued = 0
+        self.started = None
+        self.reported = None
+
+    @staticmethod
+    def _retryable(ex):
+        """
+        Whether an upload that raised is worth trying again.
+        """
+        if isinstance(ex, ArcheloncConnectionException):
+            return True
+        status_code = getattr(ex, 'status_code', None)
+        return status_code is None or status_code >= 500 or status_code == 429
+
+    def _wait(self, attempt):
+        """
+        Back off before another attempt, returning whether to give up
+        waiting because another chunk has failed.
+        """
+        return self.stop.wait(
+            self.BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+        )
+
+    def _upload(self, web_history, commands):
+        """
+        Upload a chunk, retrying with backoff, and then retrying just
+        the commands the server failed to add.
+
+        Returns:
+            tuple: Whether every command was added or queued, and the
+                summary of the chunk, with the positions that still
+                ``failed``.
+        """
+        attempt = 0
+        positions = list(range(len(commands)))
+        added = 0
+        queued = 0
+        while True:
+            try:
+                summary = web_history.import_commands(
+                    [commands[x] for x in positions]
+                )
+            except (ArcheloncConnectionException,
+                    ArcheloncAPIException) as ex:
+                if attempt >= self.RETRIES or not self._retryable(ex):
+                    raise
+                if self._wait(attempt):
+                    raise
+                attempt += 1
+                continue
+            added += summary.get('added', 0)
+            # Servers that spool count commands as queued until they
+            # are flushed
+            queued += summary.get('queued', 0)
+            # Commands the server can't read won't do any better again
+            positions = [positions[x] for x in summary.get('failed', [])]
+            summary = {
+                'received': len(commands), 'added': added, 'queued': queued,
+                'failed': positions
+            }
+            if not positions:
+                return True, summary
+            if attempt >= self.RETRIES or self._wait(attempt):
+                return False, summary
+            attempt += 1
+
+    def _record(self, index, commands, summary):
+        """
+        Checkpoint and count an uploaded chunk, reporting progress
+        now and then.  Must be called with the lock held.
+        """
+        self.checkpoint.ack(index, commands)
+        self.sent += len(commands)
+        self.added += summary['added']
+        self.queued += summary['queued']
+        now = time.time()
+        if now - self.reported >= self.PROGRESS_INTERVAL:
+            self.reported = now
+            self.report('Imported {0} commands, {1:.0f} commands/s'.format(
+                self.sent, self.sent / (now - self.started)
+            ))
+
+    def _work(self, web_history, tasks):
+        """
+        Upload chunks until told there are no more, skipping them once
+        anything has failed.
+        """
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            if self.stop.is_set():
+                continue
+            index, commands = task
+            try:
+                success, summary = self._upload(web_history, commands)
+            except Exception as ex:  # pylint: disable=broad-except
+                with self.lock:
+                    self.error = self.error or ex
+                self.stop.set()
+                continue
+            with self.lock:
+                if not success:
+                    self.failure = self.failure or (summary,)
+                    self.stop.set()
+                    continue
+                self._record(index, commands, summary)
+
+    def _pending(self, history_path):
+        """
+        Chunks that still need uploading, starting over if the start
+        of the file changed since the checkpoint.
+        """
+        checkpoint = self.checkpoint
+        # Workers move the checkpoint on as soon as chunks are yielded
+        through, expected = checkpoint.through, checkpoint.digest
+        if through or checkpoint.done:
+            self.report('Resuming import of {0} after {1} commands'.format(
+                history_path, through * self.CHUNK_SIZE
+            ))
+        digest = ''
+        for index, commands in read_chunks(history_path, self.CHUNK_SIZE):
+            if index < through:
+                digest = _digest([_digest(commands)], digest)
+                if index == through - 1 and digest != expected:
+                    break
+                continue
+            if checkpoint.done.get(index) == _digest(commands):
+                continue
+            yield index, commands
+        else:
+            if digest == expected:
+                return
+        self.report('History changed since the last import, starting over')
+        with self.lock:
+            checkpoint.reset()
+        for chunk in self._pending(history_path):
+            yield chunk
+
+    def run(self, history_path):
+        """Import a history file.
+
+        Args:
+            history_path (str): History file to import
+        Raises:
+            ArcheloncConnectionException: When a chunk couldn't be
+                uploaded after retrying
+            ArcheloncAPIException: When the server rejected a chunk
+        Returns:
+            tuple: Whether every chunk was uploaded, and the summary of
+                one that wasn't, with the positions in the chunk of
+                the commands that ``failed``.  The
+                checkpoint is removed once everything is uploaded, and
+                otherwise kept without that chunk for a rerun.
+        """
+        self.checkpoint = ImportCheckpoint(
+            self.checkpoint_path, history_path, self.CHUNK_SIZE
+        )
+        self.started = self.reported = time.time()
+        tasks = queue.Queue(self.WORKERS * 2)
+        workers = [
+            threading.Thread(
+                target=self._work, args=(self.web_history_factory(), tasks)
+            )
+            for _ in range(self.WORKERS)
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            for chunk in self._pending(history_path):
+                if self.stop.is_set():
+                    break
+                tasks.put(chunk)
+        finally:
+            for _ in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join()
+
+        if self.error:
+            raise self.error  # pylint: disable=raising-bad-type
+        if self.failure:
+            return False, self.failure[0]
+        elapsed = time.time() - self.started
+        self.report(
+            'Imported {0} commands ({1} added, {2} queued) in {3:.1f}s, '
+            '{4:.0f} commands/s'.format(
+                self.sent, self.added, self.queued, elapsed,
+                self.sent / elapsed if elapsed else 0
+            )
+        )
+        self.checkpoint.remove()
+        return True, None
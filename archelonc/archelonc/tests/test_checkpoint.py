@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Verify reading history from where the last update left off.
+"""
+from __future__ import absolute_import, unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+from archelonc.checkpoint import HistoryCheckpoint
+
+
+class TestHistoryCheckpoint(unittest.TestCase):
+    """
+    Check points through appends, truncation and replacement.
+    """
+
+    def setUp(self):
+        """
+        Make a history and check point file to work with.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.history = os.path.join(directory, 'history')
+        self.path = os.path.join(directory, 'checkpoint')
+
+    def write(self, lines, mode='ab'):
+        """
+        Write lines to the history.
+        """
+        with open(self.history, mode) as history_file:
+            history_file.write(''.join(
+                '{0}\n'.format(line) for line in lines
+            ).encode('UTF-8'))
+
+    def read(self):
+        """
+        Read new lines with a freshly loaded check point and save it.
+        """
+        checkpoint = HistoryCheckpoint(self.path)
+        lines = [line for line in checkpoint.read(self.history) if line]
+        checkpoint.save()
+        return lines
+
+    def test_appended(self):
+        """
+        Only lines after the check point are read, and only once
+        saved.
+        """
+        self.write(['ls', 'cd ☠'])
+        checkpoint = HistoryCheckpoint(self.path)
+        self.assertFalse(checkpoint.exists)
+        self.assertEqual(['ls', 'cd ☠'], checkpoint.read(self.history)[:2])
+        # Not saved, so read again
+        self.assertEqual(['ls', 'cd ☠'], self.read())
+        self.assertTrue(HistoryCheckpoint(self.path).exists)
+        self.assertEqual([], self.read())
+        self.write(['git status', 'ls'])
+        self.assertEqual(['git status', 'ls'], self.read())
+
+    def test_partial_line(self):
+        """
+        A line still being written is left until it is finished.
+        """
+        self.write(['ls'])
+        with open(self.history, 'ab') as history_file:
+            history_file.write(b'git st')
+        self.assertEqual(['ls'], self.read())
+        with open(self.history, 'ab') as history_file:
+            history_file.write(b'atus\n')
+        self.assertEqual(['git status'], self.read())
+
+    def test_truncated(self):
+        """
+        When the oldest lines are cut off, reading carries on after
+        the lines read last time.
+        """
+        lines = ['command {0}'.format(number) for number in range(100)]
+        self.write(lines)
+        self.read()
+        # Like bash keeping to HISTFILESIZE
+        self.write(lines[30:] + ['new 1', 'new 2'], mode='wb')
+        self.assertEqual(['new 1', 'new 2'], self.read())
+
+    def test_truncated_far(self):
+        """
+        The anchor is found when it is further back than is read at
+        first.
+        """
+        lines = ['command {0}'.format(number) for number in range(100)]
+        self.write(lines)
+        self.read()
+        added = ['new {0}'.format(number) for number in range(1000)]
+        self.write(lines[50:] + added, mode='wb')
+        checkpoint = HistoryCheckpoint(self.path)
+        checkpoint.READ_SIZE = 64
+        self.assertEqual(added, checkpoint.read(self.history)[:-1])
+
+    def test_truncated_repeated(self):
+        """
+        An anchor of the same command over and over isn't mistaken for
+        copies of it added after, skipping what came between.
+        """
+        self.write(['ls'] * 20)
+        self.read()
+        self.write(['ls'] * 15 + ['vim secret'] + ['ls'] * 16, mode='wb')
+        self.assertIn('vim secret', self.read())
+        # Nor for copies of it before the new ones
+        self.write(['ls'] * 40, mode='wb')
+        self.read()
+        self.write(['ls'] * 20 + ['vim notes', 'ls'], mode='wb')
+        self.assertEqual(['vim notes'], self.read())
+
+    def test_replaced(self):
+        """
+        A history without the anchor in it is read from the start.
+        """
+        self.write(['command {0}'.format(number) for number in range(100)])
+        self.read()
+        self.write(['ls', 'cd'], mode='wb')
+        self.assertEqual(['ls', 'cd'], self.read())
+
+    def test_replaced_sent(self):
+        """
+        Reading the whole file again leaves out the lines that were
+        sent before, since sending them again counts another use.
+        """
+        self.write(['command {0}'.format(number) for number in range(100)])
+        self.read()
+        self.write(['command 5', 'ls', 'command 7'], mode='wb')
+        self.assertEqual(['ls'], self.read())
+        # Only what is in the file is remembered after that
+        self.write(['command 8', 'ls', 'cd'], mode='wb')
+        self.assertEqual(['command 8', 'cd'], self.read())
+
+    def test_unsent(self):
+        """
+        Commands saved as unsent are kept until the next save.
+        """
+        self.write(['ls', 'cd'])
+        checkpoint = HistoryCheckpoint(self.path)
+        checkpoint.read(self.history)
+        checkpoint.save(unsent=['cd'])
+        checkpoint = HistoryCheckpoint(self.path)
+        self.assertEqual(['cd'], checkpoint.unsent)
+        self.assertEqual([], [x for x in checkpoint.read(self.history) if x])
+        checkpoint.save()
+        self.assertEqual([], HistoryCheckpoint(self.path).unsent)
+
+    def test_mark(self):
+        """
+        Marking skips everything already in the file.
+        """
+        self.write(['ls', 'cd'])
+        checkpoint = HistoryCheckpoint(self.path)
+        checkpoint.mark(self.history)
+        checkpoint.save()
+        self.assertEqual(os.path.getsize(self.history), checkpoint.offset)
+        self.write(['git status'])
+        self.assertEqual(['git status'], self.read())
+        self.write(['cd', 'make'], mode='wb')
+        self.assertEqual(['make'], self.read())
+
+    def test_unreadable(self):
+        """
+        A broken check point file is as good as none.
+        """
+        with open(self.path, 'w') as checkpoint_file:
+            checkpoint_file.write('{"offset": ')
+        self.write(['ls'])
+        checkpoint = HistoryCheckpoint(self.path)
+        self.assertFalse(checkpoint.exists)
+        self.assertEqual(['ls'], self.read())
@@ -3,13 +3,15 @@
 Verify the various archelonc commands.
 """
 from __future__ import absolute_import, print_function, unicode_literals
-import filecmp
 from io import BytesIO
 import os
+import shutil
+import tempfile
 from tempfile import NamedTemporaryFile as TempFile
 
 import mock
 
+from archelonc.checkpoint import HistoryCheckpoint
 from archelonc.command import (
     _get_web_setup,
     search_form,
@@ -42,6 +44,37 @@ class TestCommands(WebTest):
         "history_alt"
     )
 
+    def setUp(self):
+        """
+        Keep check points somewhere of our own, and don't wait
+        between retries.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.checkpoint_file = os.path.join(directory, 'checkpoint')
+        self.import_checkpoint_file = os.path.join(directory, 'import')
+        for patcher in (
+                mock.patch(
+                    'archelonc.command.CHECKPOINT_FILE', self.checkpoint_file
+                ),
+                mock.patch(
+                    'archelonc.command.IMPORT_CHECKPOINT_FILE',
+                    self.import_checkpoint_file
+                ),
+                mock.patch('archelonc.importer.HistoryImporter.BACKOFF', 0),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def assert_checkpoint_at_end(self, history_path):
+        """
+        Verify the check point is at the end of a history file.
+        """
+        self.assertEqual(
+            os.path.getsize(history_path),
+            HistoryCheckpoint(self.checkpoint_file).offset
+        )
+
     def test_web_setup(self):
         """
         Validate the common WebHistory configuration.
@@ -93,11 +126,9 @@ class TestCommands(WebTest):
         Do the successful test with one command.
         """
         self.assertFalse(os.path.exists(self.TEST_ARCHELON_HISTORY))
-        self.addCleanup(os.remove, self.TEST_ARCHELON_HISTORY)
         update()
-        self.assertTrue(
-            filecmp.cmp(self.TEST_ARCHELON_HISTORY, self.TEST_BASH_HISTORY)
-        )
+        self.assert_checkpoint_at_end(self.TEST_BASH_HISTORY)
+        self.assertFalse(os.path.exists(self.TEST_ARCHELON_HISTORY))
 
     @mock.patch.dict('os.environ', {'HISTFILE': TEST_BASH_HISTORY}, clear=True)
     @mock.patch('archelonc.command._get_web_setup')
@@ -119,6 +150,10 @@ class TestCommands(WebTest):
                     mock_web.bulk_add.call_args[0][0],
                     ["echo 'Hey you guys!☠'"]
                 )
+                # The copy is only used until there is a check point
+                mock_web.reset_mock()
+                update()
+                self.assertFalse(mock_web.bulk_add.called)
 
     @mock.patch('archelonc.command._get_web_setup')
     def test_update_diff_blanks(self, mock_web_setup):
@@ -149,7 +184,6 @@ class TestCommands(WebTest):
         """
         Verify exception handling and failure mode in update command.
         """
-        self.addCleanup(os.remove, self.TEST_ARCHELON_HISTORY)
         mock_web = mock.MagicMock()
         mock_web.bulk_add.return_value = False, 'foo'
         mock_web_setup.return_value = mock_web
@@ -163,6 +197,25 @@ class TestCommands(WebTest):
         with self.assertRaises(SystemExit) as exception_context:
             update()
         self.assertEqual(exception_context.exception.code, 3)
+        # The commands are tried again next time
+        self.assertFalse(os.path.exists(self.checkpoint_file))
+        # Or with commands the server failed to add
+        mock_web.bulk_add.side_effect = None
+        mock_web.bulk_add.return_value = True, (
+            {'received': 2, 'added': 1, 'failed': [1]}, 200
+        )
+        with self.assertRaises(SystemExit) as exception_context:
+            update()
+        self.assertEqual(exception_context.exception.code, 2)
+        # Only those are sent again, the others would count twice
+        mock_web.bulk_add.return_value = True, (
+            {'received': 1, 'added': 1, 'failed': []}, 200
+        )
+        update()
+        self.assertEqual(
+            ["export FOO='bar☠'"], mock_web.bulk_add.call_args[0][0]
+        )
+        self.assertEqual([], HistoryCheckpoint(self.checkpoint_file).unsent)
 
     @mock.patch.dict('os.environ', {'HISTFILE': TEST_BASH_HISTORY}, clear=True)
     @mock.patch('archelonc.command.HISTORY_FILE', TEST_ARCHELON_HISTORY)
@@ -173,7 +226,6 @@ class TestCommands(WebTest):
         """
         Verify output when there are greater than 50 commands
         """
-        self.addCleanup(os.remove, self.TEST_ARCHELON_HISTORY)
         mock_web = mock.MagicMock()
         mock_web.bulk_add.return_value = False, 'foo'
         mock_web_setup.return_value = mock_web
@@ -189,15 +241,16 @@ class TestCommands(WebTest):
         """
         Verify the uploading of our history file to the server.
         """
-        self.addCleanup(os.remove, self.TEST_ARCHELON_HISTORY)
         mock_web = mock.MagicMock()
-        mock_web.bulk_add.return_value = True, 'foo'
+        mock_web.import_commands.return_value = {'added': 1, 'failed': []}
         mock_web_setup.return_value = mock_web
         with mock.patch('sys.argv', []):
             import_history()
-        self.assertTrue(
-            filecmp.cmp(self.TEST_ARCHELON_HISTORY, self.TEST_BASH_HISTORY)
-        )
+        self.assert_checkpoint_at_end(self.TEST_BASH_HISTORY)
+        # Updates carry on from the end of the import
+        mock_web.reset_mock()
+        update()
+        self.assertFalse(mock_web.bulk_add.called)
 
     @mock.patch.dict('os.environ', {'HISTFILE': TEST_BASH_HISTORY}, clear=True)
     @mock.patch('archelonc.command.HISTORY_FILE', TEST_ARCHELON_HISTORY)
@@ -207,33 +260,31 @@ class TestCommands(WebTest):
         Verify the uploading of our history file to the server
         from a specified file.
         """
-        self.addCleanup(os.remove, self.TEST_ARCHELON_HISTORY)
         mock_web = mock.MagicMock()
-        mock_web.bulk_add.return_value = True, 'foo'
+        mock_web.import_commands.return_value = {'added': 1, 'failed': []}
         mock_web_setup.return_value = mock_web
         with mock.patch('sys.argv', ['a', self.TEST_BASH_HISTORY_ALT]):
             import_history()
-        self.assertTrue(
-            filecmp.cmp(self.TEST_ARCHELON_HISTORY, self.TEST_BASH_HISTORY_ALT)
-        )
+        self.assert_checkpoint_at_end(self.TEST_BASH_HISTORY_ALT)
 
     @mock.patch.dict('os.environ', {'HISTFILE': TEST_BASH_HISTORY}, clear=True)
+    @mock.patch('archelonc.importer.HistoryImporter.RETRIES', 0)
     @mock.patch('archelonc.command._get_web_setup')
     def test_import_errors(self, mock_web_setup):
         """
         Test handling of connection error handling.
         """
         mock_web = mock.MagicMock()
-        mock_web.bulk_add.side_effect = ArcheloncConnectionException()
+        mock_web.import_commands.side_effect = ArcheloncConnectionException()
         mock_web_setup.return_value = mock_web
         with mock.patch('sys.argv', []):
             with self.assertRaises(SystemExit) as exception_context:
                 import_history()
         self.assertEqual(exception_context.exception.code, 4)
 
-        # Test bad results coming back
-        mock_web.bulk_add.side_effect = None
-        mock_web.bulk_add.return_value = False, 'foo'
+        # Test commands the server failed to add
+        mock_web.import_commands.side_effect = None
+        mock_web.import_commands.return_value = {'added': 0, 'failed': [0]}
         with mock.patch('sys.argv', []):
             with self.assertRaises(SystemExit) as exception_context:
                 import_history()
@@ -248,14 +299,13 @@ class TestCommands(WebTest):
         test_list = ['testing-export1', 'testing-export2☠']
         mock_web = mock.MagicMock()
 
-        def side_effect(*args):
-            """Do two pages of the same results."""
-            if args[0] < 2:
-                return test_list
-            else:
-                return []
+        def side_effect(output_file):
+            """Write the commands the way the server streams them."""
+            for command in test_list * 2:
+                output_file.write(command.encode('UTF-8') + b'\n')
+            return len(test_list) * 2
 
-        mock_web.all.side_effect = side_effect
+        mock_web.export.side_effect = side_effect
         mock_web_setup.return_value = mock_web
         with mock.patch('sys.argv', []):
             export_history()
@@ -274,14 +324,13 @@ class TestCommands(WebTest):
         test_list = ['testing-export1', 'testing-export2☠']
         mock_web = mock.MagicMock()
 
-        def side_effect(*args):
-            """Do two pages of the same results."""
-            if args[0] < 2:
-                return test_list
-            else:
-                return []
+        def side_effect(output_file):
+            """Write the commands the way the server streams them."""
+            for command in test_list * 2:
+                output_file.write(command.encode('UTF-8') + b'\n')
+            return len(test_list) * 2
 
-        mock_web.all.side_effect = side_effect
+        mock_web.export.side_effect = side_effect
         mock_web_setup.return_value = mock_web
         with mock.patch('sys.argv', ['a', self.TEST_ARCHELON_HISTORY]):
             export_history()
@@ -297,7 +346,7 @@ class TestCommands(WebTest):
         Test handling of connection error handling.
         """
         mock_web = mock.MagicMock()
-        mock_web.all.side_effect = ArcheloncConnectionException()
+        mock_web.export.side_effect = ArcheloncConnectionException()
         mock_web_setup.return_value = mock_web
         with mock.patch('sys.argv', []):
             with self.assertRaises(SystemExit) as exception_context:
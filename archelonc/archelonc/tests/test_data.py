@@ -3,11 +3,15 @@
 Verify that the API calls work as expected
 """
 from __future__ import absolute_import, print_function, unicode_literals
+from io import BytesIO
+import json
 import os
 import time
 import unittest
+import zlib
 
 import mock
+import requests
 from six.moves import range  # pylint: disable=redefined-builtin,import-error
 
 from archelonc.data import (
@@ -169,6 +173,153 @@ class TestWebHistory(WebTest):
             with self.assertRaises(ArcheloncAPIException):
                 getattr(history, method[0])(*method[1])
 
+    def test_cursor_paging(self):
+        """
+        Verify we send back the cursor the server gave us for the next
+        page, and fall back to page numbers without one.
+        """
+        history = WebHistory('http://blah', 'asdf')
+        response_mock = mock.MagicMock()
+        response_mock.status_code = 200
+        response_mock.json.return_value = {
+            'commands': [{'command': 'foo'}], 'cursor': 'abc'
+        }
+        history.session = mock.MagicMock()
+        history.session.get.return_value = response_mock
+
+        self.assertEqual(['foo'], history.search_reverse('f', 0))
+        history.session.get.assert_called_with(
+            history.url, params={'q': 'f', 'o': 'r', 'p': 0}
+        )
+        history.search_reverse('f', 1)
+        history.session.get.assert_called_with(
+            history.url, params={'q': 'f', 'o': 'r', 'cursor': 'abc'}
+        )
+        # Different query, no cursor for it
+        response_mock.json.return_value = {'commands': []}
+        history.search_forward('f', 2)
+        history.session.get.assert_called_with(
+            history.url, params={'q': 'f', 'p': 2}
+        )
+
+    def test_accepted(self):
+        """
+        Verify commands queued by the server count as added.
+        """
+        history = WebHistory('http://blah', 'asdf')
+        response_mock = mock.MagicMock()
+        response_mock.status_code = 202
+        summary = {'received': 1, 'added': 1, 'failed': []}
+        response_mock.json.return_value = summary
+        history.session = mock.MagicMock()
+        history.session.post.return_value = response_mock
+        self.assertEqual((True, None), history.add('ls'))
+        self.assertEqual((True, (summary, 202)), history.bulk_add(['ls']))
+        history.session.post.assert_called_with(
+            history.url, params={'response': 'summary'},
+            json={'commands': ['ls']}
+        )
+
+    def test_export(self):
+        """
+        Verify exports are streamed into the file, and paged through on
+        servers without streaming.
+        """
+        history = WebHistory('http://blah', 'asdf')
+        response_mock = mock.MagicMock()
+        response_mock.status_code = 200
+        response_mock.iter_lines.return_value = [
+            b'{"command": "ls"}', b'', '{"command": "pwd☠"}'.encode('UTF-8')
+        ]
+        history.session = mock.MagicMock()
+        history.session.get.return_value = response_mock
+        output_file = BytesIO()
+        self.assertEqual(2, history.export(output_file))
+        self.assertEqual('ls\npwd☠\n'.encode('UTF-8'), output_file.getvalue())
+        history.session.get.assert_called_with(
+            'http://blah/api/v1/history/export', stream=True
+        )
+        self.assertTrue(response_mock.close.called)
+
+        response_mock.iter_lines.side_effect = (
+            requests.exceptions.ChunkedEncodingError()
+        )
+        with self.assertRaises(ArcheloncConnectionException):
+            history.export(BytesIO())
+
+        response_mock.status_code = 500
+        with self.assertRaises(ArcheloncAPIException):
+            history.export(BytesIO())
+
+        response_mock.status_code = 404
+        with mock.patch.object(history, 'all') as mock_all:
+            mock_all.side_effect = (
+                lambda page: ['ls', 'pwd'] if page < 2 else []
+            )
+            output_file = BytesIO()
+            self.assertEqual(4, history.export(output_file))
+        self.assertEqual(b'ls\npwd\nls\npwd\n', output_file.getvalue())
+
+    def test_import_commands(self):
+        """
+        Verify imports are streamed as gzipped lines of JSON.
+        """
+        history = WebHistory('http://blah', 'asdf')
+        history.IMPORT_CHUNK_SIZE = 2
+        summary = {'received': 3, 'added': 3, 'invalid': [], 'failed': []}
+        response_mock = mock.MagicMock()
+        response_mock.status_code = 200
+        response_mock.json.return_value = summary
+        history.session = mock.MagicMock()
+        history.session.post.return_value = response_mock
+
+        self.assertEqual(
+            summary, history.import_commands(iter(['ls', 'pwd☠', 'who']))
+        )
+        args, kwargs = history.session.post.call_args
+        self.assertEqual(('http://blah/api/v1/history/import',), args)
+        self.assertEqual('gzip', kwargs['headers']['Content-Encoding'])
+        body = zlib.decompress(
+            b''.join(kwargs['data']), 16 + zlib.MAX_WBITS
+        ).decode('UTF-8')
+        self.assertEqual(
+            ['ls', 'pwd☠', 'who'],
+            [json.loads(line) for line in body.splitlines()]
+        )
+
+        response_mock.status_code = 413
+        with self.assertRaises(ArcheloncAPIException):
+            history.import_commands(['ls'])
+
+    def test_import_commands_bulk(self):
+        """
+        Servers without the import endpoint get bulk posts instead,
+        with or without summaries.
+        """
+        history = WebHistory('http://blah', 'asdf')
+        response_mock = mock.MagicMock()
+        response_mock.status_code = 404
+        history.session = mock.MagicMock()
+        history.session.post.return_value = response_mock
+        with mock.patch.object(history, 'bulk_add') as bulk_add:
+            bulk_add.return_value = True, (
+                {'received': 2, 'added': 1, 'failed': [1]}, 200
+            )
+            self.assertEqual(
+                {'received': 2, 'added': 1, 'invalid': [], 'failed': [1]},
+                history.import_commands(iter(['ls', 'pwd']))
+            )
+            bulk_add.assert_called_with(['ls', 'pwd'])
+            # The import endpoint isn't tried again
+            bulk_add.return_value = True, ({'responses': [
+                {'status_code': 201}, {'status_code': 500}
+            ]}, 200)
+            self.assertEqual(
+                {'received': 2, 'added': 1, 'invalid': [], 'failed': [1]},
+                history.import_commands(['who', 'ls'])
+            )
+        self.assertEqual(1, history.session.post.call_count)
+
     @WebTest.VCR.use_cassette()
     def test_add_successful(self):
         """
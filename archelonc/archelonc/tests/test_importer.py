@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Verify chunked, parallel and resumable imports.
+"""
+from __future__ import absolute_import, unicode_literals
+import codecs
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from archelonc.data import (
+    ArcheloncAPIException, ArcheloncConnectionException
+)
+from archelonc.importer import (
+    HistoryImporter, ImportCheckpoint, read_chunks
+)
+
+
+class FakeWebHistory(object):
+    """
+    Record imports, failing the ones asked to.
+    """
+
+    def __init__(self, failures=None, spooled=False):
+        """
+        Start without any commands, counting them as queued rather
+        than added if ``spooled``.
+        """
+        self.lock = threading.Lock()
+        self.calls = []
+        self.failures = failures or {}
+        self.spooled = spooled
+
+    def import_commands(self, commands):
+        """
+        Record the commands, or raise the next failure for them.  A
+        list of failures is positions the server failed to add.
+        """
+        failed = []
+        with self.lock:
+            self.calls.append(list(commands))
+            failures = self.failures.get(commands[0])
+            if failures:
+                failure = failures.pop(0)
+                if isinstance(failure, Exception):
+                    raise failure
+                failed = failure
+        summary = {'received': len(commands),
+                   'added': len(commands) - len(failed),
+                   'invalid': [], 'failed': failed}
+        if self.spooled:
+            summary['queued'], summary['added'] = summary['added'], 0
+        return summary
+
+    def commands(self):
+        """
+        Every command uploaded.
+        """
+        return sorted(command for call in self.calls for command in call)
+
+
+class TestHistoryImporter(unittest.TestCase):
+    """
+    Imports in chunks, with retries and picking up where they failed.
+    """
+
+    def setUp(self):
+        """
+        Write a history to import, with small chunks and no waiting.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.history = os.path.join(directory, 'history')
+        self.checkpoint = os.path.join(directory, 'import')
+        self.commands = ['command {0} ☠'.format(x) for x in range(10)]
+        self.write(self.commands + ['', 'command 3 ☠'])
+        self.messages = []
+
+    def write(self, commands):
+        """
+        Replace the history.
+        """
+        with codecs.open(self.history, 'w', encoding='UTF-8') as history:
+            history.write(''.join(x + '\n' for x in commands))
+
+    def importer(self, web_history, workers=3):
+        """
+        Importer of three command chunks uploading to ``web_history``.
+        """
+        importer = HistoryImporter(
+            lambda: web_history, self.checkpoint, self.messages.append
+        )
+        importer.CHUNK_SIZE = 3
+        importer.WORKERS = workers
+        importer.BACKOFF = 0
+        return importer
+
+    def test_read_chunks(self):
+        """
+        Unique commands are read in chunks, without blanks.
+        """
+        self.assertEqual(
+            [
+                (0, self.commands[0:3]), (1, self.commands[3:6]),
+                (2, self.commands[6:9]), (3, self.commands[9:]),
+            ],
+            list(read_chunks(self.history, 3))
+        )
+
+    def test_import(self):
+        """
+        Every command is uploaded once, and the finished import leaves
+        no checkpoint.
+        """
+        web_history = FakeWebHistory()
+        self.assertEqual(
+            (True, None), self.importer(web_history).run(self.history)
+        )
+        self.assertEqual(4, len(web_history.calls))
+        self.assertEqual(sorted(self.commands), web_history.commands())
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertIn(
+            'Imported 10 commands (10 added, 0 queued)', self.messages[-1]
+        )
+
+    def test_spooled(self):
+        """
+        Commands a spooling server queued count as uploaded.
+        """
+        web_history = FakeWebHistory(spooled=True)
+        self.assertEqual(
+            (True, None), self.importer(web_history).run(self.history)
+        )
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertIn(
+            'Imported 10 commands (0 added, 10 queued)', self.messages[-1]
+        )
+
+    def test_retries(self):
+        """
+        Connection and server errors are retried until they run out.
+        """
+        web_history = FakeWebHistory({self.commands[3]: [
+            ArcheloncConnectionException(),
+            ArcheloncAPIException('Busy', 503),
+        ]})
+        self.assertEqual(
+            (True, None), self.importer(web_history).run(self.history)
+        )
+        self.assertEqual(6, len(web_history.calls))
+
+        web_history = FakeWebHistory({
+            self.commands[3]: [ArcheloncConnectionException()] * 6
+        })
+        with self.assertRaises(ArcheloncConnectionException):
+            self.importer(web_history).run(self.history)
+
+    def test_failed_commands(self):
+        """
+        Commands the server failed to add are sent again on their own,
+        and a chunk with any that never get added isn't acknowledged.
+        """
+        web_history = FakeWebHistory({self.commands[3]: [[0, 2]]})
+        self.assertEqual(
+            (True, None), self.importer(web_history).run(self.history)
+        )
+        self.assertIn([self.commands[3], self.commands[5]], web_history.calls)
+        self.assertIn('Imported 10 commands (10 added', self.messages[-1])
+
+        web_history = FakeWebHistory({
+            self.commands[3]: [[0, 2], [1]],
+            self.commands[5]: [[0]] * 5,
+        })
+        self.assertEqual(
+            (False, {'received': 3, 'added': 2, 'queued': 0, 'failed': [2]}),
+            self.importer(web_history, workers=1).run(self.history)
+        )
+        self.assertEqual(
+            1, ImportCheckpoint(self.checkpoint, self.history, 3).through
+        )
+
+    def test_not_retried(self):
+        """
+        Client errors aren't retried.
+        """
+        web_history = FakeWebHistory({
+            self.commands[0]: [ArcheloncAPIException('No', 401)]
+        })
+        with self.assertRaises(ArcheloncAPIException):
+            self.importer(web_history, workers=1).run(self.history)
+        self.assertEqual(1, len(web_history.calls))
+
+    def test_resume(self):
+        """
+        Running again only uploads what wasn't acknowledged.
+        """
+        web_history = FakeWebHistory({
+            self.commands[6]: [ArcheloncAPIException('No', 400)]
+        })
+        with self.assertRaises(ArcheloncAPIException):
+            self.importer(web_history, workers=1).run(self.history)
+        checkpoint = ImportCheckpoint(self.checkpoint, self.history, 3)
+        self.assertEqual(2, checkpoint.through)
+
+        web_history = FakeWebHistory()
+        self.importer(web_history).run(self.history)
+        self.assertEqual(sorted(self.commands[6:]), web_history.commands())
+        self.assertIn('Resuming import', self.messages[0])
+
+    def test_resume_changed(self):
+        """
+        A history that starts differently is imported from the start.
+        """
+        web_history = FakeWebHistory({
+            self.commands[6]: [ArcheloncAPIException('No', 400)]
+        })
+        with self.assertRaises(ArcheloncAPIException):
+            self.importer(web_history, workers=1).run(self.history)
+
+        self.commands[0] = 'changed'
+        self.write(self.commands)
+        web_history = FakeWebHistory()
+        self.importer(web_history).run(self.history)
+        self.assertEqual(sorted(self.commands), web_history.commands())
+        self.assertIn('starting over', self.messages[1])
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""
+Time what archelonc users wait on, by size of their shell history.
+
+Usage::
+
+    python benchmarks/client.py [--sizes 10000 100000] [--appended 10] \\
+        [--latency 0.0] [--json results.json] [--compare baseline.json]
+
+Each size gets a fresh home directory with a generated
+``~/.bash_history`` of that many lines, and a stub archelond server
+(``benchmarks/stub_server.py``) in this process, with ``--latency``
+seconds added to each of its responses.  The stub's own costs are
+tiny, so what is measured is the client's.  Sizes up to a few million
+lines are practical, though ``update`` before it tails the history
+gets slow well before then.
+
+Workloads:
+
+``cold_start``
+    Load ``LocalHistory``, as the search form does without a server
+``keystroke_local``
+    ``LocalHistory.search_reverse`` for each prefix of the search
+    terms, as they are typed
+``keystroke_web``
+    The same through ``WebHistory`` against the stub, loaded with
+    the history
+``update``
+    ``archelon_update`` after ``--appended`` lines were added to the
+    history since the last one
+``import``
+    ``archelon_import`` of the whole history
+``export``
+    ``archelon_export`` of everything the stub holds to a file
+
+``--json`` writes the results for comparing with ``--compare`` on
+another commit, which prints how the p50 and p99 latencies changed.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from history import SEARCH_TERMS, generate_history, percentile, write_history
+from stub_server import StubServer
+
+DEFAULT_SIZES = [10000, 100000]
+# Times to repeat the workloads that are quick enough to repeat
+REPEAT = 5
+
+
+class Sink(object):
+    """
+    Output that is thrown away, text or bytes.
+    """
+
+    def write(self, data):
+        """
+        Ignore the output.
+        """
+        pass
+
+    def flush(self):
+        """
+        Nothing to flush.
+        """
+        pass
+
+
+@contextmanager
+def command_line(*argv):
+    """
+    Run a console script's function with arguments and without its
+    output.
+    """
+    old_argv, old_stdout = sys.argv, sys.stdout
+    sys.argv = list(argv)
+    sys.stdout = Sink()
+    try:
+        yield
+    finally:
+        sys.argv, sys.stdout = old_argv, old_stdout
+
+
+def timed(latencies, function, *args):
+    """
+    Call a function, adding its latency to ``latencies``.
+    """
+    start = time.time()
+    result = function(*args)
+    latencies.append(time.time() - start)
+    return result
+
+
+def cold_start(environment):
+    """
+    Load the local history from scratch.
+    """
+    from archelonc.data import LocalHistory
+    latencies = []
+    for _ in range(REPEAT):
+        timed(latencies, LocalHistory)
+    return latencies, environment['size'] * REPEAT
+
+
+def keystrokes(history):
+    """
+    Search for every prefix of each search term, in order.
+    """
+    latencies = []
+    for term in SEARCH_TERMS:
+        for end in range(1, len(term) + 1):
+            timed(latencies, history.search_reverse, term[:end])
+    return latencies
+
+
+def keystroke_local(environment):
+    """
+    Search the local history as the user types.
+    """
+    # pylint: disable=unused-argument
+    from archelonc.data import LocalHistory
+    latencies = keystrokes(LocalHistory())
+    return latencies, None
+
+
+def keystroke_web(environment):
+    """
+    Search the server as the user types.
+    """
+    from archelonc.data import WebHistory
+    stub = environment['stub']
+    stub.reset()
+    stub.add(generate_history(environment['size']))
+    latencies = keystrokes(WebHistory(stub.url, 'benchmark'))
+    return latencies, None
+
+
+def update(environment):
+    """
+    Upload what was added to the history since the last update.
+    """
+    from archelonc import command
+    histfile = environment['histfile']
+    with command_line('archelon_update'):
+        command.update()
+    latencies = []
+    for number in range(REPEAT):
+        write_history(
+            histfile, environment['appended'], seed=number + 1, mode='a'
+        )
+        with command_line('archelon_update'):
+            timed(latencies, command.update)
+    return latencies, environment['appended'] * REPEAT
+
+
+def import_history(environment):
+    """
+    Import the whole history.
+    """
+    from archelonc import command
+    environment['stub'].reset()
+    latencies = []
+    with command_line('archelon_import', environment['histfile']):
+        timed(latencies, command.import_history)
+    return latencies, environment['size']
+
+
+def export_history(environment):
+    """
+    Export everything on the server to a file.
+    """
+    from archelonc import command
+    stub = environment['stub']
+    stub.reset()
+    stub.add(generate_history(environment['size']))
+    output = os.path.join(environment['home'], 'export')
+    latencies = []
+    for _ in range(REPEAT):
+        with command_line('archelon_export', output):
+            timed(latencies, command.export_history)
+    return latencies, len(stub.commands) * REPEAT
+
+
+WORKLOADS = [
+    ('cold_start', cold_start),
+    ('keystroke_local', keystroke_local),
+    ('keystroke_web', keystroke_web),
+    ('update', update),
+    ('import', import_history),
+    ('export', export_history),
+]
+
+
+def result(size, workload, latencies, lines):
+    """
+    Summary of one workload's latencies, and the lines of history it
+    got through a second if it works through the history.
+    """
+    seconds = sum(latencies)
+    return {
+        'size': size,
+        'workload': workload,
+        'calls': len(latencies),
+        'seconds': seconds,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'lines_per_second': lines / seconds if lines and seconds else None,
+    }
+
+
+def report(row):
+    """
+    Print a result as a table row.
+    """
+    print(
+        '{size:>8} {workload:<16} {calls:>4} calls  p50 {p50_ms:10.2f}ms  '
+        'p99 {p99_ms:10.2f}ms  {lines}'.format(
+            lines='{0:12.0f} lines/s'.format(row['lines_per_second'])
+            if row['lines_per_second'] else '',
+            **row
+        )
+    )
+    sys.stdout.flush()
+
+
+def run(sizes, appended, latency):
+    """
+    Run every workload at every size, in a fresh home directory for
+    each size.
+    """
+    results = []
+    stub = StubServer(('127.0.0.1', 0), latency=latency).start()
+    old_environ = dict(os.environ)
+    try:
+        for size in sizes:
+            home = tempfile.mkdtemp()
+            histfile = os.path.join(home, '.bash_history')
+            write_history(histfile, size)
+            os.environ.update({
+                'HOME': home,
+                'HISTFILE': histfile,
+                'ARCHELON_URL': stub.url,
+                'ARCHELON_TOKEN': 'benchmark',
+            })
+            # Paths under the home directory are worked out on import
+            for module in list(sys.modules):
+                if module.startswith('archelonc'):
+                    del sys.modules[module]
+            environment = {
+                'size': size,
+                'home': home,
+                'histfile': histfile,
+                'appended': appended,
+                'stub': stub,
+            }
+            try:
+                for workload, function in WORKLOADS:
+                    latencies, lines = function(environment)
+                    results.append(result(size, workload, latencies, lines))
+                    report(results[-1])
+            finally:
+                shutil.rmtree(home)
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environ)
+        stub.stop()
+    return results
+
+
+def commit():
+    """
+    The git commit being benchmarked, if we can tell.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    """
+    Print how latencies changed against a baseline run.
+    """
+    before = dict(
+        ((row['size'], row['workload']), row) for row in baseline['results']
+    )
+    print('\nChange from {0}:'.format(baseline.get('commit') or 'baseline'))
+    for row in results:
+        old = before.get((row['size'], row['workload']))
+        if not old:
+            continue
+        print(
+            '{size:>8} {workload:<16} p50 {p50:+8.1%}  p99 {p99:+8.1%}'.format(
+                size=row['size'],
+                workload=row['workload'],
+                p50=row['p50_ms'] / old['p50_ms'] - 1 if old['p50_ms'] else 0,
+                p99=row['p99_ms'] / old['p99_ms'] - 1 if old['p99_ms'] else 0,
+            )
+        )
+
+
+def main():
+    """
+    Parse arguments, run the benchmark and save or compare results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--appended', type=int, default=10,
+                        help='Lines added to the history between updates')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the stub server waits on each request')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Write results to this file')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare with results written by --json')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.appended, args.latency)
+    output = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(output, json_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as json_file:
+            compare(json.load(json_file), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Synthetic shell history shared by the archelonc benchmarks
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import bisect
+import codecs
+import random
+
+from six.moves import range  # pylint: disable=import-error,redefined-builtin
+
+# Programs in order of how often they're run, with their subcommands
+PROGRAMS = [
+    ('ls', ['', '-la', '-lh', '-R', '-1']),
+    ('cd', ['..', '~', '/var/log', '/etc/nginx', '-', 'src']),
+    ('git', ['status', 'diff', 'log --oneline', 'commit -am', 'push origin',
+             'checkout -b', 'rebase -i HEAD~3', 'pull --rebase']),
+    ('vim', ['README.rst', 'setup.py', 'tox.ini', '/etc/hosts']),
+    ('grep', ['-rn TODO .', '-i error /var/log/syslog', '-v grep']),
+    ('docker', ['ps -a', 'images', 'run --rm -it', 'logs -f', 'exec -it',
+                'compose up -d', 'build -t']),
+    ('ssh', ['prod-web-01', 'prod-db-02', 'bastion', 'build-agent-7']),
+    ('python', ['-m pytest -q', 'setup.py develop', 'manage.py runserver',
+                '-c "import sys; print(sys.path)"']),
+    ('kubectl', ['get pods', 'describe pod', 'logs -f', 'apply -f',
+                 'rollout status deployment']),
+    ('pip', ['install -e .', 'install -r requirements.txt', 'freeze',
+             'uninstall -y', 'list --outdated']),
+    ('make', ['test', 'install', 'clean', 'docs', 'release']),
+    ('tail', ['-f /var/log/syslog', '-n 100 app.log']),
+    ('curl', ['-s http://localhost:8580/', '-I https://example.com',
+              '-X POST -d @body.json']),
+    ('find', ['. -name "*.pyc" -delete', '/var/log -mtime +7',
+              '. -type d -empty']),
+    ('sudo', ['apt-get update', 'systemctl restart nginx',
+              'journalctl -u archelond']),
+]
+
+WORDS = [
+    'archelon', 'turtle', 'history', 'server', 'client', 'index',
+    'elastic', 'search', 'config', 'backup', 'deploy', 'staging',
+    'feature', 'bugfix', 'release', 'worker', 'queue', 'cache',
+]
+
+SEARCH_TERMS = [
+    'git st', 'docker', 'install', 'ssh prod', 'kubectl get', 'nginx',
+    'turtle', 'nomatchatall',
+]
+
+# Chance a line repeats one of the recent ones instead of being new
+REPEAT_RATE = 0.6
+# How many of the most recent lines repeats are picked from
+RECENT = 200
+
+
+def generate_history(count, seed=0):
+    """Build deterministic, realistic looking shell history lines.
+
+    Programs are picked with Zipf weights, so ``ls``, ``cd`` and
+    ``git`` dominate the way they do in real history, and most lines
+    repeat one of the recent ones the way a bash history without
+    ``ignoredups`` does.
+
+    Args:
+        count (int): Number of lines to generate
+        seed (int): Random seed so runs are comparable
+
+    Returns:
+        generator: ``count`` command strings
+    """
+    rand = random.Random(seed)
+    cumulative, total = [], 0.0
+    for rank in range(1, len(PROGRAMS) + 1):
+        total += 1.0 / rank
+        cumulative.append(total)
+    recent = []
+    for number in range(count):
+        if recent and rand.random() < REPEAT_RATE:
+            yield rand.choice(recent)
+            continue
+        program, subcommands = PROGRAMS[bisect.bisect(
+            cumulative, rand.random() * cumulative[-1]
+        )]
+        command = ' '.join(part for part in (
+            program,
+            rand.choice(subcommands),
+            '{0}-{1}'.format(rand.choice(WORDS), number)
+            if rand.random() < 0.5 else '',
+        ) if part)
+        recent.append(command)
+        if len(recent) > RECENT:
+            recent.pop(0)
+        yield command
+
+
+def write_history(path, count, seed=0, mode='w'):
+    """Write generated history lines to a file.
+
+    Args:
+        path (str): History file to write
+        count (int): Number of lines to write
+        seed (int): Random seed so runs are comparable
+        mode (str): ``w`` to replace the file or ``a`` to append
+    """
+    with codecs.open(path, mode, encoding='UTF-8') as history_file:
+        for command in generate_history(count, seed):
+            history_file.write(command + '\n')
+
+
+def percentile(latencies, fraction):
+    """Nearest rank percentile of a list of latencies.
+
+    Args:
+        latencies (list): Measured latencies
+        fraction (float): Percentile wanted between 0 and 1
+
+    Returns:
+        float: The latency at that percentile
+    """
+    ordered = sorted(latencies)
+    if not ordered:
+        return 0.0
+    rank = int(round(fraction * (len(ordered) - 1)))
+    return ordered[rank]
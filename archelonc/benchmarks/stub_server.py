@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+Stand in for archelond, keeping commands in memory, so the client can
+be benchmarked without the server's own costs.
+
+Usage::
+
+    python benchmarks/stub_server.py [--port 8580] [--latency 0.005]
+
+Any token is accepted.  Served are searching and paging through
+``/api/v1/history``, adding one or many commands to it (answering
+bulk adds with the ``summary`` response), gzipped newline delimited
+JSON to ``/api/v1/history/import`` and streaming it back from
+``/api/v1/history/export``.  Every request waits ``--latency``
+seconds first.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+from collections import OrderedDict
+import json
+import threading
+import time
+import zlib
+
+# pylint: disable=import-error
+from six.moves import socketserver
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.urllib.parse import parse_qs, urlparse
+
+DEFAULT_PORT = 8580
+PAGE_SIZE = 50
+HISTORY_URL = '/api/v1/history'
+
+
+class StubServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    HTTP server holding the commands it was sent.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0.0):
+        """
+        Listen on ``address`` without any commands.
+        """
+        HTTPServer.__init__(self, address, StubHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.commands = OrderedDict()
+        self.requests = 0
+
+    @property
+    def url(self):
+        """
+        URL to set ``ARCHELON_URL`` to.
+        """
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+    def add(self, commands):
+        """
+        Keep commands, returning how many were new.
+        """
+        added = 0
+        with self.lock:
+            for command in commands:
+                if command not in self.commands:
+                    added += 1
+                self.commands[command] = None
+        return added
+
+    def reset(self):
+        """
+        Forget every command and request.
+        """
+        with self.lock:
+            self.commands = OrderedDict()
+            self.requests = 0
+
+    def start(self):
+        """
+        Serve from a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answer the client's API calls from the server's commands.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """
+        Don't log every request.
+        """
+        pass
+
+    def _body(self):
+        """
+        Request body, put back together if it was sent in chunks.
+        """
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body.decode('UTF-8')
+
+    def _respond(self, status, body, content_type='application/json'):
+        """
+        Send a response, JSON encoding it unless it is already text.
+        """
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start(self):
+        """
+        Count and delay the request, then split up its URL.
+        """
+        with self.server.lock:
+            self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        params = dict(
+            (key, values[-1]) for key, values in parse_qs(url.query).items()
+        )
+        return url.path.rstrip('/'), params
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Search, page or export the commands.
+        """
+        path, params = self._start()
+        with self.server.lock:
+            commands = list(self.server.commands)
+        if path == HISTORY_URL + '/export':
+            self._respond(200, b''.join(
+                json.dumps({'command': command}).encode('UTF-8') + b'\n'
+                for command in commands
+            ), 'application/x-ndjson')
+            return
+        if path != HISTORY_URL:
+            self._respond(404, {'error': 'Not found'})
+            return
+        term = params.get('q')
+        if term:
+            commands = [command for command in commands if term in command]
+        if params.get('o') != 'r':
+            commands.reverse()
+        start = int(params.get('p', 0)) * PAGE_SIZE
+        self._respond(200, {'commands': [
+            {'id': command, 'command': command}
+            for command in commands[start:start + PAGE_SIZE]
+        ]})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Add a command, a list of commands or an import.
+        """
+        path, _ = self._start()
+        body = self._body()
+        if path == HISTORY_URL + '/import':
+            commands = [
+                json.loads(line) for line in body.split('\n') if line
+            ]
+            added = self.server.add(commands)
+            self._respond(200, {
+                'received': len(commands), 'added': added,
+                'invalid': [], 'failed': [],
+            })
+            return
+        if path != HISTORY_URL:
+            self._respond(404, {'error': 'Not found'})
+            return
+        data = json.loads(body)
+        if 'commands' in data:
+            self.server.add(data['commands'])
+            self._respond(200, {
+                'received': len(data['commands']),
+                'added': len(data['commands']),
+                'failed': [],
+            })
+            return
+        self.server.add([data['command']])
+        self._respond(201, {'id': data['command']})
+
+
+def main():
+    """
+    Parse arguments and serve until interrupted.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds every request waits')
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port), latency=args.latency)
+    print('Serving archelond stub on {0}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+"""
+asyncio versions of the data stores and API, served over ASGI.
+
+Everything in this package needs Python 3.5 or newer, so nothing
+outside of it imports it.
+"""
+from __future__ import absolute_import, unicode_literals
+from archelond.aio.data import (
+    AsyncHistoryData, AsyncMemoryData, AsyncElasticData
+)
+
+__all__ = ['AsyncHistoryData', 'AsyncMemoryData', 'AsyncElasticData']
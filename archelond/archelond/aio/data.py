@@ -0,0 +1,545 @@
+"""
+Data stores with coroutine methods, for the ASGI application.
+"""
+from __future__ import absolute_import, unicode_literals
+from abc import ABCMeta, abstractmethod
+import json
+import logging
+
+from elasticsearch.exceptions import (
+    HTTP_EXCEPTIONS,
+    ConflictError,
+    ConnectionError as ESConnectionError,
+    NotFoundError,
+    RequestError,
+    TransportError,
+)
+from elasticsearch.serializer import JSONSerializer
+from six import with_metaclass
+
+from archelond.data import ElasticData, MemoryData
+from archelond.data.elastic import script_refused
+from archelond.data.cursor import ResultPage
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None  # pylint: disable=invalid-name
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class AsyncHistoryData(with_metaclass(ABCMeta, object)):
+    """Abstract asyncio data storage for command history.
+
+    The same contract as :py:class:`archelond.data.abstract.HistoryData`,
+    except every operation is a coroutine, so that one process can
+    have many requests waiting on the data store at once.
+    """
+    # Only return a max of 50 results
+    NUM_RESULTS = 50
+
+    @abstractmethod
+    def __init__(self, config):
+        """Setup and configuration of data storage.
+
+        Args:
+            config (dict): The flask application configuration
+                dictionary.
+        """
+        self.config = config
+
+    async def bootstrap(self):
+        """
+        Create anything the data store needs before it can be used.
+        """
+        pass
+
+    async def close(self):
+        """
+        Release connections when the application shuts down.
+        """
+        pass
+
+    @abstractmethod
+    async def add(self, command, username, host, **kwargs):
+        """Add or update a command.
+
+        Returns:
+            Command ID (str): The id of the command stored
+        """
+        pass
+
+    @abstractmethod
+    async def bulk_add(self, commands, username, host, **kwargs):
+        """Add or update many commands at once.
+
+        Returns:
+            list: Command IDs in the order of ``commands``, with
+                ``None`` for any that couldn't be stored.
+        """
+        pass
+
+    @abstractmethod
+    async def update_meta(self, command_id, username, host, **kwargs):
+        """Replace a command's metadata without counting a use.
+
+        Raises:
+            KeyError: If the command doesn't exist.
+        """
+        pass
+
+    @abstractmethod
+    async def delete(self, command_id, username, host, **kwargs):
+        """Delete a command.
+
+        Raises:
+            KeyError: If the command doesn't exist.
+        """
+        pass
+
+    @abstractmethod
+    async def get(self, command_id, username, host, **kwargs):
+        """Get a single command.
+
+        Raises:
+            KeyError: If the command doesn't exist.
+        Returns:
+            dict: Command dictionary
+        """
+        pass
+
+    @abstractmethod
+    async def all(self, order, username, host, page=0, **kwargs):
+        """Get a page of all commands.
+
+        Returns:
+            ResultPage: Command dictionaries and the next page's cursor
+        """
+        pass
+
+    @abstractmethod
+    async def filter(self, term, order, username, host, page=0, **kwargs):
+        """Get a page of commands containing ``term``.
+
+        Raises:
+            ValueError: If ``cursor`` is not valid.
+        Returns:
+            ResultPage: Command dictionaries and the next page's cursor
+        """
+        pass
+
+
+class AsyncMemoryData(AsyncHistoryData):
+    """
+    :py:class:`archelond.data.MemoryData` behind coroutines.  Nothing
+    it does waits on the network, so it is called directly.
+    """
+
+    def __init__(self, config):
+        """
+        Build the in memory store.
+        """
+        super(AsyncMemoryData, self).__init__(config)
+        self.data = MemoryData(config)
+
+    async def add(self, command, username, host, **kwargs):
+        """
+        Add the command.
+        """
+        return self.data.add(command, username, host, **kwargs)
+
+    async def bulk_add(self, commands, username, host, **kwargs):
+        """
+        Add the commands.
+        """
+        return self.data.bulk_add(commands, username, host, **kwargs)
+
+    async def update_meta(self, command_id, username, host, **kwargs):
+        """
+        Replace the command's metadata.
+        """
+        return self.data.update_meta(command_id, username, host, **kwargs)
+
+    async def delete(self, command_id, username, host, **kwargs):
+        """
+        Delete the command.
+        """
+        return self.data.delete(command_id, username, host, **kwargs)
+
+    async def get(self, command_id, username, host, **kwargs):
+        """
+        Get the command.
+        """
+        return self.data.get(command_id, username, host, **kwargs)
+
+    async def all(self, order, username, host, page=0, **kwargs):
+        """
+        Get a page of all commands.
+        """
+        return self.data.all(order, username, host, page=page, **kwargs)
+
+    async def filter(self, term, order, username, host, page=0, **kwargs):
+        """
+        Get a page of matching commands.
+        """
+        # pylint: disable=too-many-arguments
+        return self.data.filter(
+            term, order, username, host, page=page, **kwargs
+        )
+
+
+class AsyncElasticData(AsyncHistoryData):
+    """Elasticsearch over ``aiohttp``.
+
+    Indexes, queries, sorting and cursors are built by a
+    :py:class:`archelond.data.ElasticData`, which never sends anything
+    itself, so both store and find commands the same way.  Errors are
+    raised as the ``elasticsearch`` client's exceptions.
+
+    Needs ``aiohttp`` installed.
+    """
+
+    def __init__(self, config):
+        """
+        Configure the index, without connecting yet.
+        """
+        super(AsyncElasticData, self).__init__(config)
+        if aiohttp is None:
+            raise ImportError('AsyncElasticData requires aiohttp')
+        self.sync = ElasticData(config)
+        self.index = self.sync.index
+        url = str(self.config['ELASTICSEARCH_URL']).rstrip('/')
+        if '://' not in url:
+            url = 'http://{0}'.format(url)
+        self.url = url
+        self.serializer = JSONSerializer()
+        self.session = None
+
+    async def _request(self, method, path, body=None, params=None,
+                       content_type='application/json'):
+        """Send a request to Elasticsearch.
+
+        Raises:
+            elasticsearch.exceptions.TransportError: For any error
+                status, or ``ConnectionError`` if we can't connect.
+
+        Returns:
+            dict: The decoded response
+        """
+        # pylint: disable=too-many-arguments
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        if body is not None and not isinstance(body, str):
+            body = self.serializer.dumps(body)
+        try:
+            async with self.session.request(
+                    method, '{0}{1}'.format(self.url, path),
+                    data=body, params=params,
+                    headers={'Content-Type': content_type}
+            ) as response:
+                text = await response.text()
+                status = response.status
+        except aiohttp.ClientError as ex:
+            raise ESConnectionError('N/A', str(ex), ex)
+        try:
+            data = json.loads(text) if text else {}
+        except ValueError:
+            data = {'error': text}
+        if status >= 300:
+            raise HTTP_EXCEPTIONS.get(status, TransportError)(
+                status, text, data
+            )
+        return data
+
+    def _path(self, username, *parts):
+        """
+        Path to something in the user's document type.
+        """
+        # pylint: disable=protected-access
+        return '/'.join(
+            ('', self.index, self.sync._doc_type(username)) + parts
+        )
+
+    async def close(self):
+        """
+        Close the HTTP connection pool.
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def bootstrap(self):
+        """
+        Create the index if it doesn't exist yet.
+        """
+        # pylint: disable=protected-access
+        try:
+            await self._request(
+                'PUT', '/{0}'.format(self.index), self.sync._index_body()
+            )
+        except RequestError:
+            pass  # Already exists
+        self.sync._search_after[self.sync._index_key()] = (
+            self.sync.has_search_after(await self._request('GET', '/'))
+        )
+        self.sync._check_ngram(await self._request(
+            'GET', '/{0}/_mapping/field/command.ngram'.format(self.index)
+        ))
+        self.sync._verified.add(self.sync._index_key())
+
+    async def _ensure_index(self):
+        """
+        Bootstrap on first use in this process.
+        """
+        # pylint: disable=protected-access
+        if self.sync._index_key() not in self.sync._verified:
+            await self.bootstrap()
+
+    async def add(self, command, username, host, **kwargs):
+        """
+        Index the command by the hash of it.
+        """
+        # pylint: disable=protected-access
+        await self._ensure_index()
+        doc_id = self.sync._doc_id(command)
+        if self.sync.scripted:
+            try:
+                await self._request(
+                    'POST', self._path(username, doc_id, '_update'),
+                    self.sync._use(command, username, host, **kwargs),
+                    {'retry_on_conflict': self.sync.RETRY_ON_CONFLICT}
+                )
+                return doc_id
+            except TransportError as ex:
+                if not script_refused(ex):
+                    raise
+                self.sync._refuse_scripts(ex)
+        cmd_ids = await self._index_uses([command], username, host, **kwargs)
+        if cmd_ids[0] is None:
+            raise TransportError(500, 'Failed to index command')
+        return doc_id
+
+    async def _bulk(self, lines):
+        """
+        Send the lines of a ``_bulk`` request, returning its items.
+        """
+        results = await self._request(
+            'POST', '/_bulk', '\n'.join(lines) + '\n',
+            content_type='application/x-ndjson'
+        )
+        return results['items']
+
+    async def _index_uses(self, commands, username, host, **kwargs):
+        """
+        Count uses without scripts, the way ``ElasticData`` does when
+        the cluster refuses them.
+        """
+        # pylint: disable=protected-access,too-many-locals
+        doc_type = self.sync._doc_type(username)
+        chunk_size = self.sync.BULK_CHUNK_SIZE
+        indexed = set()
+        for start in range(0, len(commands), chunk_size):
+            chunk = commands[start:start + chunk_size]
+            found = await self._request(
+                'POST', self._path(username, '_mget'),
+                {'ids': list(set(self.sync._doc_id(x) for x in chunk))}
+            )
+            documents = self.sync._counted(
+                chunk,
+                dict(
+                    (doc['_id'], doc['_source'])
+                    for doc in found['docs'] if doc.get('found')
+                ),
+                username, host, **kwargs
+            )
+            lines = []
+            for doc_id, document in documents.items():
+                lines.append(self.serializer.dumps({'index': {
+                    '_index': self.index, '_type': doc_type, '_id': doc_id,
+                }}))
+                lines.append(self.serializer.dumps(document))
+            try:
+                items = await self._bulk(lines)
+            except TransportError as ex:
+                log.exception(ex)
+                continue
+            for item in items:
+                result = item['index']
+                if result.get('status', 500) < 300:
+                    indexed.add(result['_id'])
+                else:
+                    log.error('Failed to index command: %s', result)
+        return [
+            doc_id if doc_id in indexed else None
+            for doc_id in (self.sync._doc_id(x) for x in commands)
+        ]
+
+    async def bulk_add(self, commands, username, host, **kwargs):
+        """
+        Update the commands with ``_bulk`` requests, a chunk at a time,
+        counting uses without scripts once the cluster refuses them.
+        """
+        # pylint: disable=protected-access,too-many-locals
+        await self._ensure_index()
+        if not self.sync.scripted:
+            return await self._index_uses(commands, username, host, **kwargs)
+        doc_type = self.sync._doc_type(username)
+        chunk_size = self.sync.BULK_CHUNK_SIZE
+        cmd_ids = []
+        refused = []
+        for start in range(0, len(commands), chunk_size):
+            chunk = commands[start:start + chunk_size]
+            lines = []
+            for command in chunk:
+                lines.append(self.serializer.dumps({'update': {
+                    '_index': self.index,
+                    '_type': doc_type,
+                    '_id': self.sync._doc_id(command),
+                    '_retry_on_conflict': self.sync.RETRY_ON_CONFLICT,
+                }}))
+                lines.append(self.serializer.dumps(
+                    self.sync._use(command, username, host, **kwargs)
+                ))
+            try:
+                items = await self._bulk(lines)
+            except TransportError as ex:
+                log.exception(ex)
+                cmd_ids.extend([None] * len(chunk))
+                continue
+            for item in items:
+                result = item['update']
+                if result.get('status', 500) < 300:
+                    cmd_ids.append(result['_id'])
+                elif script_refused(result.get('error')):
+                    refused.append((len(cmd_ids), result['error']))
+                    cmd_ids.append(None)
+                else:
+                    log.error('Failed to index command: %s', result)
+                    cmd_ids.append(None)
+        if refused:
+            self.sync._refuse_scripts(refused[0][1])
+            retried = await self._index_uses(
+                [commands[x] for x, _ in refused], username, host, **kwargs
+            )
+            for (position, _), cmd_id in zip(refused, retried):
+                cmd_ids[position] = cmd_id
+        return cmd_ids
+
+    async def update_meta(self, command_id, username, host, **kwargs):
+        """
+        Replace the command's meta at the version it was read at, the
+        way ``ElasticData.update_meta`` does.
+        """
+        await self._ensure_index()
+        path = self._path(username, command_id)
+        for attempt in range(self.sync.RETRY_ON_CONFLICT + 1):
+            try:
+                hit = await self._request('GET', path)
+            except NotFoundError:
+                raise KeyError(command_id)
+            document = hit['_source']
+            document['meta'] = kwargs
+            try:
+                await self._request(
+                    'PUT', path, document, {'version': hit['_version']}
+                )
+                return
+            except ConflictError:
+                if attempt == self.sync.RETRY_ON_CONFLICT:
+                    raise
+
+    async def delete(self, command_id, username, host, **kwargs):
+        """
+        Remove the command.
+        """
+        await self._ensure_index()
+        try:
+            await self._request('DELETE', self._path(username, command_id))
+        except NotFoundError:
+            raise KeyError
+
+    async def get(self, command_id, username, host, **kwargs):
+        """
+        Get one command.
+        """
+        await self._ensure_index()
+        try:
+            hit = await self._request('GET', self._path(username, command_id))
+        except NotFoundError:
+            raise KeyError
+        result = hit['_source']
+        result['id'] = hit['_id']
+        return result
+
+    async def all(self, order, username, host, page=0, **kwargs):
+        """
+        Filter with a match all query.
+        """
+        return await self.filter(
+            None, order, username, host, page=page,
+            body={'query': {'match_all': {}}}, **kwargs
+        )
+
+    async def filter(self, term, order, username, host, page=0, body=None,
+                     cursor=None, **kwargs):
+        """
+        Get a page of commands the way ``ElasticData.filter`` does.
+        """
+        # pylint: disable=too-many-arguments,protected-access
+        if not body:
+            body = {'query': self.sync._query(term)}
+        body['sort'] = self.sync._sort(order)
+        position = self.sync._position(cursor)
+        offset = self.sync._offset(page, position)
+        try:
+            await self._ensure_index()
+            if position and position[0] == 'scroll':
+                results = await self._scroll(position[1])
+            else:
+                params = {'size': self.sync.NUM_RESULTS}
+                for key, value in self.sync._search_kwargs(
+                        body, page, position
+                ).items():
+                    params[key.rstrip('_')] = value
+                results = await self._request(
+                    'POST', self._path(username, '_search'), body, params
+                )
+                if 'scroll' in params:
+                    # Scroll on from the first page to the cursor's
+                    if self.sync._spent_scroll(results):
+                        results['hits']['hits'] = []
+                    else:
+                        results = await self._scroll(results['_scroll_id'])
+            scroll_id = self.sync._spent_scroll(results)
+            if scroll_id:
+                try:
+                    await self._request(
+                        'DELETE', '/_search/scroll', scroll_id,
+                        content_type='text/plain'
+                    )
+                except NotFoundError:
+                    pass
+        except RequestError as ex:
+            log.exception(ex)
+            if cursor:
+                raise ValueError('Invalid cursor')
+            return ResultPage()
+        except ESConnectionError as ex:
+            log.exception(ex)
+            return ResultPage()
+        return self.sync._result_page(results, offset)
+
+    async def _scroll(self, scroll_id):
+        """
+        Get the next page of a scroll context, raising ``ValueError``
+        if it has expired.  The id is sent as the whole body, like the
+        Elasticsearch client does, since 1.x doesn't take JSON here.
+        """
+        try:
+            return await self._request(
+                'POST', '/_search/scroll', scroll_id,
+                params={'scroll': self.sync.scroll}, content_type='text/plain'
+            )
+        except NotFoundError:
+            raise ValueError('Expired cursor')
@@ -0,0 +1,534 @@
+"""
+ASGI version of the API in :py:mod:`archelond.web`, with the same
+routes and payloads, for serving from one process with an asyncio
+server such as uvicorn::
+
+    uvicorn archelond.aio.web:app
+
+Only the history and token API is served.  The web page, history
+export, stats, spool and metrics stay with the Flask application.
+"""
+from __future__ import absolute_import, unicode_literals
+import asyncio  # pylint: disable=import-error
+import base64
+import binascii
+from io import BytesIO
+import logging
+import os
+
+from flask import Flask, json
+from six import string_types
+from six.moves.urllib.parse import parse_qs
+
+from archelond.aio.data import AsyncElasticData, AsyncMemoryData
+from archelond.auth import CachedHtPasswdAuth
+from archelond.data import ORDER_TYPES
+from archelond.log import configure_logging
+from archelond.util import import_command, ndjson_lines
+
+log = logging.getLogger('archelond')  # pylint: disable=invalid-name
+
+V1_ROOT = '/api/v1/'
+
+# Ways a bulk POST can report what happened to each command
+BULK_RESPONSES = ('full', 'summary', 'ids')
+
+# Routes only the Flask application serves
+FLASK_ONLY = (
+    '{}history/export'.format(V1_ROOT),
+    '{}stats'.format(V1_ROOT),
+    '{}spool'.format(V1_ROOT),
+    '/metrics',
+)
+
+DATA_TYPES = {
+    'MemoryData': AsyncMemoryData,
+    'ElasticData': AsyncElasticData,
+}
+
+
+class Request(object):
+    """
+    The parts of an HTTP request the views need.
+    """
+
+    def __init__(self, scope, body):
+        """
+        Pull the request apart from its ASGI scope and body.
+        """
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {
+            key: values[0] for key, values in parse_qs(
+                scope.get('query_string', b'').decode('latin-1')
+            ).items()
+        }
+        self.headers = {
+            key.decode('latin-1').lower(): value.decode('latin-1')
+            for key, value in scope.get('headers', [])
+        }
+        self.remote_addr = (scope.get('client') or [None])[0]
+        self.body = body
+
+    @property
+    def json(self):
+        """
+        The JSON body, if the request has one.
+        """
+        if not self.headers.get('content-type', '').startswith(
+                'application/json'
+        ):
+            return None
+        try:
+            return json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            return None
+
+    @property
+    def form(self):
+        """
+        The url encoded form body.
+        """
+        return {
+            key: values[0] for key, values in parse_qs(
+                self.body.decode('utf-8')
+            ).items()
+        }
+
+
+class Response(object):
+    """
+    What to send back for a request.
+    """
+
+    def __init__(self, body=b'', status=200, headers=None):
+        """
+        Build a response, encoding text bodies.
+        """
+        if isinstance(body, string_types):
+            body = body.encode('utf-8')
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+
+
+def jsonify_code(src_object, status_code=200):
+    """Serialize to JSON the way the Flask application does.
+
+    Args:
+        src_object (serializable object): data structure to jsonify
+        status_code (int): Status code to send
+
+    Returns:
+        Response: JSON response
+    """
+    return Response(
+        json.dumps(src_object) + '\n', status_code,
+        {'content-type': 'application/json'}
+    )
+
+
+class ArchelondASGI(object):
+    """
+    ASGI application serving the archelond API from an
+    :py:class:`archelond.aio.AsyncHistoryData` data store.
+    """
+    # pylint: disable=too-many-return-statements,too-many-branches
+
+    def __init__(self, flask_app, data):
+        """Serve the API.
+
+        Args:
+            flask_app (flask.Flask): Application holding the
+                configuration and users.
+            data (AsyncHistoryData): Data store to serve
+        """
+        self.flask_app = flask_app
+        self.config = flask_app.config
+        self.data = data
+        self.htpasswd = CachedHtPasswdAuth(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        """
+        ASGI entry point.
+        """
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':  # pragma: no cover
+            return
+
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        request = Request(scope, b''.join(chunks))
+
+        try:
+            response = await self.dispatch(request)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Failed handling %s %s', request.method,
+                          request.path)
+            response = jsonify_code({'error': 'Internal server error'}, 500)
+
+        response.headers['content-length'] = str(len(response.body))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status,
+            'headers': [
+                (key.encode('latin-1'), value.encode('latin-1'))
+                for key, value in response.headers.items()
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': response.body})
+
+    async def _lifespan(self, receive, send):
+        """
+        Close the data store's connections on shutdown.
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.data.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def authenticate(self, request):
+        """Check basic or token authentication like ``HtPasswdAuth``.
+
+        Passwords are checked in a thread, since an MD5-crypt check
+        that isn't cached yet would hold up every other request.
+
+        Returns:
+            str: The user, or ``None`` if they aren't authenticated
+        """
+        header = request.headers.get('authorization', '')
+        if header[:6].lower() == 'basic ':
+            try:
+                username, password = base64.b64decode(
+                    header[6:].encode('ascii')
+                ).decode('utf-8').split(':', 1)
+            except (ValueError, TypeError, binascii.Error):
+                return None
+            is_valid, user = await asyncio.get_event_loop().run_in_executor(
+                None, self.htpasswd.check_basic_auth, username, password
+            )
+        elif header or request.args.get('access_token'):
+            # slice the 'token ' piece of the header (following
+            # github style):
+            token = header[6:] if header else request.args['access_token']
+            is_valid, user = self.htpasswd.check_token_auth(token)
+        else:
+            return None
+        return user if is_valid else None
+
+    def auth_failed(self):
+        """
+        Ask for basic auth.
+        """
+        return Response(
+            'Could not verify your access level for that URL.\n'
+            'You have to login with proper credentials',
+            401,
+            {'www-authenticate': 'Basic realm="{0}"'.format(
+                self.config.get('FLASK_AUTH_REALM', 'Login Required')
+            )}
+        )
+
+    async def dispatch(self, request):
+        """
+        Authenticate and route the request to a view.
+        """
+        user = await self.authenticate(request)
+        if user is None:
+            return self.auth_failed()
+
+        if request.path in FLASK_ONLY:
+            return jsonify_code(
+                {'error': 'Only served by the Flask application'}, 501
+            )
+
+        if request.path == '{}token'.format(V1_ROOT):
+            if request.method != 'GET':
+                return jsonify_code({'error': 'Method not allowed'}, 405)
+            token = self.htpasswd.generate_token(user)
+            if isinstance(token, bytes):
+                token = token.decode('ascii')
+            return jsonify_code({'token': token})
+
+        history_root = '{}history'.format(V1_ROOT)
+        if request.path == history_root:
+            if request.method == 'GET':
+                return await self.history_get(request, user)
+            if request.method == 'POST':
+                return await self.history_post(request, user)
+            return jsonify_code({'error': 'Method not allowed'}, 405)
+
+        if request.path == history_root + '/import':
+            if request.method != 'POST':
+                return jsonify_code({'error': 'Method not allowed'}, 405)
+            return await self.history_import(request, user)
+
+        if request.path.startswith(history_root + '/'):
+            cmd_id = request.path[len(history_root) + 1:]
+            if cmd_id and '/' not in cmd_id:
+                if request.method == 'GET':
+                    return await self.history_item_get(request, user, cmd_id)
+                if request.method == 'PUT':
+                    return await self.history_item_put(request, user, cmd_id)
+                if request.method == 'DELETE':
+                    return await self.history_item_delete(
+                        request, user, cmd_id
+                    )
+                return jsonify_code({'error': 'Method not allowed'}, 405)
+
+        return jsonify_code({'error': 'Not found'}, 404)
+
+    async def history_get(self, request, user):
+        """
+        Get a page of commands, see :py:func:`archelond.web.history`.
+        """
+        query = request.args.get('q')
+        order = request.args.get('o')
+        cursor = request.args.get('cursor')
+        try:
+            page = int(request.args.get('p', 0))
+        except ValueError:
+            return jsonify_code({'error': 'Page must be a number'}, 422)
+
+        order_type = None
+        if order:
+            if order not in ORDER_TYPES:
+                return jsonify_code(
+                    {'error': 'Order specified is not an option'},
+                    422
+                )
+            order_type = order
+
+        try:
+            if query:
+                results = await self.data.filter(
+                    query, order_type, user, request.remote_addr,
+                    page=page, cursor=cursor
+                )
+            else:
+                results = await self.data.all(
+                    order_type, user, request.remote_addr,
+                    page=page, cursor=cursor
+                )
+        except ValueError:
+            return jsonify_code({'error': 'Invalid cursor'}, 422)
+        response = {'commands': results}
+        next_cursor = getattr(results, 'cursor', None)
+        if next_cursor:
+            response['cursor'] = next_cursor
+        return jsonify_code(response)
+
+    async def history_post(self, request, user):
+        """
+        Add one or many commands, see :py:func:`archelond.web.history`.
+        """
+        from_form = True
+        data = request.json
+        if data:
+            from_form = False
+        else:
+            data = request.form
+        command = data.get('command')
+        commands = data.get('commands')
+        if not (command or commands):
+            return jsonify_code({'error': 'Missing command(s) parameter'}, 422)
+
+        if commands:
+            if from_form:
+                commands = json.loads(commands)
+            if not isinstance(commands, list):
+                return jsonify_code({'error': 'Commands must be list'}, 422)
+            response_type = request.args.get('response', 'full')
+            if response_type not in BULK_RESPONSES:
+                return jsonify_code(
+                    {'error': 'Response specified is not an option'},
+                    422
+                )
+            cmd_ids = await self.data.bulk_add(
+                commands, user, request.remote_addr
+            )
+            if response_type == 'ids':
+                return jsonify_code({'ids': cmd_ids})
+            if response_type == 'summary':
+                failed = [
+                    index for index, cmd_id in enumerate(cmd_ids)
+                    if cmd_id is None
+                ]
+                return jsonify_code({
+                    'received': len(commands),
+                    'added': len(commands) - len(failed),
+                    'failed': failed,
+                })
+            results_list = []
+            for cmd_id in cmd_ids:
+                if cmd_id is None:
+                    results_list.append({
+                        'response': 'Failed to add command',
+                        'status_code': 500,
+                        'headers': {},
+                    })
+                    continue
+                results_list.append({
+                    'response': '',
+                    'status_code': 201,
+                    'headers': {'location': self._location(cmd_id)},
+                })
+            return jsonify_code({'responses': results_list})
+        if not isinstance(command, string_types):
+            return jsonify_code({'error': 'Command must be a string'}, 422)
+
+        cmd_id = await self.data.add(command, user, request.remote_addr)
+        return Response(b'', 201, {'location': self._location(cmd_id)})
+
+    async def _import_batch(self, commands, indices, summary, request, user):
+        """
+        Add a batch of imported commands, counting how it went in the
+        summary.
+        """
+        # pylint: disable=too-many-arguments
+        cmd_ids = await self.data.bulk_add(
+            commands, user, request.remote_addr
+        )
+        for index, cmd_id in zip(indices, cmd_ids):
+            if cmd_id is None:
+                summary['failed'].append(index)
+            else:
+                summary['added'] += 1
+
+    async def history_import(self, request, user):
+        """
+        Add commands from a newline delimited JSON body, see
+        :py:func:`archelond.web.history_import`.  The whole body has
+        already been read, but it is still added a batch at a time.
+        """
+        batch_size = self.config.get('IMPORT_BATCH_SIZE', 500)
+        gzipped = request.headers.get(
+            'content-encoding', ''
+        ).lower() == 'gzip'
+        summary = {'received': 0, 'added': 0, 'invalid': [], 'failed': []}
+        commands, indices = [], []
+        try:
+            for line in ndjson_lines(BytesIO(request.body), gzipped):
+                index = summary['received']
+                summary['received'] += 1
+                command = import_command(line)
+                if command is None:
+                    summary['invalid'].append(index)
+                    continue
+                commands.append(command)
+                indices.append(index)
+                if len(commands) == batch_size:
+                    await self._import_batch(
+                        commands, indices, summary, request, user
+                    )
+                    commands, indices = [], []
+        except ValueError as ex:
+            if commands:
+                await self._import_batch(
+                    commands, indices, summary, request, user
+                )
+            summary['error'] = str(ex)
+            return jsonify_code(summary, 400)
+        if commands:
+            await self._import_batch(commands, indices, summary, request, user)
+        return jsonify_code(summary)
+
+    @staticmethod
+    def _location(cmd_id):
+        """
+        URL of a history item
+        """
+        return '{0}history/{1}'.format(V1_ROOT, cmd_id)
+
+    async def history_item_get(self, request, user, cmd_id):
+        """
+        Get one command, see :py:func:`archelond.web.history_item`.
+        """
+        try:
+            cmd = await self.data.get(cmd_id, user, request.remote_addr)
+        except KeyError:
+            return jsonify_code({'error': 'No such history item'}, 404)
+        return jsonify_code(cmd)
+
+    async def history_item_put(self, request, user, cmd_id):
+        """
+        Update a command's metadata, see
+        :py:func:`archelond.web.history_item`.
+        """
+        try:
+            await self.data.get(cmd_id, user, request.remote_addr)
+        except KeyError:
+            return jsonify_code({'error': 'No such history item'}, 404)
+        from_form = True
+        data = request.json
+        if data:
+            from_form = False
+        else:
+            data = request.form
+        if not data:
+            return jsonify_code(
+                {'error': 'Data is required, received empty PUT'},
+                422
+            )
+        put_command = data.get('payload')
+        if not put_command:
+            return jsonify_code(
+                {'error': 'Request must contain ``payload`` parameter'},
+                422
+            )
+        if from_form:
+            put_command = json.loads(put_command)
+
+        # Make sure we don't let them overwrite server side params
+        for key in ('command', 'username', 'host'):
+            put_command.pop(key, None)
+        try:
+            await self.data.update_meta(
+                cmd_id, user, request.remote_addr, **put_command
+            )
+        except KeyError:
+            return jsonify_code({'error': 'No such history item'}, 404)
+        return Response(b'', 204)
+
+    async def history_item_delete(self, request, user, cmd_id):
+        """
+        Delete a command, see :py:func:`archelond.web.history_item`.
+        """
+        try:
+            await self.data.delete(cmd_id, user, request.remote_addr)
+        except KeyError:
+            return jsonify_code({'error': 'No such history item'}, 404)
+        return jsonify_code({'message': 'success'})
+
+
+def asgi_app():
+    """
+    Build the ASGI application from the same configuration as
+    :py:func:`archelond.web.wsgi_app`.
+    """
+    flask_app = Flask('archelond')
+    if os.environ.get('ARCHELOND_CONF'):
+        flask_app.config.from_envvar('ARCHELOND_CONF')
+    else:
+        flask_app.config.from_object('archelond.config')
+
+    data_class = DATA_TYPES.get(flask_app.config['DATABASE_TYPE'])
+    if data_class is None:
+        raise Exception('No valid asyncio database type is set')
+    configure_logging(flask_app)
+    return ArchelondASGI(flask_app, data_class(flask_app.config))
+
+
+app = asgi_app()  # pylint: disable=invalid-name
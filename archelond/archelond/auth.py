@@ -0,0 +1,200 @@
+"""
+htpasswd authentication that remembers credentials it has verified,
+so every API request doesn't pay for an MD5-crypt password check or a
+token signature check.
+"""
+from __future__ import absolute_import, unicode_literals
+from collections import OrderedDict
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+# pylint: disable=no-name-in-module, import-error
+from flask.ext.htpasswd import HtPasswdAuth
+from passlib.apache import HtpasswdFile
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class CachedHtPasswdAuth(HtPasswdAuth):
+    """``HtPasswdAuth`` with a cache of verified credentials.
+
+    Up to ``AUTH_CACHE_SIZE`` credentials that passed are kept for at
+    most ``AUTH_CACHE_TTL`` seconds, least recently used first out.
+    They are keyed by an HMAC of the credential with a key made for
+    each process, so the cache never holds passwords or tokens.
+    Credentials that fail aren't cached and are checked every time.
+
+    The htpasswd file is checked for changes on every request, and
+    when it changes the users are reloaded and the cache is emptied,
+    so changed passwords and removed users take effect straight away.
+    An ``AUTH_CACHE_SIZE`` of 0 turns this all off.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, app=None):
+        """
+        Set up an empty cache before the application is configured.
+        """
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.secret = os.urandom(32)
+        self.size = 0
+        self.ttl = 0
+        self.path = None
+        self.signature = None
+        # Bumped every time the cache is emptied
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # HtPasswdAuth is an old style class on Python 2
+        HtPasswdAuth.__init__(self, app)
+
+    def init_app(self, app):
+        """
+        Size the cache from the configuration and load the users.
+        """
+        self.size = int(app.config.get('AUTH_CACHE_SIZE', 1024))
+        self.ttl = float(app.config.get('AUTH_CACHE_TTL', 60))
+        HtPasswdAuth.init_app(self, app)
+
+    @staticmethod
+    def _signature(path):
+        """
+        What we compare to notice changes to the htpasswd file, or
+        ``None`` if it doesn't exist.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def _clear(self):
+        """
+        Forget every verified credential.
+        """
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def load_users(self, app):
+        """
+        Load the users and start over with an empty cache.
+
+        Raises:
+            IOError: If the configured htpasswd file does not exist.
+        """
+        self.path = app.config['FLASK_HTPASSWD_PATH']
+        self.signature = self._signature(self.path)
+        self._clear()
+        HtPasswdAuth.load_users(self, app)
+
+    def _refresh(self):
+        """
+        Reload the users if the htpasswd file has changed.
+        """
+        signature = self._signature(self.path)
+        if signature == self.signature:
+            return
+        self.signature = signature
+        self._clear()
+        try:
+            self.users = HtpasswdFile(self.path)
+        except IOError:
+            log.warning('Unable to reload changed htpasswd file %s, '
+                        'keeping the users we have', self.path)
+        else:
+            log.info('Reloaded changed htpasswd file %s', self.path)
+
+    def _digest(self, *parts):
+        """
+        Key for a credential in the cache.
+        """
+        return hmac.new(
+            self.secret, json.dumps(parts).encode('utf-8'), hashlib.sha256
+        ).digest()
+
+    def _verify(self, key, check, *args):
+        """Verify a credential from the cache, or with ``check``.
+
+        Args:
+            key (bytes): Digest of the credential
+            check (function): Unbound ``HtPasswdAuth`` method that
+                verifies the credential
+            args: What to pass ``check``
+
+        Returns:
+            tuple (is_valid, username): What ``check`` returned
+        """
+        if not self.size:
+            return check(self, *args)
+        self._refresh()
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries[key] = self.entries.pop(key)
+                    self.hits += 1
+                    return True, entry[1]
+                del self.entries[key]
+            self.misses += 1
+            generation = self.generation
+
+        is_valid, user = check(self, *args)
+        if not is_valid:
+            return is_valid, user
+
+        with self.lock:
+            # Don't cache what we checked against users since replaced
+            if generation == self.generation:
+                self.entries[key] = (now + self.ttl, user)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return is_valid, user
+
+    def check_basic_auth(self, username, password):
+        """
+        Check a username and password against the htpasswd file.
+        """
+        return self._verify(
+            self._digest('basic', username, password),
+            HtPasswdAuth.check_basic_auth, username, password
+        )
+
+    def check_token_auth(self, token):
+        """
+        Check who a token is for and if it still lets them in.
+        """
+        return self._verify(
+            self._digest('token', token),
+            HtPasswdAuth.check_token_auth, token
+        )
+
+    def cache_stats(self):
+        """Counters for how well the cache is doing.
+
+        Returns:
+            dict: ``hits``, ``misses``, their ``hit_rate``,
+                ``evictions`` to make room, ``invalidations`` by
+                htpasswd changes, and current ``entries``
+        """
+        with self.lock:
+            checks = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / checks if checks else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+            }
@@ -6,15 +6,87 @@ import os
 
 DEBUG = False
 FLASK_SECRET = os.environ.get('ARCHELOND_FLASK_SECRET', 'please-change-me')
+# Defaults to INFO when unset
 LOG_LEVEL = os.environ.get('ARCHELOND_LOG_LEVEL', None)
+# Only log one in this many large payloads (such as Elasticsearch
+# responses) at DEBUG, and at most this many characters of each.
+LOG_PAYLOAD_SAMPLE = int(os.environ.get('ARCHELOND_LOG_PAYLOAD_SAMPLE', 10))
+LOG_PAYLOAD_MAX_SIZE = int(
+    os.environ.get('ARCHELOND_LOG_PAYLOAD_MAX_SIZE', 1024)
+)
+# Records waiting to be written before new ones are dropped
+LOG_QUEUE_SIZE = int(os.environ.get('ARCHELOND_LOG_QUEUE_SIZE', 10000))
 
 DATABASE_TYPE = os.environ.get(
     'ARCHELOND_DATABASE',
     'MemoryData'
 )
 
+# Directory to journal MemoryData changes to so they survive restarts
+MEMORY_JOURNAL_PATH = os.environ.get('ARCHELOND_MEMORY_JOURNAL_PATH', None)
+MEMORY_SNAPSHOT_INTERVAL = int(
+    os.environ.get('ARCHELOND_MEMORY_SNAPSHOT_INTERVAL', 10000)
+)
+MEMORY_JOURNAL_FSYNC = bool(os.environ.get('ARCHELOND_MEMORY_JOURNAL_FSYNC'))
+
+SQLITE_PATH = os.environ.get('ARCHELOND_SQLITE_PATH', 'archelond.sqlite')
+
 ELASTICSEARCH_URL = os.environ.get('ARCHELOND_ELASTICSEARCH_URL', None)
 ELASTICSEARCH_INDEX = os.environ.get('ARCHELOND_ELASTICSEARCH_INDEX', None)
+# How long to keep scroll contexts alive between pages past the first
+# (e.g. 1m), or unset to page with from.  Elasticsearch 5 and up page
+# with search_after either way.
+ELASTICSEARCH_SCROLL = os.environ.get('ARCHELOND_ELASTICSEARCH_SCROLL', None)
+# Index commands in n-grams as well for fast substring search.  Only
+# takes effect when the index is created.
+ELASTICSEARCH_NGRAM = bool(os.environ.get('ARCHELOND_ELASTICSEARCH_NGRAM'))
+# Count uses with an inline update script, for clusters that allow
+# them.  Otherwise each command is read and indexed again.
+ELASTICSEARCH_SCRIPT = bool(os.environ.get('ARCHELOND_ELASTICSEARCH_SCRIPT'))
+
+# Seconds it takes for a use of a command to count half as much in
+# the frecency ordering
+FRECENCY_HALF_LIFE = float(
+    os.environ.get('ARCHELOND_FRECENCY_HALF_LIFE', 7 * 24 * 60 * 60)
+)
+
+# Cache up to this many pages of search results in each process, 0 to
+# turn caching off.  Pages are cached for at most CACHE_TTL seconds,
+# which is also how long other processes' changes can take to show up.
+CACHE_SIZE = int(os.environ.get('ARCHELOND_CACHE_SIZE', 0))
+CACHE_TTL = float(os.environ.get('ARCHELOND_CACHE_TTL', 10))
+
+# SQLite file to queue added commands in, so POSTs return without
+# waiting on the data store.  Unset to add commands synchronously.
+SPOOL_PATH = os.environ.get('ARCHELOND_SPOOL_PATH', None)
+SPOOL_BATCH_SIZE = int(os.environ.get('ARCHELOND_SPOOL_BATCH_SIZE', 500))
+SPOOL_FLUSH_INTERVAL = float(
+    os.environ.get('ARCHELOND_SPOOL_FLUSH_INTERVAL', 1)
+)
+SPOOL_MAX_ATTEMPTS = int(os.environ.get('ARCHELOND_SPOOL_MAX_ATTEMPTS', 10))
+
+# Commands to add to the data store at a time from streamed imports
+IMPORT_BATCH_SIZE = int(os.environ.get('ARCHELOND_IMPORT_BATCH_SIZE', 500))
+
+# Directory for each process to write its metrics to, so /metrics
+# can add them up across processes.  Unset to only serve the metrics
+# of the process answering.
+METRICS_PATH = os.environ.get('ARCHELOND_METRICS_PATH', None)
+METRICS_FLUSH_INTERVAL = float(
+    os.environ.get('ARCHELOND_METRICS_FLUSH_INTERVAL', 1)
+)
+
+# Directory to write request profiles to, unset to never profile.
+# One in PROFILE_SAMPLE requests is profiled (0 for none), along with
+# every request that has PROFILE_SECRET in the PROFILE_HEADER header,
+# until there are PROFILE_MAX_FILES profiles in the directory.
+PROFILE_PATH = os.environ.get('ARCHELOND_PROFILE_PATH', None)
+PROFILE_SAMPLE = int(os.environ.get('ARCHELOND_PROFILE_SAMPLE', 0))
+PROFILE_HEADER = os.environ.get(
+    'ARCHELOND_PROFILE_HEADER', 'X-Archelond-Profile'
+)
+PROFILE_SECRET = os.environ.get('ARCHELOND_PROFILE_SECRET', None)
+PROFILE_MAX_FILES = int(os.environ.get('ARCHELOND_PROFILE_MAX_FILES', 1000))
 
 # Load path to environment variable to point to htpasswd file
 # or write the ARCHELOND_HTPASSWD out to a file and ref that
@@ -24,5 +96,10 @@ if os.environ.get('ARCHELOND_HTPASSWD'):
     with open(FLASK_HTPASSWD_PATH, 'w') as wfile:
         wfile.write(os.environ['ARCHELOND_HTPASSWD'])
 
+# Remember up to this many verified passwords and tokens in each
+# process for AUTH_CACHE_TTL seconds, 0 to check every request.
+AUTH_CACHE_SIZE = int(os.environ.get('ARCHELOND_AUTH_CACHE_SIZE', 1024))
+AUTH_CACHE_TTL = float(os.environ.get('ARCHELOND_AUTH_CACHE_TTL', 60))
+
 # Enforce authentication on all views
 FLASK_AUTH_ALL = True
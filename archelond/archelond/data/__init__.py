@@ -2,11 +2,17 @@
 Import all known data store implementations
 """
 from __future__ import absolute_import, unicode_literals
+from archelond.data.cache import CachedData
 from archelond.data.elastic import ElasticData
 from archelond.data.memory import MemoryData
+from archelond.data.metered import MeteredData
+from archelond.data.sqlite import SQLiteData
 
 ORDER_TYPES = [
     'r',  # reverse
+    'f',  # frecency, most often and recently used first
 ]
 
-__all__ = ['ElasticData', 'MemoryData']
+__all__ = [
+    'CachedData', 'ElasticData', 'MemoryData', 'MeteredData', 'SQLiteData'
+]
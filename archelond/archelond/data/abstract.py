@@ -14,7 +14,7 @@ class HistoryData(with_metaclass(ABCMeta, object)):
     history.  Generally a command data item needs just two things, an
     ID and the command itself.  It also needs order.  See the
     :py:class:`archelond.data.MemoryData` class as the simplest
-    structure using an :py:class:`collections.OrderedDict`.
+    structure using dictionaries and lists.
 
     An ID can be any string, and the concrete implementation of
     :py:class:`HistoryData` is responsible for type casting it if
@@ -25,7 +25,12 @@ class HistoryData(with_metaclass(ABCMeta, object)):
     should result in the return of just one command when filtered
     by a term equal to that command.
 
+    Results of ``all`` and ``filter`` are paged, at most
+    ``NUM_RESULTS`` to a page.
+
     """
+    # Only return a max of 50 results
+    NUM_RESULTS = 50
 
     @abstractmethod
     def __init__(self, config):
@@ -41,6 +46,17 @@ class HistoryData(with_metaclass(ABCMeta, object)):
         """
         self.config = config
 
+    def bootstrap(self):
+        """Create anything the data store needs before it can be used.
+
+        Data stores that need more than a cheap local setup in
+        ``__init__``, like creating a remote index, do it here.
+        Nothing needs to call it first, it is run from the
+        ``archelond-bootstrap`` command to get it out of the way
+        before application servers start.
+        """
+        pass
+
     @abstractmethod
     def add(self, command, username, host, **kwargs):
         """Add or update a command
@@ -56,6 +72,39 @@ class HistoryData(with_metaclass(ABCMeta, object)):
         """
         pass  # pragma: no cover
 
+    @abstractmethod
+    def bulk_add(self, commands, username, host, **kwargs):
+        """Add or update many commands at once
+
+        Save (update or create) a list of commands to the data store
+        in as few round trips as the data store allows.
+
+        Args:
+            commands (list): The commands to store
+            username (str): The username of the person adding them
+            host (str): The IP address of API caller
+        Returns:
+            list: The id of each command stored, in the same order as
+                ``commands``, with ``None`` for any command that
+                couldn't be stored.
+        """
+        pass  # pragma: no cover
+
+    @abstractmethod
+    def update_meta(self, command_id, username, host, **kwargs):
+        """Replace a command's metadata
+
+        Replace the ``meta`` of a stored command with ``kwargs``,
+        without counting a use of it the way ``add`` does.  Raise a
+        KeyError if the command does not exist.
+
+        Args:
+            command_id (str): Unique command identifier
+            username (str): The username of the person updating it
+            host (str): The IP address of API caller
+        """
+        pass  # pragma: no cover
+
     @abstractmethod
     def delete(self, command_id, username, host, **kwargs):
         """Delete a command
@@ -93,20 +142,76 @@ class HistoryData(with_metaclass(ABCMeta, object)):
         """Unfiltered but ordered command history
 
         Return the full data set as a list of dict structures
-        in the specified order.
+        in the specified order, one page at a time.
 
         Args:
             order (str): An ordering from :py:const:`ORDER_TYPES`
             username (str): The username of the person adding it
             host (str): The IP address of API caller
+            page (int): Zero based page number to return
+            cursor (str): Opaque cursor from a previous page's results
+                to continue from instead of ``page``.  Data stores
+                raise a ValueError for cursors they didn't make.
 
         Returns:
 
             list: A list of dictionaries where each dictionary must
                 have at least a ``command`` key and an ``id`` key.
+                Data stores that support cursors return a
+                :py:class:`archelond.data.cursor.ResultPage`.
         """
         pass  # pragma: no cover
 
+    @staticmethod
+    def _in_range(timestamp, since, until):
+        """
+        Whether a command's timestamp is within the export's range.
+        """
+        return (
+            (since is None or timestamp >= since) and
+            (until is None or timestamp < until)
+        )
+
+    def export(self, username, host, term=None, since=None, until=None):
+        """Every command, for streaming out a user's whole history
+
+        The default pages through ``all`` or ``filter`` with cursors.
+        Data stores that can read their commands out in one pass
+        should do that instead.
+
+        Args:
+            username (str): The username of the person exporting
+            host (str): The IP address of API caller
+            term (str): Only export commands containing this
+            since (datetime.datetime): Only export commands last added
+                at or after this UTC time
+            until (datetime.datetime): Only export commands last added
+                before this UTC time
+
+        Yields:
+            dict: Command dictionaries, oldest first for data stores
+                that keep an order.
+        """
+        # pylint: disable=too-many-arguments
+        page = 0
+        cursor = None
+        while True:
+            if term:
+                results = self.filter(
+                    term, None, username, host, page=page, cursor=cursor
+                )
+            else:
+                results = self.all(
+                    None, username, host, page=page, cursor=cursor
+                )
+            for result in results:
+                if self._in_range(result['timestamp'], since, until):
+                    yield result
+            if len(results) < self.NUM_RESULTS:
+                return
+            page += 1
+            cursor = getattr(results, 'cursor', None)
+
     @abstractmethod
     def filter(self, term, order, username, host, **kwargs):
         """Get a filtered by term and ordered command history
@@ -116,10 +221,16 @@ class HistoryData(with_metaclass(ABCMeta, object)):
             order (str): An ordering from :py:const:`ORDER_TYPES`
             username (str): The username of the person adding it
             host (str): The IP address of API caller
+            page (int): Zero based page number to return
+            cursor (str): Opaque cursor from a previous page's results
+                to continue from instead of ``page``.  Data stores
+                raise a ValueError for cursors they didn't make.
 
         Returns:
 
             list: A list of dictionaries where each dictionary must
                 have at least a ``command`` key and an ``id`` key.
+                Data stores that support cursors return a
+                :py:class:`archelond.data.cursor.ResultPage`.
         """
         pass  # pragma: no cover
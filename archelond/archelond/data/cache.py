@@ -0,0 +1,204 @@
+"""
+Read through cache of search results that wraps any other data store.
+"""
+from __future__ import absolute_import, unicode_literals
+from collections import OrderedDict
+import threading
+import time
+
+from archelond.data.abstract import HistoryData
+from archelond.data.cursor import ResultPage
+
+
+class CachedData(HistoryData):
+    """Cache ``filter`` and ``all`` results of another data store.
+
+    Results are kept in a least recently used cache of at most
+    ``CACHE_SIZE`` pages, each for at most ``CACHE_TTL`` seconds, and
+    keyed by user, term, order, page and cursor.  Anything that
+    changes a user's commands drops all of that user's cached pages,
+    so the cache never hides a change made through the same process.
+
+    Changes made through other application processes aren't seen
+    until the cached page expires, so ``CACHE_TTL`` is how stale a
+    search can be when running more than one.
+    """
+
+    def __init__(self, config, data):
+        """Wrap ``data`` with a cache sized from ``config``.
+
+        Args:
+            config (dict): The flask application configuration
+                dictionary.
+            data (HistoryData): The data store to cache results of
+        """
+        super(CachedData, self).__init__(config)
+        self.data = data
+        self.size = int(self.config.get('CACHE_SIZE', 1024))
+        self.ttl = float(self.config.get('CACHE_TTL', 10))
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.user_keys = {}
+        # Bumped on every change to a user's commands
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _drop(self, key):
+        """
+        Forget a cached page.  Must be called with the lock held.
+        """
+        del self.entries[key]
+        keys = self.user_keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.user_keys[key[0]]
+
+    def _cached(self, key, function, *args, **kwargs):
+        """
+        Return the cached page for ``key``, or get it with
+        ``function`` and cache it.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries[key] = self.entries.pop(key)
+                    self.hits += 1
+                    return ResultPage(entry[1], entry[1].cursor)
+                self._drop(key)
+            self.misses += 1
+            generation = self.generations.get(key[0], 0)
+
+        # Don't hold up everyone else while we wait on the data store
+        results = function(*args, **kwargs)
+        page = ResultPage(results, getattr(results, 'cursor', None))
+
+        with self.lock:
+            if generation != self.generations.get(key[0], 0):
+                # The user's commands changed while we were searching,
+                # so these results may already be stale.
+                return page
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (now + self.ttl, page)
+            self.user_keys.setdefault(key[0], set()).add(key)
+            while len(self.entries) > self.size:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+        return ResultPage(page, page.cursor)
+
+    def invalidate(self, username):
+        """Drop every cached page for a user.
+
+        Args:
+            username (str): User whose commands changed
+        """
+        with self.lock:
+            self.generations[username] = (
+                self.generations.get(username, 0) + 1
+            )
+            for key in self.user_keys.pop(username, ()):
+                del self.entries[key]
+                self.invalidations += 1
+
+    def cache_stats(self):
+        """Counters for how well the cache is doing.
+
+        Returns:
+            dict: ``hits``, ``misses``, ``evictions`` to make room,
+                ``invalidations`` by changes, and current ``entries``
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+            }
+
+    def bootstrap(self):
+        """
+        Bootstrap the data store we are wrapping.
+        """
+        self.data.bootstrap()
+
+    def add(self, command, username, host, **kwargs):
+        """
+        Add the command and drop the user's cached pages.
+        """
+        try:
+            return self.data.add(command, username, host, **kwargs)
+        finally:
+            self.invalidate(username)
+
+    def bulk_add(self, commands, username, host, **kwargs):
+        """
+        Add the commands and drop the user's cached pages.
+        """
+        try:
+            return self.data.bulk_add(commands, username, host, **kwargs)
+        finally:
+            self.invalidate(username)
+
+    def update_meta(self, command_id, username, host, **kwargs):
+        """
+        Update the command and drop the user's cached pages.
+        """
+        try:
+            return self.data.update_meta(
+                command_id, username, host, **kwargs
+            )
+        finally:
+            self.invalidate(username)
+
+    def delete(self, command_id, username, host, **kwargs):
+        """
+        Delete the command and drop the user's cached pages.
+        """
+        try:
+            return self.data.delete(command_id, username, host, **kwargs)
+        finally:
+            self.invalidate(username)
+
+    def get(self, command_id, username, host, **kwargs):
+        """
+        Single commands are cheap to get, so aren't cached.
+        """
+        return self.data.get(command_id, username, host, **kwargs)
+
+    def export(self, username, host, term=None, since=None, until=None):
+        """
+        Exports are read once, so go straight to the wrapped data store.
+        """
+        # pylint: disable=too-many-arguments
+        return self.data.export(
+            username, host, term=term, since=since, until=until
+        )
+
+    def all(self, order, username, host, page=0, cursor=None, **kwargs):
+        """
+        Cached ``all`` of the wrapped data store.
+        """
+        # pylint: disable=too-many-arguments
+        return self._cached(
+            (username, 'all', None, order, page, cursor),
+            self.data.all, order, username, host,
+            page=page, cursor=cursor, **kwargs
+        )
+
+    def filter(self, term, order, username, host, page=0, cursor=None,
+               **kwargs):
+        """
+        Cached ``filter`` of the wrapped data store.
+        """
+        # pylint: disable=too-many-arguments
+        return self._cached(
+            (username, 'filter', term, order, page, cursor),
+            self.data.filter, term, order, username, host,
+            page=page, cursor=cursor, **kwargs
+        )
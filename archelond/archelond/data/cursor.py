@@ -0,0 +1,61 @@
+"""
+Opaque cursors for paging through data store results
+"""
+from __future__ import absolute_import, unicode_literals
+import base64
+import binascii
+import json
+
+
+class ResultPage(list):
+    """A page of results from a data store.
+
+    Behaves exactly like the list of command dictionaries data stores
+    have always returned, but also carries the ``cursor`` to pass back
+    in for the next page.  ``cursor`` is ``None`` when the data store
+    knows there is nothing more to get.
+    """
+
+    def __init__(self, results=(), cursor=None):
+        """
+        Wrap the results and remember the cursor to the next page.
+        """
+        super(ResultPage, self).__init__(results)
+        self.cursor = cursor
+
+
+def encode_cursor(values):
+    """Turn the position a data store stopped at into an opaque token.
+
+    Args:
+        values (list): JSON serializable values the data store needs
+            to pick up where it left off.
+
+    Returns:
+        str: URL safe cursor string
+    """
+    payload = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Get back the values encoded with :py:func:`encode_cursor`.
+
+    Args:
+        cursor (str): The cursor a client sent us
+
+    Raises:
+        ValueError: If the cursor is not one we made.
+
+    Returns:
+        list: The values that were encoded
+    """
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        )
+    except (TypeError, ValueError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+    return values
@@ -3,22 +3,49 @@ ElasticSearch implementation of the data store.  Currently the
 recommended default data store.
 """
 from __future__ import absolute_import, unicode_literals
+from collections import OrderedDict
 from datetime import datetime
 import hashlib
 import logging
 
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan, streaming_bulk
 from elasticsearch.exceptions import (
+    ConflictError,
     RequestError,
     NotFoundError,
+    TransportError,
     ConnectionError as ESConnectionError
 )
 import pytz
 
 from archelond.data.abstract import HistoryData
+from archelond.data.cursor import ResultPage, encode_cursor, decode_cursor
+from archelond.data.frecency import HALF_LIFE, frecency, seconds
+from archelond.log import log_payload
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# Update an existing command with a new use, see
+# archelond.data.frecency for the rank
+USE_SCRIPT = (
+    'def rank = ctx._source.frecency; '
+    'def now = when / half_life; '
+    'ctx._source.putAll(document); '
+    'ctx._source.count = (ctx._source.count ?: 0) + 1; '
+    'ctx._source.frecency = rank == null ? now : '
+    'now + Math.log(Math.pow(2, rank - now) + 1) / Math.log(2)'
+)
+
+
+def script_refused(error):
+    """
+    Whether an Elasticsearch error, or the error of a bulk item, is
+    the cluster refusing to run scripts because they are disabled.
+    """
+    message = '{0}'.format(error).lower()
+    return 'script' in message and 'disabled' in message
+
 
 class ElasticData(HistoryData):
     """
@@ -26,12 +53,37 @@ class ElasticData(HistoryData):
     This is what should be used in production
     """
     DOC_TYPE = 'history'
-    # Only return a max of 50 results
-    NUM_RESULTS = 50
+    # Number of commands sent in each _bulk request
+    BULK_CHUNK_SIZE = 500
+    # Unique field to break sort ties with for search_after, only
+    # sorted on by clusters that have it since it loads fielddata
+    TIEBREAKER_FIELD = '_uid'
+    # Length of the pieces the optional command.ngram subfield indexes
+    NGRAM_SIZE = 3
+    # Times to retry a use of a command another request is updating
+    RETRY_ON_CONFLICT = 3
+    # How long to keep an export's scroll context alive between pages
+    EXPORT_SCROLL = '5m'
+    # Indexes known to exist, shared by every instance in the process
+    _verified = set()
+    # Whether the cluster of each index can search_after, learned when
+    # it is bootstrapped
+    _search_after = {}
+    # Indexes whose cluster refused to run USE_SCRIPT
+    _unscripted = set()
+    # Whether each index has the command.ngram subfield to search,
+    # learned when it is bootstrapped
+    _ngram = {}
 
     def __init__(self, config):
         """
-        Configure and setup the ES client
+        Configure and setup the ES client.
+
+        Nothing is sent to Elasticsearch here, so application workers
+        start without waiting on the cluster.  Each process instead
+        makes sure the index exists with :py:meth:`bootstrap` the
+        first time it is used.  The ``archelond-bootstrap`` command
+        does the same ahead of a deploy.
         """
         super(ElasticData, self).__init__(config)
 
@@ -39,37 +91,163 @@ class ElasticData(HistoryData):
         self.elasticsearch = Elasticsearch(
             self.config['ELASTICSEARCH_URL']
         )
-        # Create configured index.
+        self.index = self.config['ELASTICSEARCH_INDEX']
+        self.scroll = self.config.get('ELASTICSEARCH_SCROLL')
+        self.ngram_mapping = bool(self.config.get('ELASTICSEARCH_NGRAM'))
+        self.script = bool(self.config.get('ELASTICSEARCH_SCRIPT'))
+        self.half_life = self.config.get('FRECENCY_HALF_LIFE', HALF_LIFE)
+
+    def _index_body(self):
+        """
+        Settings and mappings to create the index with.
+        """
         # Analyzer is setup such that every single character can
         # be part of the search query
-        self.index = self.config['ELASTICSEARCH_INDEX']
-        # pylint: disable=unexpected-keyword-arg
-        self.elasticsearch.indices.create(
-            index=self.index, ignore=400,
-            body={
-                'settings': {
-                    'analysis': {
-                        'analyzer': {
-                            'command_analyzer': {
-                                'tokenizer': 'keyword',
-                                'filter': 'lowercase'
-                            }
+        body = {
+            'settings': {
+                'analysis': {
+                    'analyzer': {
+                        'command_analyzer': {
+                            'tokenizer': 'keyword',
+                            'filter': 'lowercase'
                         }
                     }
-                },
-                'mappings': {
-                    self.index: {
-                        'properties': {
-                            'command': {
-                                'search_analyzer': 'command_analyzer',
-                                'index_analyzer': 'command_analyzer',
-                                'type': 'string'
-                            }
-                        }
+                }
+            },
+            'mappings': {
+                self.index: {
+                    'properties': {
+                        'command': {
+                            'search_analyzer': 'command_analyzer',
+                            'index_analyzer': 'command_analyzer',
+                            'type': 'string'
+                        },
+                        'count': {'type': 'long'},
+                        'last_used': {'type': 'date'},
+                        'frecency': {'type': 'double'},
                     }
                 }
             }
+        }
+        if self.ngram_mapping:
+            self._add_ngram_mapping(body)
+        return body
+
+    def bootstrap(self):
+        """
+        Create the configured index if it doesn't exist yet, and
+        remember for the rest of the process that it does.
+        """
+        # pylint: disable=unexpected-keyword-arg
+        self.elasticsearch.indices.create(
+            index=self.index, ignore=400, body=self._index_body()
         )
+        self._search_after[self._index_key()] = self.has_search_after(
+            self.elasticsearch.info()
+        )
+        self._check_ngram(self.elasticsearch.indices.get_field_mapping(
+            index=self.index, field='command.ngram'
+        ))
+        self._verified.add(self._index_key())
+
+    @staticmethod
+    def has_ngram(mapping):
+        """
+        Whether the field ``mapping`` of ``command.ngram`` shows the
+        subfield in any document type of the index.
+        """
+        try:
+            return any(
+                'command.ngram' in fields
+                for index in mapping.values()
+                for fields in index['mappings'].values()
+            )
+        except (KeyError, TypeError, AttributeError):
+            return False
+
+    def _check_ngram(self, mapping):
+        """
+        Only search the n-gram subfield when it is both configured and
+        in the index, since the mapping is fixed when the index is
+        created, and warn when they disagree.
+        """
+        indexed = self.has_ngram(mapping)
+        if indexed != self.ngram_mapping:
+            log.warning(
+                'ELASTICSEARCH_NGRAM is %s but the %s index was created '
+                '%s the command.ngram subfield, so searches match the start '
+                'of commands.  Delete the index and load the history again '
+                'to change it.',
+                'set' if self.ngram_mapping else 'unset', self.index,
+                'with' if indexed else 'without'
+            )
+        self._ngram[self._index_key()] = indexed and self.ngram_mapping
+
+    @property
+    def ngram(self):
+        """
+        Whether searches can match any part of commands with the
+        n-gram subfield.
+        """
+        return self._ngram.get(self._index_key(), False)
+
+    @staticmethod
+    def has_search_after(info):
+        """
+        Whether the cluster that answered with ``info`` supports
+        ``search_after``, which arrived in Elasticsearch 5.
+        """
+        try:
+            return int(info['version']['number'].split('.')[0]) >= 5
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return False
+
+    @property
+    def search_after(self):
+        """
+        Whether pages can be fetched with ``search_after`` cursors.
+        """
+        return self._search_after.get(self._index_key(), False)
+
+    def _index_key(self):
+        """
+        What identifies our index across instances in this process
+        """
+        return (str(self.config['ELASTICSEARCH_URL']), self.index)
+
+    def _ensure_index(self):
+        """
+        Bootstrap the index on first use if nothing in this process
+        has yet.
+        """
+        if self._index_key() not in self._verified:
+            self.bootstrap()
+
+    def _add_ngram_mapping(self, body):
+        """
+        Add a ``command.ngram`` subfield that indexes every
+        ``NGRAM_SIZE`` long piece of the command, so any substring at
+        least that long can be found without expanding wildcards or
+        prefixes over the whole term dictionary.
+        """
+        analysis = body['settings']['analysis']
+        analysis['tokenizer'] = {
+            'command_ngram_tokenizer': {
+                'type': 'nGram',
+                'min_gram': self.NGRAM_SIZE,
+                'max_gram': self.NGRAM_SIZE,
+            }
+        }
+        analysis['analyzer']['command_ngram_analyzer'] = {
+            'tokenizer': 'command_ngram_tokenizer',
+            'filter': 'lowercase'
+        }
+        body['mappings'][self.index]['properties']['command']['fields'] = {
+            'ngram': {
+                'type': 'string',
+                'analyzer': 'command_ngram_analyzer'
+            }
+        }
 
     def _doc_type(self, username):
         """
@@ -84,32 +262,240 @@ class ElasticData(HistoryData):
         """
         return hashlib.sha256(command.encode('utf-8')).hexdigest()
 
-    def add(self, command, username, host, **kwargs):
+    def _document(self, command, username, host, **kwargs):
         """
-        Add the command to the index with a time stamp and id
-        by hash of the command and append username to doc type
-        for user separation of data.
+        Build the document we index for a command.
         """
-        doc_type = self._doc_type(username)
-        doc_id = ElasticData._doc_id(command)
-        document = {
+        return {
             'command': command,
             'username': username,
             'host': host,
             'timestamp': datetime.utcnow().replace(tzinfo=pytz.utc),
+            # Add kwargs to meta key in document
+            'meta': kwargs,
+        }
+
+    def _use(self, command, username, host, **kwargs):
+        """
+        Body of an update that counts a use of the command and bumps
+        its rank, creating it if it isn't indexed yet.
+        """
+        document = self._document(command, username, host, **kwargs)
+        document['last_used'] = document['timestamp']
+        upsert = dict(document)
+        upsert['count'] = 1
+        upsert['frecency'] = frecency(
+            None, document['timestamp'], self.half_life
+        )
+        return {
+            'script': USE_SCRIPT,
+            'params': {
+                'document': document,
+                'when': seconds(document['timestamp']),
+                'half_life': self.half_life,
+            },
+            'upsert': upsert,
         }
-        # Add kwargs to meta key in document
-        document['meta'] = kwargs
-        result = self.elasticsearch.index(
-            index=self.index, doc_type=doc_type, id=doc_id, body=document
+
+    @property
+    def scripted(self):
+        """
+        Whether uses are counted by ``USE_SCRIPT``, which is when
+        ``ELASTICSEARCH_SCRIPT`` is set, until the cluster refuses to
+        run it.
+        """
+        return self.script and self._index_key() not in self._unscripted
+
+    def _refuse_scripts(self, error):
+        """
+        Count uses without scripts from now on.
+        """
+        log.warning(
+            'Elasticsearch refused the use counting script, counting '
+            'uses without it: %s', error
         )
-        log.debug(result)
+        self._unscripted.add(self._index_key())
+
+    def _counted(self, commands, previous, username, host, **kwargs):
+        """
+        Documents counting a use of each command on top of the
+        ``previous`` source of those already indexed, by id.
+        """
+        documents = OrderedDict()
+        for command in commands:
+            doc_id = self._doc_id(command)
+            old = documents.get(doc_id) or previous.get(doc_id) or {}
+            document = self._document(command, username, host, **kwargs)
+            document['last_used'] = document['timestamp']
+            document['count'] = (old.get('count') or 0) + 1
+            document['frecency'] = frecency(
+                old.get('frecency'), document['timestamp'], self.half_life
+            )
+            documents[doc_id] = document
+        return documents
+
+    def _index_uses(self, commands, username, host, **kwargs):
+        """
+        Count uses of the commands without scripts, by reading what is
+        indexed with ``_mget`` and indexing whole documents, a
+        ``BULK_CHUNK_SIZE`` chunk at a time.  Uses of a command counted
+        by another request in between can be lost, so this is only for
+        clusters with scripting disabled.
+        """
+        doc_type = self._doc_type(username)
+        indexed = set()
+        for start in range(0, len(commands), self.BULK_CHUNK_SIZE):
+            chunk = commands[start:start + self.BULK_CHUNK_SIZE]
+            found = self.elasticsearch.mget(
+                index=self.index, doc_type=doc_type,
+                body={'ids': list(set(self._doc_id(x) for x in chunk))}
+            )
+            documents = self._counted(
+                chunk,
+                dict(
+                    (doc['_id'], doc['_source'])
+                    for doc in found['docs'] if doc.get('found')
+                ),
+                username, host, **kwargs
+            )
+            for success, item in streaming_bulk(
+                    self.elasticsearch,
+                    (
+                        {
+                            '_op_type': 'index',
+                            '_index': self.index,
+                            '_type': doc_type,
+                            '_id': doc_id,
+                            '_source': document,
+                        }
+                        for doc_id, document in documents.items()
+                    ),
+                    chunk_size=self.BULK_CHUNK_SIZE,
+                    raise_on_error=False, raise_on_exception=False
+            ):
+                if success:
+                    indexed.add(item['index']['_id'])
+                else:
+                    log.error('Failed to index command: %s', item['index'])
+        return [
+            doc_id if doc_id in indexed else None
+            for doc_id in (self._doc_id(x) for x in commands)
+        ]
+
+    def add(self, command, username, host, **kwargs):
+        """
+        Add the command to the index with a time stamp and id
+        by hash of the command and append username to doc type
+        for user separation of data.
+
+        Commands already in the index are updated by a script that
+        counts the use and bumps their rank for the ``f`` ordering.
+        Clusters with scripting disabled have the use counted by
+        reading the command and indexing it again instead.
+        """
+        self._ensure_index()
+        doc_type = self._doc_type(username)
+        doc_id = ElasticData._doc_id(command)
+        if self.scripted:
+            try:
+                # pylint: disable=unexpected-keyword-arg
+                result = self.elasticsearch.update(
+                    index=self.index, doc_type=doc_type, id=doc_id,
+                    body=self._use(command, username, host, **kwargs),
+                    retry_on_conflict=self.RETRY_ON_CONFLICT
+                )
+            except TransportError as ex:
+                if not script_refused(ex):
+                    raise
+                self._refuse_scripts(ex)
+            else:
+                log_payload(log, 'Updated command: %s', result)
+                return doc_id
+        if self._index_uses([command], username, host, **kwargs)[0] is None:
+            raise TransportError(500, 'Failed to index command')
         return doc_id
 
+    def bulk_add(self, commands, username, host, **kwargs):
+        """
+        Update all the commands like :py:meth:`add` with ``_bulk``
+        requests of ``BULK_CHUNK_SIZE`` commands each, instead of a
+        request per command.  Commands that fail, or are in a chunk
+        that couldn't be sent at all, get an id of ``None``.  Once
+        the cluster refuses the use counting script, uses are counted
+        without it as :py:meth:`add` does.
+        """
+        self._ensure_index()
+        if not self.scripted:
+            return self._index_uses(commands, username, host, **kwargs)
+        doc_type = self._doc_type(username)
+        actions = (
+            {
+                '_op_type': 'update',
+                '_index': self.index,
+                '_type': doc_type,
+                '_id': ElasticData._doc_id(command),
+                '_retry_on_conflict': self.RETRY_ON_CONFLICT,
+                '_source': self._use(command, username, host, **kwargs),
+            }
+            for command in commands
+        )
+        cmd_ids = []
+        refused = []
+        refusal = None
+        for position, (success, item) in enumerate(streaming_bulk(
+                self.elasticsearch, actions,
+                chunk_size=self.BULK_CHUNK_SIZE,
+                raise_on_error=False, raise_on_exception=False
+        )):
+            result = item['update']
+            if success:
+                cmd_ids.append(result['_id'])
+            elif script_refused(result.get('error')):
+                refused.append(position)
+                refusal = result['error']
+                cmd_ids.append(None)
+            else:
+                log.error('Failed to index command: %s', result)
+                cmd_ids.append(None)
+        if refused:
+            self._refuse_scripts(refusal)
+            for position, cmd_id in zip(refused, self._index_uses(
+                    [commands[x] for x in refused], username, host, **kwargs
+            )):
+                cmd_ids[position] = cmd_id
+        return cmd_ids
+
+    def update_meta(self, command_id, username, host, **kwargs):
+        """
+        Replace the command's meta, writing the document back at the
+        version it was read at so a use counted in between isn't lost,
+        and trying again ``RETRY_ON_CONFLICT`` times if one was.
+        """
+        self._ensure_index()
+        doc_type = self._doc_type(username)
+        for attempt in range(self.RETRY_ON_CONFLICT + 1):
+            try:
+                hit = self.elasticsearch.get(self.index, command_id, doc_type)
+            except NotFoundError:
+                raise KeyError(command_id)
+            document = hit['_source']
+            document['meta'] = kwargs
+            try:
+                # pylint: disable=unexpected-keyword-arg
+                self.elasticsearch.index(
+                    self.index, doc_type, document, id=command_id,
+                    version=hit['_version']
+                )
+                return
+            except ConflictError:
+                if attempt == self.RETRY_ON_CONFLICT:
+                    raise
+
     def delete(self, command_id, username, host, **kwargs):
         """
         Remove item from elasticsearch
         """
+        self._ensure_index()
         try:
             self.elasticsearch.delete(
                 self.index, self._doc_type(username), command_id
@@ -121,6 +507,7 @@ class ElasticData(HistoryData):
         """
         Pull one command out of elasticsearch
         """
+        self._ensure_index()
         try:
             hit = self.elasticsearch.get(
                 self.index, command_id, self._doc_type(username)
@@ -140,44 +527,266 @@ class ElasticData(HistoryData):
                 "match_all": {}
             }
         }
-        return self.filter(None, order, username, host, body, page)
+        return self.filter(
+            None, order, username, host, body, page,
+            cursor=kwargs.get('cursor')
+        )
 
-    def filter(self, term, order, username, host, body=None, page=0, **kwargs):
+    def _sort(self, order):
         """
-        Return filtered search that is ordered
+        Sort for a result ordering.  Clusters with ``search_after``
+        end it with a unique field, so that every hit has a distinct
+        position to continue after.  Older ones page by offset, which
+        doesn't need one, so they don't load fielddata for it.
         """
-        doc_type = self._doc_type(username)
-        sort = ''
         if order and order == 'r':
-            sort = 'timestamp:desc'
-        if not body:
-            body = {
-                'query': {
-                    'match_phrase_prefix': {
-                        'command': {
-                            'query': term,
-                            'max_expansions': self.NUM_RESULTS
-                        }
-                    }
-                }
-            }
-        # Implicitly we are sorting by score without order set, which
-        # is nice
+            sort = [{'timestamp': 'desc'}]
+            direction = 'desc'
+        elif order == 'f':
+            sort = [{'frecency': {'order': 'desc', 'missing': '_last'}}]
+            direction = 'desc'
+        else:
+            # Implicitly we are sorting by score without order set,
+            # which is nice
+            sort = ['_score']
+            direction = 'asc'
+        if self.search_after:
+            sort.append({self.TIEBREAKER_FIELD: direction})
+        return sort
+
+    @staticmethod
+    def _position(cursor):
+        """Decode a cursor made by :py:meth:`_next_cursor`.
+
+        Raises:
+            ValueError: If the cursor isn't one of ours
+
+        Returns:
+            list: ``['after', *sort_values]``, ``['from', offset]``,
+                ``['scroll', scroll_id]`` or ``None`` without a cursor.
+        """
+        if cursor is None:
+            return None
+        position = decode_cursor(cursor)
+        if len(position) < 2 or position[0] not in (
+                'after', 'from', 'scroll'
+        ):
+            raise ValueError('Invalid cursor')
+        if position[0] == 'from' and not (
+                isinstance(position[1], int) and position[1] >= 0
+        ):
+            raise ValueError('Invalid cursor')
+        return position
+
+    def _offset(self, page, position):
+        """
+        How many results into the ordering a page starts.
+        """
+        if position and position[0] == 'from':
+            return position[1]
+        return self.NUM_RESULTS * page
+
+    def _search_kwargs(self, body, page, position):
+        """
+        Where to start a search that isn't continuing a scroll, adding
+        ``search_after`` to the body if needed.  When
+        ``ELASTICSEARCH_SCROLL`` is set, the cursor of a first page
+        opens a scroll context, which starts at the beginning and is
+        scrolled on a page to the cursor's.  Deeper offsets would have
+        to scroll through every page before them, so they stay with
+        ``from``.
+        """
+        if position and position[0] == 'after':
+            body['search_after'] = position[1:]
+            return {'from_': 0}
+        offset = self._offset(page, position)
+        if position and self.scroll and offset == self.NUM_RESULTS:
+            return {'scroll': self.scroll}
+        return {'from_': offset}
+
+    def _next_cursor(self, results, offset):
+        """
+        Cursor to the page after a search response that started
+        ``offset`` results in.
+        """
+        hits = results['hits']['hits']
+        if '_scroll_id' in results:
+            return encode_cursor(['scroll', results['_scroll_id']])
+        if self.search_after and hits:
+            return encode_cursor(['after'] + hits[-1]['sort'])
+        return encode_cursor(['from', offset + self.NUM_RESULTS])
+
+    def _spent_scroll(self, results):
+        """
+        Scroll id of a response that was the last page of its scroll
+        context, which should be cleared rather than left to expire.
+        """
+        if len(results['hits']['hits']) < self.NUM_RESULTS:
+            return results.get('_scroll_id')
+        return None
+
+    def _result_page(self, results, offset=0):
+        """
+        Turn a search response that started ``offset`` results in into
+        a page of commands.
+        """
+        log_payload(log, 'Search response: %s', results)
+        results_list = ResultPage()
+        for hit in results['hits']['hits']:
+            result = hit['_source']
+            result['id'] = hit['_id']
+            result['score'] = hit['_score']
+            results_list.append(result)
+        if len(results_list) == self.NUM_RESULTS:
+            results_list.cursor = self._next_cursor(results, offset)
+        return results_list
+
+    def _scroll(self, scroll_id):
+        """Get the next page of a scroll context.
+
+        Raises:
+            ValueError: If the scroll context has expired.
+        """
         try:
             # pylint: disable=unexpected-keyword-arg
+            return self.elasticsearch.scroll(
+                scroll_id=scroll_id, scroll=self.scroll
+            )
+        except NotFoundError:
+            raise ValueError('Expired cursor')
+
+    def _search(self, doc_type, body, page, cursor):
+        """Run the search for a page of results.
+
+        Raises:
+            ValueError: If the cursor isn't one of ours or its scroll
+                context has expired.
+
+        Returns:
+            dict: The search response
+        """
+        position = self._position(cursor)
+        if position and position[0] == 'scroll':
+            results = self._scroll(position[1])
+        else:
+            kwargs = self._search_kwargs(body, page, position)
             results = self.elasticsearch.search(
                 index=self.index, doc_type=doc_type, size=self.NUM_RESULTS,
-                body=body, sort=sort, from_=self.NUM_RESULTS*page
+                body=body, **kwargs
             )
-        except (ESConnectionError, RequestError) as ex:
-            log.exception(ex)
-            return []
-        log.debug(results)
-        log.debug('Got %s hits for %s', results['hits']['total'], term)
-        results_list = []
-        for hit in results['hits']['hits']:
+            if 'scroll' in kwargs:
+                # Scroll on from the first page to the cursor's
+                if self._spent_scroll(results):
+                    results['hits']['hits'] = []
+                else:
+                    results = self._scroll(results['_scroll_id'])
+        scroll_id = self._spent_scroll(results)
+        if scroll_id:
+            # pylint: disable=unexpected-keyword-arg
+            self.elasticsearch.clear_scroll(scroll_id=scroll_id, ignore=404)
+        return results
+
+    def _query(self, term):
+        """
+        Query for commands containing ``term``.
+
+        With the n-gram subfield, the term's n-grams are matched as a
+        phrase, which only matches their consecutive run in commands
+        that contain the whole term anywhere.  Terms shorter than an
+        n-gram, or an index without the subfield, fall back to
+        matching the start of the command.
+        """
+        if self.ngram and len(term) >= self.NGRAM_SIZE:
+            return {
+                'match_phrase': {
+                    'command.ngram': {
+                        'query': term,
+                        'analyzer': 'command_ngram_analyzer'
+                    }
+                }
+            }
+        return {
+            'match_phrase_prefix': {
+                'command': {
+                    'query': term,
+                    'max_expansions': self.NUM_RESULTS
+                }
+            }
+        }
+
+    def export(self, username, host, term=None, since=None, until=None):
+        """
+        Export the user's commands with a scan of a scroll context,
+        ``BULK_CHUNK_SIZE`` hits from each shard at a time.  Scans
+        don't sort, so commands come out in no particular order.
+        """
+        # pylint: disable=too-many-arguments
+        self._ensure_index()
+        query = self._query(term) if term else {'match_all': {}}
+        timestamp = {}
+        if since is not None:
+            timestamp['gte'] = since.isoformat()
+        if until is not None:
+            timestamp['lt'] = until.isoformat()
+        if timestamp:
+            query = {
+                'filtered': {
+                    'query': query,
+                    'filter': {'range': {'timestamp': timestamp}}
+                }
+            }
+        for hit in scan(
+                self.elasticsearch, query={'query': query},
+                index=self.index, doc_type=self._doc_type(username),
+                scroll=self.EXPORT_SCROLL, size=self.BULK_CHUNK_SIZE
+        ):
             result = hit['_source']
             result['id'] = hit['_id']
-            result['score'] = hit['_score']
-            results_list.append(result)
-        return results_list
+            yield result
+
+    def filter(self, term, order, username, host, body=None, page=0,
+               cursor=None, **kwargs):
+        """
+        Return filtered search that is ordered.
+
+        Without a cursor this gets ``page`` with ``from``, which gets
+        slower the deeper the page.  On Elasticsearch 5 and up, the
+        cursor returned with each full page holds the sort values of
+        its last hit, and the next page is fetched with
+        ``search_after`` them, costing the same as the first page and
+        not shifting as new commands come in.  Older clusters don't
+        have ``search_after``, so their cursors hold the ``from`` of
+        the next page, and they sort without a tiebreaker.
+
+        When ``ELASTICSEARCH_SCROLL`` is set (for example ``1m``), the
+        first cursor sent back from an older cluster instead opens a
+        scroll context that is kept alive that long between pages, and
+        the cursor is its scroll id, so every page after the first
+        comes from the same point in time.  First pages, like every
+        keystroke in the search form, never open one, and a scroll
+        context is cleared as soon as its last page is read.
+
+        Raises:
+            ValueError: If the cursor isn't one of ours, has expired
+                or was rejected by Elasticsearch.
+        """
+        # pylint: disable=too-many-arguments
+        doc_type = self._doc_type(username)
+        if not body:
+            body = {'query': self._query(term)}
+        body['sort'] = self._sort(order)
+        try:
+            self._ensure_index()
+            results = self._search(doc_type, body, page, cursor)
+        except RequestError as ex:
+            log.exception(ex)
+            if cursor:
+                raise ValueError('Invalid cursor')
+            return ResultPage()
+        except ESConnectionError as ex:
+            log.exception(ex)
+            return ResultPage()
+        log.debug('Got %s hits for %s', results['hits']['total'], term)
+        return self._result_page(
+            results, self._offset(page, self._position(cursor))
+        )
@@ -0,0 +1,51 @@
+"""
+Frecency ranking: how often a command is used, with each use counting
+for less the longer ago it was.
+
+A command's score is the sum over its uses of ``2 ** -(age / half
+life)``.  Storing that score directly would mean rewriting every
+command's score as time passes, so instead we store its logarithm
+shifted by the time of the last use::
+
+    rank = log2(score at last use) + last use / half life
+
+Every command's score decays by the same factor as time goes on, so
+ordering by ``rank`` is ordering by score at any moment, and a rank
+only changes when its command is used again.  That makes it a plain
+stored field that data stores can index and sort on.
+"""
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import math
+
+import pytz
+
+# How long it takes a use to count for half as much
+HALF_LIFE = 7 * 24 * 60 * 60
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def seconds(when):
+    """
+    Seconds since the epoch of a UTC datetime.
+    """
+    return (when - EPOCH).total_seconds()
+
+
+def frecency(rank, when, half_life=HALF_LIFE):
+    """Rank of a command after using it once more.
+
+    Args:
+        rank (float): The command's current rank, or ``None`` if it
+            has never been used.
+        when (datetime.datetime): UTC time of this use
+        half_life (float): Seconds for a use to count for half as much
+
+    Returns:
+        float: The new rank
+    """
+    now = seconds(when) / half_life
+    if rank is None:
+        return now
+    return now + math.log(2 ** (rank - now) + 1, 2)
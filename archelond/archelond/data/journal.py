@@ -0,0 +1,338 @@
+"""
+Durable storage for the in memory data store: an append only log of
+every change, periodically compacted into a snapshot.
+"""
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import errno
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import pytz
+from six.moves import range  # pylint: disable=import-error,redefined-builtin
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# Document fields that hold datetimes
+DATETIME_FIELDS = ('timestamp', 'last_used')
+
+
+def dump_document(cmd_id, document):
+    """Make a stored command document JSON serializable.
+
+    Args:
+        cmd_id (str): Unique command identifier
+        document (dict): The command document as the data store holds it
+
+    Returns:
+        dict: A copy of the document with its ID and string datetimes
+    """
+    dumped = dict(document)
+    dumped['id'] = cmd_id
+    for key in DATETIME_FIELDS:
+        if key in document:
+            dumped[key] = document[key].strftime(TIMESTAMP_FORMAT)
+    return dumped
+
+
+def load_document(dumped):
+    """Reverse :py:func:`dump_document`.
+
+    Args:
+        dumped (dict): A document made by :py:func:`dump_document`
+
+    Returns:
+        tuple: The command ID and the document as the data store holds it
+    """
+    document = dict(dumped)
+    cmd_id = document.pop('id')
+    for key in DATETIME_FIELDS:
+        if key in document:
+            document[key] = datetime.strptime(
+                document[key], TIMESTAMP_FORMAT
+            ).replace(tzinfo=pytz.utc)
+    return cmd_id, document
+
+
+class Journal(object):
+    """Snapshot plus append only log in a directory.
+
+    The snapshot is a binary file of length prefixed JSON documents
+    that is memory mapped on load, so reading it doesn't copy the
+    whole file into Python.  Every change after it is appended to a
+    JSON lines log named for the snapshot's generation.  Taking a new
+    snapshot bumps the generation and starts an empty log, so a
+    restart only ever replays the changes made since the last
+    snapshot.  Snapshots can be written in the background, in which
+    case changes go on being logged to the new generation's log while
+    the snapshot is written, and a restart before it is finished
+    replays the logs of every generation after the last snapshot.  If
+    we die after writing a snapshot but before the old log is removed,
+    the old log is simply ignored.
+
+    Only one journal can use a directory at a time, which is enforced
+    with an exclusive lock on a file in it.
+    """
+    SNAPSHOT_NAME = 'snapshot'
+    LOG_NAME = 'log.{0}'
+    LOCK_NAME = 'lock'
+    MAGIC = b'ARCHSNP1'
+    # magic, generation, number of records
+    HEADER = struct.Struct('>8sQQ')
+    RECORD = struct.Struct('>I')
+
+    def __init__(self, path, fsync=False):
+        """Set up the journal directory.
+
+        Args:
+            path (str): Directory to keep the snapshot and log in
+            fsync (bool): ``fsync`` the log after every change instead
+                of just flushing it to the OS.
+
+        Raises:
+            IOError: If another journal has the directory locked
+        """
+        self.path = path
+        self.fsync = fsync
+        self.generation = 0
+        self.pending = 0
+        self.log_file = None
+        self.writer = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.lock_file = open(os.path.join(path, self.LOCK_NAME), 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as ex:
+            self.lock_file.close()
+            self.lock_file = None
+            if ex.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            raise IOError(
+                ex.errno,
+                'Journal {0} is in use by another process'.format(path)
+            )
+
+    def _snapshot_path(self):
+        """
+        Where the snapshot lives
+        """
+        return os.path.join(self.path, self.SNAPSHOT_NAME)
+
+    def _log_path(self, generation):
+        """
+        Where the log for a generation lives
+        """
+        return os.path.join(self.path, self.LOG_NAME.format(generation))
+
+    def _read_snapshot(self):
+        """Memory map the snapshot and yield its documents.
+
+        Yields:
+            dict: Dumped documents in the order they were written
+        """
+        path = self._snapshot_path()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return
+        with open(path, 'rb') as snapshot_file:
+            mapped = mmap.mmap(
+                snapshot_file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+            try:
+                magic, generation, count = self.HEADER.unpack_from(mapped, 0)
+                if magic != self.MAGIC:
+                    raise ValueError(
+                        'Not an archelond snapshot: {0}'.format(path)
+                    )
+                self.generation = generation
+                offset = self.HEADER.size
+                for _ in range(count):
+                    (length,) = self.RECORD.unpack_from(mapped, offset)
+                    offset += self.RECORD.size
+                    yield json.loads(
+                        mapped[offset:offset + length].decode('utf-8')
+                    )
+                    offset += length
+            finally:
+                mapped.close()
+
+    def _read_log(self):
+        """Yield the operations logged since the snapshot, from its
+        generation's log and those of any snapshots that weren't
+        finished, leaving the generation at the last of them.
+
+        Yields:
+            dict: Logged operations in order
+        """
+        for operation in self._read_log_file(self._log_path(self.generation)):
+            yield operation
+        while os.path.exists(self._log_path(self.generation + 1)):
+            self.generation += 1
+            for operation in self._read_log_file(
+                    self._log_path(self.generation)
+            ):
+                yield operation
+
+    def _read_log_file(self, path):
+        """Yield the operations in one log.
+
+        A line that doesn't parse can only be a write torn by a crash,
+        so it is cut off along with anything after it.
+
+        Yields:
+            dict: Logged operations in order
+        """
+        if not os.path.exists(path):
+            return
+        good_bytes = 0
+        with open(path, 'rb') as log_file:
+            for line in log_file:
+                try:
+                    operation = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    log.warning(
+                        'Truncating torn journal entry at byte %s of %s',
+                        good_bytes, path
+                    )
+                    break
+                good_bytes += len(line)
+                self.pending += 1
+                yield operation
+        if good_bytes != os.path.getsize(path):
+            with open(path, 'rb+') as log_file:
+                log_file.truncate(good_bytes)
+
+    def load(self):
+        """Read back everything stored.
+
+        Yields:
+            tuple: ``('snapshot', document)`` for every snapshot
+                document, then ``('log', operation)`` for every logged
+                operation after it.
+        """
+        for document in self._read_snapshot():
+            yield 'snapshot', document
+        for operation in self._read_log():
+            yield 'log', operation
+        self.log_file = open(self._log_path(self.generation), 'ab')
+
+    def append(self, *operations):
+        """Durably log changes.
+
+        All of the operations are written before flushing, so logging
+        a batch of changes costs one flush.
+
+        Args:
+            operations (dict): JSON serializable descriptions of changes
+        """
+        for operation in operations:
+            line = json.dumps(operation, separators=(',', ':')) + '\n'
+            self.log_file.write(line.encode('utf-8'))
+        self.log_file.flush()
+        if self.fsync:
+            os.fsync(self.log_file.fileno())
+        self.pending += len(operations)
+
+    def rotate(self):
+        """Start an empty log for the next generation, to log changes
+        to while a snapshot of everything before them is written.
+
+        Returns:
+            int: The new generation, to pass to :py:meth:`write_snapshot`
+        """
+        self.log_file.close()
+        self.generation += 1
+        self.log_file = open(self._log_path(self.generation), 'ab')
+        self.pending = 0
+        return self.generation
+
+    def snapshot(self, documents):
+        """Write a new snapshot and start an empty log after it.
+
+        Args:
+            documents (iterable): Dumped documents to write, in order
+        """
+        self.write_snapshot(self.rotate(), documents)
+
+    @property
+    def writing(self):
+        """
+        Whether a snapshot is being written in the background.
+        """
+        return self.writer is not None and self.writer.is_alive()
+
+    def snapshot_later(self, documents):
+        """Start an empty log now and write the snapshot from another
+        thread, so changes don't wait for it.
+
+        Args:
+            documents (iterable): Dumped documents to write, in order.
+                They are read from the other thread, so must not
+                change after this is called.
+        """
+        self.writer = threading.Thread(
+            target=self.write_snapshot,
+            args=(self.rotate(), documents),
+            name='archelond-journal-snapshot'
+        )
+        self.writer.daemon = True
+        self.writer.start()
+
+    def write_snapshot(self, generation, documents):
+        """Write the snapshot of a generation and remove the logs
+        before it.
+
+        The snapshot is written to a temporary file and renamed into
+        place, so a crash part way through leaves the old snapshot and
+        logs to recover from.
+
+        Args:
+            generation (int): Generation made by :py:meth:`rotate`
+            documents (iterable): Dumped documents to write, in order
+        """
+        path = self._snapshot_path()
+        temp_path = '{0}.tmp'.format(path)
+        count = 0
+        with open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(self.HEADER.pack(self.MAGIC, generation, 0))
+            for document in documents:
+                record = json.dumps(
+                    document, separators=(',', ':')
+                ).encode('utf-8')
+                snapshot_file.write(self.RECORD.pack(len(record)))
+                snapshot_file.write(record)
+                count += 1
+            snapshot_file.seek(0)
+            snapshot_file.write(
+                self.HEADER.pack(self.MAGIC, generation, count)
+            )
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.rename(temp_path, path)
+
+        old = generation - 1
+        while os.path.exists(self._log_path(old)):
+            os.remove(self._log_path(old))
+            old -= 1
+        log.info('Wrote journal snapshot %s of %s commands', generation, count)
+
+    def close(self):
+        """
+        Finish any snapshot being written, close the log file and
+        unlock the directory.
+        """
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
@@ -2,24 +2,180 @@
 In memory data store implementation for development and testing
 """
 from __future__ import absolute_import, unicode_literals
-from collections import OrderedDict
+from bisect import bisect_left, bisect_right
 from datetime import datetime
 import hashlib
+import itertools
 import logging
+import threading
 
 import pytz
+import six
+from six.moves import range  # pylint: disable=import-error,redefined-builtin
 
 from archelond.data.abstract import HistoryData
+from archelond.data.cursor import ResultPage, encode_cursor, decode_cursor
+from archelond.data.frecency import HALF_LIFE, frecency
+from archelond.data.journal import Journal, dump_document, load_document
+from archelond.data.trigram import TrigramIndex
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+class UserHistory(object):
+    """
+    One user's slice of the in memory store: their commands in order,
+    the trigram index over them, and accounting for how much they hold.
+
+    Order is kept as a list of command IDs alongside the ascending
+    sequence number each was added with.  Deletes leave a ``None``
+    hole behind that is compacted away once holes make up
+    ``COMPACT_RATIO`` of the list, and since sequence numbers never
+    change, a sequence number is a stable place to resume from with a
+    binary search.
+    """
+    COMPACT_RATIO = 0.5
+
+    def __init__(self):
+        """
+        Start out empty
+        """
+        self.data = {}
+        self.index = TrigramIndex()
+        self.sequence = {}
+        self.order = []
+        self.seqs = []
+        self.deleted = 0
+        self.size = 0
+        self._counter = itertools.count()
+
+    def __len__(self):
+        """
+        Number of commands held
+        """
+        return len(self.data)
+
+    def add(self, cmd_id, document):
+        """Store and index a command document.
+
+        Documents that are already stored are replaced in place and
+        keep their original position.
+
+        Args:
+            cmd_id (str): Unique command identifier
+            document (dict): The command document to store
+        """
+        if cmd_id not in self.data:
+            self.index.add(cmd_id, document['command'])
+            seq = next(self._counter)
+            self.sequence[cmd_id] = seq
+            self.order.append(cmd_id)
+            self.seqs.append(seq)
+            self.size += len(document['command'].encode('utf-8'))
+        self.data[cmd_id] = document
+
+    def remove(self, cmd_id):
+        """Remove a command, raising a KeyError if it isn't stored.
+
+        Args:
+            cmd_id (str): Unique command identifier
+        """
+        document = self.data.pop(cmd_id)
+        self.index.remove(cmd_id, document['command'])
+        seq = self.sequence.pop(cmd_id)
+        self.order[bisect_left(self.seqs, seq)] = None
+        self.deleted += 1
+        self.size -= len(document['command'].encode('utf-8'))
+        if self.deleted > len(self.order) * self.COMPACT_RATIO:
+            self._compact()
+
+    def _compact(self):
+        """
+        Drop the holes deletes have left in the order list.
+        """
+        keep = [
+            index for index, cmd_id in enumerate(self.order)
+            if cmd_id is not None
+        ]
+        self.order = [self.order[index] for index in keep]
+        self.seqs = [self.seqs[index] for index in keep]
+        self.deleted = 0
+
+    def walk(self, reverse=False, after=None):
+        """Iterate over command IDs in order.
+
+        Args:
+            reverse (bool): Go newest first instead of oldest first
+            after (int): Sequence number to start after (or before when
+                reversed).  Finding it is a binary search, so resuming
+                deep into the history is as cheap as starting at the
+                top.
+
+        Yields:
+            str: Command IDs
+        """
+        if reverse:
+            if after is None:
+                start = len(self.seqs) - 1
+            else:
+                start = bisect_left(self.seqs, after) - 1
+            positions = range(start, -1, -1)
+        else:
+            if after is None:
+                start = 0
+            else:
+                start = bisect_right(self.seqs, after)
+            positions = range(start, len(self.seqs))
+        for position in positions:
+            cmd_id = self.order[position]
+            if cmd_id is not None:
+                yield cmd_id
+
+    def stats(self):
+        """Accounting for this user's history.
+
+        Returns:
+            dict: Number of ``commands`` and result ``pages``, the
+                ``bytes`` of command text they hold and the number of
+                ``trigrams`` indexed.
+        """
+        return {
+            'commands': len(self.data),
+            'pages': -(-len(self.data) // HistoryData.NUM_RESULTS),
+            'bytes': self.size,
+            'trigrams': len(self.index.postings),
+        }
+
+
 class MemoryData(HistoryData):
     """
     A quick in memory deduplicated structure for standalone testing
     and development.
+
+    Each user gets their own :py:class:`UserHistory` partition, so a
+    query only costs as much as that user's history no matter how
+    much everyone else has stored.
+
+    Setting ``MEMORY_JOURNAL_PATH`` makes it durable.  Every change is
+    appended to a :py:class:`archelond.data.journal.Journal` in that
+    directory, a compact snapshot is taken every
+    ``MEMORY_SNAPSHOT_INTERVAL`` changes, and starting up loads the
+    snapshot and replays only the changes made after it.  Snapshots
+    are written from a background thread, and changes made meanwhile
+    are logged after them.
+
+    Everything is done holding one lock, so threaded servers can share
+    an instance.
+
+    Adding a command that is already stored updates it in place,
+    counting the use and bumping its
+    :py:mod:`archelond.data.frecency` rank for the ``f`` ordering.
     """
+    # Past this many index candidates it is cheaper to walk the data
+    # in order than to sort the candidates by sequence.
+    SORT_LIMIT = 4096
+
     INITIAL_DATA = [
         'cd',
         'pwd',
@@ -29,12 +185,27 @@ class MemoryData(HistoryData):
 
     def __init__(self, config):
         """
-        Initialize internal data structure with init data
+        Initialize internal data structure, and restore it from the
+        journal if one is configured.
         """
         super(MemoryData, self).__init__(config)
-        self.data = OrderedDict()
-        for item in self.INITIAL_DATA:
-            self.add(item, None, None)
+        self.users = {}
+        self.lock = threading.RLock()
+        self.journal = None
+        self.snapshot_interval = self.config.get(
+            'MEMORY_SNAPSHOT_INTERVAL', 10000
+        )
+        self.half_life = self.config.get('FRECENCY_HALF_LIFE', HALF_LIFE)
+        if self.config.get('MEMORY_JOURNAL_PATH'):
+            self.journal = Journal(
+                self.config['MEMORY_JOURNAL_PATH'],
+                fsync=self.config.get('MEMORY_JOURNAL_FSYNC', False)
+            )
+            try:
+                self._restore()
+            except Exception:
+                self.journal.close()
+                raise
 
     @staticmethod
     def _doc_id(command):
@@ -43,58 +214,332 @@ class MemoryData(HistoryData):
         """
         return hashlib.sha256(command.encode('utf-8')).hexdigest()
 
-    def add(self, command, username, host, **kwargs):
+    def _history(self, username, create=True):
+        """Get the partition for a user.
+
+        New partitions are seeded with ``INITIAL_DATA`` so that
+        everyone has something to look at.  Only changes should create
+        them, so looking up someone who has never added anything
+        doesn't store or journal anything for them.
+
+        Args:
+            username (str): The user to get the history of
+            create (bool): Create the partition if it doesn't exist,
+                otherwise raise a KeyError.
+
+        Returns:
+            UserHistory: The user's partition
         """
-        Append item to data list
+        history = self.users.get(username)
+        if history is None:
+            if not create:
+                raise KeyError(username)
+            history = self.users[username] = UserHistory()
+            for item in self.INITIAL_DATA:
+                self.add(item, username, None)
+        return history
+
+    def _restore(self):
         """
-        cmd_id = self._doc_id(command)
-        self.data[cmd_id] = {
+        Load the snapshot and replay the log after it.
+        """
+        for source, record in self.journal.load():
+            if source == 'snapshot' or record['op'] == 'add':
+                if source == 'log':
+                    record = record['document']
+                cmd_id, document = load_document(record)
+                history = self.users.get(document['username'])
+                if history is None:
+                    history = self.users[document['username']] = UserHistory()
+                history.add(cmd_id, document)
+            else:
+                self.users[record['username']].remove(record['id'])
+        log.info(
+            'Restored %s commands from journal',
+            sum(len(history) for history in self.users.values())
+        )
+
+    def _log_change(self, *operations):
+        """
+        Journal changes if we are durable, and snapshot when due,
+        unless the last snapshot is still being written.
+        """
+        if self.journal is None:
+            return
+        self.journal.append(*operations)
+        if (self.journal.pending >= self.snapshot_interval and
+                not self.journal.writing):
+            # Only references are taken holding the lock.  Stored
+            # documents are replaced rather than changed, so they are
+            # serialized from the other thread as they are now.
+            documents = [
+                (cmd_id, history.data[cmd_id])
+                for history in list(self.users.values())
+                for cmd_id in history.walk()
+            ]
+            self.journal.snapshot_later(
+                dump_document(cmd_id, document)
+                for cmd_id, document in documents
+            )
+
+    def stats(self, username):
+        """Page and memory accounting for a single user.
+
+        Args:
+            username (str): The user to report on
+
+        Returns:
+            dict: See :py:meth:`UserHistory.stats`, all zero for a
+                user without any history
+        """
+        with self.lock:
+            try:
+                return self._history(username, create=False).stats()
+            except KeyError:
+                return UserHistory().stats()
+
+    def _document(self, command, username, host, **kwargs):
+        """
+        Build the document we store for a command.
+        """
+        return {
             'command': command,
             'username': username,
             'host': host,
             'timestamp': datetime.utcnow().replace(tzinfo=pytz.utc),
             'meta': kwargs
         }
+
+    def _use(self, history, cmd_id, document):
+        """
+        Carry the use count and rank of a stored command over to its
+        new document, counting this use.
+        """
+        previous = history.data.get(cmd_id, {})
+        document['count'] = previous.get('count', 0) + 1
+        document['last_used'] = document['timestamp']
+        document['frecency'] = frecency(
+            previous.get('frecency'), document['timestamp'], self.half_life
+        )
+
+    def add(self, command, username, host, **kwargs):
+        """
+        Append item to the user's data list and index it, or update it
+        in place if it is already there.
+        """
+        cmd_id = self._doc_id(command)
+        document = self._document(command, username, host, **kwargs)
+        with self.lock:
+            history = self._history(username)
+            self._use(history, cmd_id, document)
+            history.add(cmd_id, document)
+            self._log_change(
+                {'op': 'add', 'document': dump_document(cmd_id, document)}
+            )
         return cmd_id
 
+    def bulk_add(self, commands, username, host, **kwargs):
+        """
+        Add all the commands to the user's data list in one go, only
+        taking the lock and journaling once.
+        """
+        added = [
+            (self._doc_id(command),
+             self._document(command, username, host, **kwargs))
+            for command in commands
+        ]
+        with self.lock:
+            history = self._history(username)
+            for cmd_id, document in added:
+                self._use(history, cmd_id, document)
+                history.add(cmd_id, document)
+            self._log_change(*[
+                {'op': 'add', 'document': dump_document(cmd_id, document)}
+                for cmd_id, document in added
+            ])
+        return [cmd_id for cmd_id, _ in added]
+
+    def update_meta(self, command_id, username, host, **kwargs):
+        """
+        Replace the command's meta in place, leaving its use count,
+        rank and position alone.
+        """
+        with self.lock:
+            history = self._history(username, create=False)
+            document = dict(history.data[command_id])
+            document['meta'] = kwargs
+            history.add(command_id, document)
+            self._log_change({
+                'op': 'add', 'document': dump_document(command_id, document)
+            })
+
     def delete(self, command_id, username, host, **kwargs):
         """
-        Remove key from internal dictionary
+        Remove key from the user's dictionary and index
         """
-        del self.data[command_id]
+        with self.lock:
+            self._history(username, create=False).remove(command_id)
+            self._log_change(
+                {'op': 'delete', 'id': command_id, 'username': username}
+            )
 
     def get(self, command_id, username, host, **kwargs):
         """
         Pull the specified command out of the data store.
         """
-        command = self.data[command_id]
+        with self.lock:
+            history = self._history(username, create=False)
+            command = history.data[command_id]
         command['id'] = command_id
         return command
 
     def all(self, order, username, host, page=0, **kwargs):
         """
-        Simply rewrap the data structure, order,  and return
+        Filter with no term, to get everything in order.
         """
-        if page != 0:
-            return []
-        return self.filter(None, order, username, host)
+        return self.filter(None, order, username, host, page=page, **kwargs)
 
-    def filter(self, term, order, username, host, page=0, **kwargs):
+    def export(self, username, host, term=None, since=None, until=None):
         """
-        Return filtered and reversed OrderedDict.
+        Export the user's commands in order.  Which commands to export
+        is worked out holding the lock, so the export is of one moment
+        in time however slowly it is read.
         """
-        # we reverse a list, and pylint thinks that is a type change...
-        # pylint: disable=redefined-variable-type
-        if page != 0:
-            return []
+        # pylint: disable=too-many-arguments
+        with self.lock:
+            try:
+                history = self._history(username, create=False)
+            except KeyError:
+                return iter([])
+            candidates = None
+            if term:
+                candidates = history.index.candidates(term)
+            documents = []
+            for cmd_id in history.walk():
+                if candidates is not None and cmd_id not in candidates:
+                    continue
+                document = history.data[cmd_id]
+                if term and term not in document['command']:
+                    continue
+                if not self._in_range(document['timestamp'], since, until):
+                    continue
+                document['id'] = cmd_id
+                documents.append(document)
+        return iter(documents)
 
-        if order and order == 'r':
-            ordered_set = reversed(list(self.data.items()))
-        else:
-            ordered_set = list(self.data.items())
-        result_list = []
-        for command_id, meta in ordered_set:
-            if term is None or term in meta['command']:
+    @staticmethod
+    def _rank(history, cmd_id):
+        """
+        Position of a command in the ``f`` ordering.
+        """
+        return (
+            history.data[cmd_id].get('frecency') or 0,
+            history.sequence[cmd_id]
+        )
+
+    def _frecent(self, history, candidates, after):
+        """
+        Command IDs from the most frecent, starting after the
+        ``(rank, sequence)`` position of a cursor.
+        """
+        if candidates is None:
+            candidates = history.data
+        ranked = sorted(
+            ((self._rank(history, cmd_id), cmd_id) for cmd_id in candidates),
+            reverse=True
+        )
+        return [
+            cmd_id for rank, cmd_id in ranked
+            if after is None or rank < after
+        ]
+
+    def filter(self, term, order, username, host, page=0, cursor=None,
+               **kwargs):
+        """
+        Return a page of filtered and optionally reversed commands.
+
+        Terms of at least three characters are looked up in the
+        trigram index, and only the candidates it returns are checked
+        for the substring.  Shorter terms, or no term at all, walk the
+        user's history in order.  When the term is so common that
+        sorting the candidates would cost more than walking the
+        history, we walk it and skip anything that isn't a candidate.
+
+        Pages hold at most ``NUM_RESULTS`` commands.  The cursor
+        returned with a full page resumes right after its last
+        command, so getting the next page doesn't revisit the ones
+        before it.  ``page`` still works for callers without a cursor,
+        but it has to skip over every earlier result to get there.
+
+        The ``f`` ordering sorts every match by rank, most frecent
+        first, so it costs as much as the number of matches.
+        """
+        # pylint: disable=too-many-arguments,too-many-branches
+        reverse = order == 'r'
+        frecent = order == 'f'
+        after = None
+        skip = page * self.NUM_RESULTS
+        if cursor is not None:
+            position = decode_cursor(cursor)
+            if frecent:
+                valid = (
+                    len(position) == 2 and
+                    isinstance(position[0], (float,) + six.integer_types) and
+                    isinstance(position[1], six.integer_types)
+                )
+                after = tuple(position)
+            else:
+                valid = (
+                    len(position) == 1 and
+                    isinstance(position[0], six.integer_types)
+                )
+                after = position[0] if valid else None
+            if not valid:
+                raise ValueError('Invalid cursor')
+            skip = 0
+
+        with self.lock:
+            try:
+                history = self._history(username, create=False)
+            except KeyError:
+                return ResultPage()
+            candidates = None
+            if term is not None:
+                candidates = history.index.candidates(term)
+            if frecent:
+                ordered_set = self._frecent(history, candidates, after)
+            elif (candidates is not None and
+                  len(candidates) < self.SORT_LIMIT):
+                sequence = history.sequence
+                ordered_set = sorted(
+                    candidates, key=sequence.get, reverse=reverse
+                )
+                if after is not None:
+                    ordered_set = [
+                        cmd_id for cmd_id in ordered_set
+                        if (sequence[cmd_id] < after if reverse
+                            else sequence[cmd_id] > after)
+                    ]
+            else:
+                ordered_set = history.walk(reverse, after)
+
+            results = ResultPage()
+            for command_id in ordered_set:
+                if candidates is not None and command_id not in candidates:
+                    continue
+                meta = history.data[command_id]
+                if term is not None and term not in meta['command']:
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
                 meta['id'] = command_id
-                result_list.append(meta)
-        return result_list
+                results.append(meta)
+                if len(results) == self.NUM_RESULTS:
+                    if frecent:
+                        position = list(self._rank(history, command_id))
+                    else:
+                        position = [history.sequence[command_id]]
+                    results.cursor = encode_cursor(position)
+                    break
+            return results
@@ -0,0 +1,146 @@
+"""
+Measure the calls made to any other data store.
+"""
+from __future__ import absolute_import, unicode_literals
+import time
+
+from archelond.data.abstract import HistoryData
+
+
+class MeteredData(HistoryData):
+    """Time every call to another data store.
+
+    Latency goes in the ``archelond_data_seconds`` histogram and
+    exceptions are counted in ``archelond_data_errors_total``, by
+    method (and exception).  The commands returned by ``all``,
+    ``filter`` and ``export`` are counted in
+    ``archelond_data_results_total``, and the size of every
+    ``bulk_add`` goes in ``archelond_bulk_size``.
+
+    Exports are timed from when they are asked for until the last
+    command has been read out of them.
+    """
+
+    def __init__(self, config, data, metrics):
+        """Wrap ``data`` and record to ``metrics``.
+
+        Args:
+            config (dict): The flask application configuration
+                dictionary.
+            data (HistoryData): The data store to measure
+            metrics (archelond.metrics.Metrics): Where to record
+        """
+        super(MeteredData, self).__init__(config)
+        self.data = data
+        self.metrics = metrics
+
+    def _call(self, method, *args, **kwargs):
+        """
+        Call and time a method of the wrapped data store.
+        """
+        start = time.time()
+        try:
+            return getattr(self.data, method)(*args, **kwargs)
+        except Exception as ex:
+            self.metrics.inc('archelond_data_errors_total', {
+                'method': method, 'error': type(ex).__name__
+            })
+            raise
+        finally:
+            self.metrics.observe(
+                'archelond_data_seconds', {'method': method},
+                time.time() - start
+            )
+
+    def _results(self, method, results):
+        """
+        Count the commands returned, and hand them back.
+        """
+        self.metrics.inc(
+            'archelond_data_results_total', {'method': method}, len(results)
+        )
+        return results
+
+    def bootstrap(self):
+        """
+        Bootstrap the data store we are wrapping.
+        """
+        return self._call('bootstrap')
+
+    def add(self, command, username, host, **kwargs):
+        """
+        Time adding the command.
+        """
+        return self._call('add', command, username, host, **kwargs)
+
+    def bulk_add(self, commands, username, host, **kwargs):
+        """
+        Time adding the commands and note how many there were.
+        """
+        self.metrics.observe(
+            'archelond_bulk_size', {'method': 'bulk_add'}, len(commands)
+        )
+        return self._call('bulk_add', commands, username, host, **kwargs)
+
+    def update_meta(self, command_id, username, host, **kwargs):
+        """
+        Time updating the command.
+        """
+        return self._call(
+            'update_meta', command_id, username, host, **kwargs
+        )
+
+    def delete(self, command_id, username, host, **kwargs):
+        """
+        Time deleting the command.
+        """
+        return self._call('delete', command_id, username, host, **kwargs)
+
+    def get(self, command_id, username, host, **kwargs):
+        """
+        Time getting the command.
+        """
+        return self._call('get', command_id, username, host, **kwargs)
+
+    def all(self, order, username, host, **kwargs):
+        """
+        Time and count a page of all commands.
+        """
+        return self._results('all', self._call(
+            'all', order, username, host, **kwargs
+        ))
+
+    def filter(self, term, order, username, host, **kwargs):
+        """
+        Time and count a page of matching commands.
+        """
+        return self._results('filter', self._call(
+            'filter', term, order, username, host, **kwargs
+        ))
+
+    def export(self, username, host, term=None, since=None, until=None):
+        """
+        Time and count the export as it is read.
+        """
+        # pylint: disable=too-many-arguments
+        start = time.time()
+        count = 0
+        try:
+            for result in self.data.export(
+                    username, host, term=term, since=since, until=until
+            ):
+                count += 1
+                yield result
+        except Exception as ex:
+            self.metrics.inc('archelond_data_errors_total', {
+                'method': 'export', 'error': type(ex).__name__
+            })
+            raise
+        finally:
+            self.metrics.observe(
+                'archelond_data_seconds', {'method': 'export'},
+                time.time() - start
+            )
+            self.metrics.inc(
+                'archelond_data_results_total', {'method': 'export'}, count
+            )
@@ -0,0 +1,409 @@
+"""
+SQLite implementation of the data store.  Indexed substring search
+without needing to run Elasticsearch.
+"""
+from __future__ import absolute_import, unicode_literals
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import pytz
+import six
+
+from archelond.data.abstract import HistoryData
+from archelond.data.cursor import ResultPage, encode_cursor, decode_cursor
+from archelond.data.frecency import HALF_LIFE, frecency
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS history (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id TEXT NOT NULL,
+        username TEXT NOT NULL,
+        command TEXT NOT NULL,
+        host TEXT,
+        timestamp TEXT NOT NULL,
+        meta TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 1,
+        last_used TEXT,
+        frecency REAL NOT NULL DEFAULT 0,
+        UNIQUE (username, id)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS history_user_time
+    ON history (username, timestamp, seq)
+    """,
+]
+
+# Columns added since the first schema, to add to older databases
+COLUMNS = [
+    ('count', 'INTEGER NOT NULL DEFAULT 1'),
+    ('last_used', 'TEXT'),
+    ('frecency', 'REAL NOT NULL DEFAULT 0'),
+]
+
+FRECENCY_INDEX = """
+    CREATE INDEX IF NOT EXISTS history_user_frecency
+    ON history (username, frecency, seq)
+"""
+
+FTS_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+        command, content='history', content_rowid='seq', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS history_fts_insert
+    AFTER INSERT ON history BEGIN
+        INSERT INTO history_fts (rowid, command)
+        VALUES (new.seq, new.command);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS history_fts_delete
+    AFTER DELETE ON history BEGIN
+        INSERT INTO history_fts (history_fts, rowid, command)
+        VALUES ('delete', old.seq, old.command);
+    END
+    """,
+]
+
+
+class SQLiteData(HistoryData):
+    """
+    A SQLite implementation of HistoryData.
+
+    Commands are stored in one table with an index on ``(username,
+    timestamp)`` for ordering and keyset paging, and an FTS5 trigram
+    index over ``command`` for substring search.  The database runs in
+    WAL mode so every application server process can read while
+    another writes.  Each thread gets its own connection, and so does
+    each process forked after the store was made.
+
+    Terms shorter than three characters can't use the trigram index
+    and are found by scanning the user's commands instead, as are all
+    terms if the SQLite library is too old to have the trigram
+    tokenizer (3.34.0).
+
+    Adding a command the user already has replaces its row, counting
+    the use and bumping its :py:mod:`archelond.data.frecency` rank,
+    which has an index of its own for the ``f`` ordering.
+    """
+    # Commands to look up at a time, under SQLite's variable limit
+    LOOKUP_CHUNK_SIZE = 500
+
+    def __init__(self, config):
+        """
+        Configure the database file and make sure the schema exists.
+        """
+        super(SQLiteData, self).__init__(config)
+        self.path = self.config.get('SQLITE_PATH', 'archelond.sqlite')
+        self.local = threading.local()
+        # Connections made before a fork, kept so they aren't closed
+        self.inherited = []
+        self.half_life = self.config.get('FRECENCY_HALF_LIFE', HALF_LIFE)
+        self.fts = True
+        connection = self._connection()
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+            existing = set(
+                row['name']
+                for row in connection.execute('PRAGMA table_info(history)')
+            )
+            for name, definition in COLUMNS:
+                if name not in existing:
+                    connection.execute(
+                        'ALTER TABLE history ADD COLUMN {0} {1}'.format(
+                            name, definition
+                        )
+                    )
+            connection.execute(FRECENCY_INDEX)
+        try:
+            with connection:
+                for statement in FTS_SCHEMA:
+                    connection.execute(statement)
+        except sqlite3.OperationalError as ex:
+            log.warning(
+                'SQLite %s has no FTS5 trigram index, searches will scan: %s',
+                sqlite3.sqlite_version, ex
+            )
+            self.fts = False
+        # Application servers fork their workers after loading the app,
+        # so don't leave a connection open for them to inherit
+        connection.close()
+        self.local.connection = None
+
+    def _connection(self):
+        """
+        Get the connection for this thread, opening it if needed or if
+        it was opened before this process was forked.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid != os.getpid():
+            # Closing the parent's connection could upset its locks
+            self.inherited.append(connection)
+            connection = None
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def _doc_id(command):
+        """
+        hash the command to make the id
+        """
+        return hashlib.sha256(command.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _user(username):
+        """
+        Usernames are part of the unique key, so can't be NULL.
+        """
+        return username or ''
+
+    @staticmethod
+    def _datetime(value):
+        """
+        Parse a stored timestamp.
+        """
+        return datetime.strptime(
+            value, TIMESTAMP_FORMAT
+        ).replace(tzinfo=pytz.utc)
+
+    def _document(self, row):
+        """
+        Turn a database row into a command dictionary.
+        """
+        return {
+            'id': row['id'],
+            'command': row['command'],
+            'username': row['username'] or None,
+            'host': row['host'],
+            'timestamp': self._datetime(row['timestamp']),
+            'meta': json.loads(row['meta']),
+            'count': row['count'],
+            'last_used': self._datetime(
+                row['last_used'] or row['timestamp']
+            ),
+            'frecency': row['frecency'],
+        }
+
+    def add(self, command, username, host, **kwargs):
+        """
+        Insert the command, or update it if the user already has it.
+        """
+        return self.bulk_add([command], username, host, **kwargs)[0]
+
+    def bulk_add(self, commands, username, host, **kwargs):
+        """
+        Insert or replace all the commands in a single transaction,
+        carrying over the use count and rank of any the user already
+        has.  A command repeated in the batch is stored once but
+        counted each time.
+        """
+        when = datetime.utcnow().replace(tzinfo=pytz.utc)
+        timestamp = when.strftime(TIMESTAMP_FORMAT)
+        meta = json.dumps(kwargs)
+        user = self._user(username)
+        cmd_ids = [self._doc_id(command) for command in commands]
+        connection = self._connection()
+        with connection:
+            # Hold the write lock from reading the counts on
+            connection.execute('BEGIN IMMEDIATE')
+            uses = self._uses(connection, user, list(set(cmd_ids)))
+            rows = OrderedDict()
+            for cmd_id, command in zip(cmd_ids, commands):
+                count, rank = uses.get(cmd_id, (0, None))
+                uses[cmd_id] = count + 1, frecency(
+                    rank, when, self.half_life
+                )
+                rows[cmd_id] = (
+                    cmd_id, user, command, host, timestamp, meta,
+                    timestamp
+                ) + uses[cmd_id]
+            connection.executemany(
+                'DELETE FROM history WHERE username = ? AND id = ?',
+                [(user, cmd_id) for cmd_id in rows]
+            )
+            connection.executemany(
+                'INSERT INTO history '
+                '(id, username, command, host, timestamp, meta, '
+                'last_used, count, frecency) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                list(rows.values())
+            )
+        return cmd_ids
+
+    def _uses(self, connection, user, cmd_ids):
+        """
+        Use count and rank of the commands the user already has.
+        """
+        uses = {}
+        for start in range(0, len(cmd_ids), self.LOOKUP_CHUNK_SIZE):
+            chunk = cmd_ids[start:start + self.LOOKUP_CHUNK_SIZE]
+            uses.update(
+                (row['id'], (row['count'], row['frecency']))
+                for row in connection.execute(
+                    'SELECT id, count, frecency FROM history '
+                    'WHERE username = ? AND id IN ({0})'.format(
+                        ', '.join('?' * len(chunk))
+                    ),
+                    [user] + chunk
+                )
+            )
+        return uses
+
+    def update_meta(self, command_id, username, host, **kwargs):
+        """
+        Replace the command's meta, raising a KeyError if it isn't
+        there.
+        """
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute(
+                'UPDATE history SET meta = ? WHERE username = ? AND id = ?',
+                (json.dumps(kwargs), self._user(username), command_id)
+            )
+        if cursor.rowcount == 0:
+            raise KeyError(command_id)
+
+    def delete(self, command_id, username, host, **kwargs):
+        """
+        Remove the command, raising a KeyError if it isn't there.
+        """
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute(
+                'DELETE FROM history WHERE username = ? AND id = ?',
+                (self._user(username), command_id)
+            )
+        if cursor.rowcount == 0:
+            raise KeyError(command_id)
+
+    def get(self, command_id, username, host, **kwargs):
+        """
+        Pull one command out of the database.
+        """
+        row = self._connection().execute(
+            'SELECT * FROM history WHERE username = ? AND id = ?',
+            (self._user(username), command_id)
+        ).fetchone()
+        if row is None:
+            raise KeyError(command_id)
+        return self._document(row)
+
+    def all(self, order, username, host, page=0, **kwargs):
+        """
+        Filter with no term, to get everything in order.
+        """
+        return self.filter(None, order, username, host, page=page, **kwargs)
+
+    def _clauses(self, term, username):
+        """
+        Where clauses and their parameters for the user's commands
+        containing ``term``.
+        """
+        clauses = ['username = ?']
+        params = [self._user(username)]
+        if term:
+            if self.fts and len(term) >= 3:
+                clauses.append(
+                    'seq IN (SELECT rowid FROM history_fts '
+                    'WHERE history_fts MATCH ?)'
+                )
+                params.append('"{0}"'.format(term.replace('"', '""')))
+            # The trigram index doesn't care about case, we do.
+            clauses.append('instr(command, ?) > 0')
+            params.append(term)
+        return clauses, params
+
+    def export(self, username, host, term=None, since=None, until=None):
+        """
+        Export the user's commands oldest first with a single query,
+        reading rows from it as they are sent.  WAL mode keeps the
+        query reading from one snapshot while others write.
+        """
+        # pylint: disable=too-many-arguments
+        clauses, params = self._clauses(term, username)
+        for operator, value in (('>=', since), ('<', until)):
+            if value is not None:
+                clauses.append('timestamp {0} ?'.format(operator))
+                params.append(value.strftime(TIMESTAMP_FORMAT))
+        rows = self._connection().execute(
+            'SELECT * FROM history WHERE {0} '
+            'ORDER BY timestamp, seq'.format(' AND '.join(clauses)),
+            params
+        )
+        for row in rows:
+            yield self._document(row)
+
+    def filter(self, term, order, username, host, page=0, cursor=None,
+               **kwargs):
+        """
+        Return a page of commands containing ``term``, oldest first
+        unless reversed.
+
+        The cursor returned with a full page holds the timestamp and
+        row of its last command, so the next page starts there in the
+        ``(username, timestamp)`` index instead of counting through
+        the pages before it.  The ``f`` ordering is most frecent first,
+        and its cursor holds the rank and row instead.
+        """
+        # pylint: disable=too-many-arguments
+        descending = order == 'r'
+        frecent = order == 'f'
+        if frecent:
+            sort_column, sort_type = 'frecency', (float,) + six.integer_types
+        else:
+            sort_column, sort_type = 'timestamp', six.string_types
+        clauses, params = self._clauses(term, username)
+
+        offset = page * self.NUM_RESULTS
+        if cursor is not None:
+            position = decode_cursor(cursor)
+            if (len(position) != 2 or
+                    not isinstance(position[0], sort_type) or
+                    not isinstance(position[1], six.integer_types)):
+                raise ValueError('Invalid cursor')
+            clauses.append(
+                '({0}, seq) {1} (?, ?)'.format(
+                    sort_column, '<' if descending or frecent else '>'
+                )
+            )
+            params.extend(position)
+            offset = 0
+
+        direction = 'DESC' if descending or frecent else 'ASC'
+        rows = self._connection().execute(
+            'SELECT * FROM history WHERE {where} '
+            'ORDER BY {column} {direction}, seq {direction} '
+            'LIMIT ? OFFSET ?'.format(
+                where=' AND '.join(clauses), column=sort_column,
+                direction=direction
+            ),
+            params + [self.NUM_RESULTS, offset]
+        ).fetchall()
+
+        results = ResultPage(self._document(row) for row in rows)
+        if len(rows) == self.NUM_RESULTS:
+            results.cursor = encode_cursor(
+                [rows[-1][sort_column], rows[-1]['seq']]
+            )
+        return results
@@ -0,0 +1,101 @@
+"""
+Trigram posting list index for substring searching of commands
+"""
+from __future__ import absolute_import, unicode_literals
+
+
+class TrigramIndex(object):
+    """Incremental inverted index of command trigrams.
+
+    Every command is broken up into the set of three character
+    substrings it contains, and each of those trigrams keeps a posting
+    set of the command IDs that contain it.  Any command containing a
+    search term must contain every trigram of that term, so
+    intersecting the postings of the term's trigrams gives a (usually
+    tiny) candidate set that only needs to be confirmed with a real
+    substring check.
+
+    Terms shorter than :py:const:`TrigramIndex.GRAM_SIZE` have no
+    trigrams, and callers are expected to fall back to scanning.
+    """
+    GRAM_SIZE = 3
+
+    def __init__(self):
+        """
+        Start with an empty set of postings
+        """
+        self.postings = {}
+
+    @classmethod
+    def trigrams(cls, text):
+        """Split text into the set of its unique trigrams.
+
+        Args:
+            text (str): The string to break up.
+
+        Returns:
+            set: The unique trigrams in ``text``, empty if it is too
+                short to have any.
+        """
+        return set(
+            text[index:index + cls.GRAM_SIZE]
+            for index in range(len(text) - cls.GRAM_SIZE + 1)
+        )
+
+    def add(self, command_id, command):
+        """Index a command.
+
+        Args:
+            command_id (str): Unique command identifier
+            command (str): The command to index
+        """
+        for gram in self.trigrams(command):
+            self.postings.setdefault(gram, set()).add(command_id)
+
+    def remove(self, command_id, command):
+        """Remove a command from the index.
+
+        Postings that become empty are dropped so the index doesn't
+        grow without bound as commands come and go.
+
+        Args:
+            command_id (str): Unique command identifier
+            command (str): The command that was indexed for the ID
+        """
+        for gram in self.trigrams(command):
+            posting = self.postings.get(gram)
+            if posting is None:
+                continue
+            posting.discard(command_id)
+            if not posting:
+                del self.postings[gram]
+
+    def candidates(self, term):
+        """Get the IDs of commands that may contain ``term``.
+
+        Args:
+            term (str): The term being searched for.
+
+        Returns:
+            set: IDs of commands containing every trigram of the
+                term, or ``None`` if the term is too short to use the
+                index.
+        """
+        grams = self.trigrams(term)
+        if not grams:
+            return None
+        postings = []
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if not posting:
+                return set()
+            postings.append(posting)
+        # Intersect from the smallest posting up to keep the working
+        # set as small as possible.
+        postings.sort(key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            result.intersection_update(posting)
+            if not result:
+                break
+        return result
@@ -1,21 +1,171 @@
 """
 Configure logging
+
+Records are put on a queue by the thread logging them, and formatted
+and written to syslog by a listener thread, so requests don't wait on
+either.  Threads don't survive a fork, so the first record logged in
+a forked worker starts a queue and listener thread of its own.  Large
+payloads, such as Elasticsearch responses, should be logged with
+:py:func:`log_payload` so they are sampled and cut short.
 """
 # pylint: disable=ungrouped-imports
 from __future__ import absolute_import, unicode_literals
+import atexit
+import itertools
 import logging
 import os
 import platform
+import sys
+import threading
 from logging.handlers import SysLogHandler
 
+from six.moves import queue, reprlib
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:  # pragma: no cover
+    # Python 2 logs from the request thread
+    QueueHandler = QueueListener = None  # pylint: disable=invalid-name
+
+DEFAULT_LOG_LEVEL = 'INFO'
+
+# Log one payload in this many, and at most this many characters of it
+PAYLOAD_SAMPLE = 10
+PAYLOAD_MAX_SIZE = 1024
+
+_PAYLOAD_COUNT = itertools.count()
+# Only look as far into payloads as we could end up logging
+_PAYLOAD_REPR = reprlib.Repr()
+_PAYLOAD_REPR.maxlevel = 4
+_PAYLOAD_REPR.maxdict = _PAYLOAD_REPR.maxlist = 16
+_PAYLOAD_REPR.maxstring = _PAYLOAD_REPR.maxother = 256
+
+_LISTENERS = []
+
+if QueueHandler is not None:
+    class RecordQueueHandler(QueueHandler):
+        """
+        Queue records with their message merged, leaving the rest of
+        the formatting to the listener thread.
+        """
+
+        def prepare(self, record):
+            """
+            Merge the arguments into the message now, in case they
+            change before the listener gets to them.
+            """
+            record.msg = record.getMessage()
+            record.args = None
+            return record
+
+        def enqueue(self, record):
+            """
+            Queue a record, once this process has a listener reading
+            the queue.
+            """
+            self.listener.check_process()
+            self.queue.put_nowait(record)
+
+    class RecordQueueListener(QueueListener):
+        """
+        Listener that waits for room in a full queue to stop, instead
+        of failing, and that knows which process started its thread.
+        """
+
+        def __init__(self, record_queue, *handlers):
+            """
+            Set up, but don't start, the listener.
+            """
+            QueueListener.__init__(self, record_queue, *handlers)
+            self.lock = threading.Lock()
+            self.pid = None
+            self.queue_handler = None
+
+        def start(self):
+            """
+            Start the listener thread in this process.
+            """
+            self.pid = os.getpid()
+            QueueListener.start(self)
+
+        def check_process(self):
+            """
+            Give a forked process its own queue and listener thread,
+            since the ones it inherited don't run in it.  Application
+            servers fork their workers after loading the app.
+            """
+            if self.pid == os.getpid():
+                return
+            with self.lock:
+                if self.pid == os.getpid():
+                    return
+                self._thread = None
+                self.queue = self.queue_handler.queue = queue.Queue(
+                    self.queue.maxsize
+                )
+                self.start()
+
+        def enqueue_sentinel(self):
+            """
+            Queue the message that stops the listener thread.
+            """
+            self.queue.put(self._sentinel)
+
+
+def log_payload(logger, message, payload, level=logging.DEBUG):
+    """Log a sample of large payloads, cut down to size.
+
+    Nothing is formatted unless ``logger`` is enabled for ``level``,
+    and then only one payload in ``LOG_PAYLOAD_SAMPLE`` is logged,
+    with at most ``LOG_PAYLOAD_MAX_SIZE`` characters of it.
+
+    Args:
+        logger (logging.Logger): Logger to log to
+        message (str): Message with one ``%s`` for the payload
+        payload (object): Payload to log
+        level (int): Level to log at
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if next(_PAYLOAD_COUNT) % PAYLOAD_SAMPLE:
+        return
+    text = _PAYLOAD_REPR.repr(payload)
+    if len(text) > PAYLOAD_MAX_SIZE:
+        text = text[:PAYLOAD_MAX_SIZE] + '...'
+    logger.log(level, message, text)
+
+
+def _stop_listener():
+    """
+    Stop the listener thread, writing out anything still queued.
+    """
+    while _LISTENERS:
+        listener = _LISTENERS.pop()
+        # pylint: disable=protected-access
+        # A thread started before a fork isn't ours to stop
+        if listener._thread is not None and listener.pid == os.getpid():
+            listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+atexit.register(_stop_listener)
+
 
 def configure_logging(app):
     """
-    Set the log level for the application
+    Set the log level for the application, and start logging to
+    stderr and syslog from a listener thread.  ``LOG_LEVEL`` defaults
+    to ``INFO``, so debug messages aren't formatted in production.
+
+    The listener is available as ``app.log_listener``, or is ``None``
+    on Python 2, where handlers are called directly.
     """
+    # pylint: disable=global-statement
+    global PAYLOAD_SAMPLE, PAYLOAD_MAX_SIZE
 
     # Disable log exceptions due to overly long elasticsearch
-    # log messages
+    # log messages, or a full queue
     logging.raiseExceptions = False
     # Set up format for default logging
     hostname = platform.node().split('.')[0]
@@ -23,27 +173,12 @@ def configure_logging(app):
                  '%(filename)s:%(lineno)d - '
                  '{hostname}- %(message)s').format(hostname=hostname)
 
-    # Grab config from env if set, else allow system/language
-    # defaults.
-    config_log_level = app.config.get('LOG_LEVEL', None)
-    config_log_int = None
-    set_level = None
-
-    if config_log_level:
-        config_log_int = getattr(logging, config_log_level.upper(), None)
-        if not isinstance(config_log_int, int):
-            raise ValueError('Invalid log level: {0}'.format(config_log_level))
-        set_level = config_log_int
-
-    # Set to NotSet if we still aren't set yet
-    if not set_level:
-        set_level = config_log_int = logging.NOTSET
-
-    # Setup logging with format and main and change the root logger if
-    # we aren't.
-    logging.basicConfig(format=formatter)
-    root_logger = logging.getLogger()
-    root_logger.setLevel(set_level)
+    config_log_level = app.config.get('LOG_LEVEL') or DEFAULT_LOG_LEVEL
+    config_log_int = getattr(logging, config_log_level.upper(), None)
+    if not isinstance(config_log_int, int):
+        raise ValueError('Invalid log level: {0}'.format(config_log_level))
+    PAYLOAD_SAMPLE = max(int(app.config.get('LOG_PAYLOAD_SAMPLE', 10)), 1)
+    PAYLOAD_MAX_SIZE = int(app.config.get('LOG_PAYLOAD_MAX_SIZE', 1024))
 
     address = None
     if os.path.exists('/dev/log'):
@@ -52,12 +187,40 @@ def configure_logging(app):
         address = '/var/run/syslog'
     else:
         address = ('127.0.0.1', 514)  # pylint: disable=redefined-variable-type
-    # Add syslog handler before adding formatters
-    root_logger.addHandler(
+    handlers = [
         SysLogHandler(address=address, facility=SysLogHandler.LOG_LOCAL0)
-    )
+    ]
 
-    for handler in root_logger.handlers:
+    # Replace what we set up last time
+    root_logger = logging.getLogger()
+    root_logger.setLevel(config_log_int)
+    _stop_listener()
+    for handler in list(root_logger.handlers):
+        if getattr(handler, 'archelond', False):
+            root_logger.removeHandler(handler)
+            handler.close()
+    # Log to stderr too, unless something else already handles logs
+    if not root_logger.handlers:
+        handlers.append(logging.StreamHandler(sys.stderr))
+    for handler in handlers:
         handler.setFormatter(logging.Formatter(formatter))
 
+    app.log_listener = None
+    if QueueHandler is None:  # pragma: no cover
+        for handler in handlers:
+            handler.archelond = True
+            root_logger.addHandler(handler)
+        return config_log_int
+
+    queue_handler = RecordQueueHandler(
+        queue.Queue(int(app.config.get('LOG_QUEUE_SIZE', 10000)))
+    )
+    queue_handler.archelond = True
+    listener = RecordQueueListener(queue_handler.queue, *handlers)
+    listener.queue_handler = queue_handler
+    queue_handler.listener = listener
+    listener.start()
+    _LISTENERS.append(listener)
+    root_logger.addHandler(queue_handler)
+    app.log_listener = listener
     return config_log_int
@@ -0,0 +1,420 @@
+"""
+Request, data store and cache metrics, served in the Prometheus text
+format from ``/metrics``.
+
+Every process counts for itself.  With ``METRICS_PATH`` set, each
+process also writes its metrics to its own file in that directory
+every ``METRICS_FLUSH_INTERVAL`` seconds, and ``/metrics`` adds up the
+files of every process, so any uwsgi worker can be scraped for the
+whole server.  Files are left behind when processes exit so their
+counts aren't lost, so empty the directory when restarting the
+server.
+"""
+from __future__ import absolute_import, unicode_literals
+import atexit
+from bisect import bisect_left
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from flask import g, request
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0,
+)
+SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+# Type, help and (for histograms) buckets of every metric
+METRICS = {
+    'archelond_requests_total': (
+        'counter', 'Requests by route, method and status', None,
+    ),
+    'archelond_request_seconds': (
+        'histogram', 'Request latency by route and method', LATENCY_BUCKETS,
+    ),
+    'archelond_data_seconds': (
+        'histogram', 'Data store call latency by method', LATENCY_BUCKETS,
+    ),
+    'archelond_data_errors_total': (
+        'counter', 'Data store calls that raised by method', None,
+    ),
+    'archelond_data_results_total': (
+        'counter', 'Commands returned by the data store by method', None,
+    ),
+    'archelond_bulk_size': (
+        'histogram', 'Commands in each bulk add', SIZE_BUCKETS,
+    ),
+    'archelond_auth_cache_hits_total': (
+        'counter', 'Credentials found in the authentication cache', None,
+    ),
+    'archelond_auth_cache_misses_total': (
+        'counter', 'Credentials checked against the htpasswd file', None,
+    ),
+    'archelond_auth_cache_evictions_total': (
+        'counter', 'Credentials dropped from the cache to make room', None,
+    ),
+    'archelond_auth_cache_invalidations_total': (
+        'counter', 'Credentials dropped when the htpasswd file changed',
+        None,
+    ),
+    'archelond_search_cache_hits_total': (
+        'counter', 'Searches answered from the search result cache', None,
+    ),
+    'archelond_search_cache_misses_total': (
+        'counter', 'Searches passed on to the data store', None,
+    ),
+    'archelond_search_cache_evictions_total': (
+        'counter', 'Cached searches dropped to make room', None,
+    ),
+    'archelond_search_cache_invalidations_total': (
+        'counter', 'Cached searches dropped when their history changed',
+        None,
+    ),
+}
+
+
+def _labels(labels):
+    """
+    Hashable, ordered form of a label dictionary.
+    """
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    """
+    Escape a label value for the text format.
+    """
+    return '{0}'.format(value).replace('\\', r'\\').replace(
+        '"', r'\"'
+    ).replace('\n', r'\n')
+
+
+def _format_labels(labels, extra=()):
+    """
+    Label pairs in the text format, including the braces.
+    """
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(key, _escape(value)) for key, value in pairs
+    ))
+
+
+def _format_value(value):
+    """
+    Number in the text format.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return '{0}'.format(int(value))
+    return repr(float(value))
+
+
+class Metrics(object):
+    """Counters and histograms of one process.
+
+    Counters are keyed by name and labels.  Histograms keep a count
+    for each of their buckets (not cumulative), then their sum and
+    count.  Collectors are functions called for each snapshot that
+    return counters kept somewhere else, as ``(name, labels, value)``.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, config):
+        """Set up empty metrics.
+
+        Args:
+            config (dict): The flask application configuration
+                dictionary.
+        """
+        self.path = config.get('METRICS_PATH')
+        self.interval = float(config.get('METRICS_FLUSH_INTERVAL', 1))
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self.pid = None
+        self.filename = None
+        self.thread = None
+        atexit.register(self.write)
+
+    def _check_process(self):
+        """
+        Start over in a new process, since the counts we have belong
+        to the process we were forked from.  Must be called with the
+        lock held.
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.counters = {}
+        self.histograms = {}
+        if not self.path:
+            return
+        self.filename = os.path.join(self.path, '{0}-{1}.json'.format(
+            self.pid, uuid.uuid4().hex
+        ))
+        self.thread = threading.Thread(
+            target=self._run, name='archelond-metrics-writer'
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def inc(self, name, labels, amount=1):
+        """Add to a counter.
+
+        Args:
+            name (str): Metric name from ``METRICS``
+            labels (dict): Labels of the counter
+            amount (float): How much to add
+        """
+        key = (name, _labels(labels))
+        with self.lock:
+            self._check_process()
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        """Count a value in a histogram.
+
+        Args:
+            name (str): Metric name from ``METRICS``
+            labels (dict): Labels of the histogram
+            value (float): What was measured
+        """
+        buckets = METRICS[name][2]
+        key = (name, _labels(labels))
+        with self.lock:
+            self._check_process()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [
+                    [0] * (len(buckets) + 1), 0.0, 0
+                ]
+            histogram[0][bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def add_collector(self, collector):
+        """Add counters kept by something else, such as a cache.
+
+        Args:
+            collector (function): Called without arguments, returns
+                an iterable of ``(name, labels, value)``
+        """
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        """This process's metrics in a form that can be saved as JSON.
+
+        Returns:
+            dict: ``counters`` as ``[name, labels, value]`` and
+                ``histograms`` as ``[name, labels, buckets, sum,
+                count]``, with labels as lists of pairs.
+        """
+        counters = {}
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                key = (name, _labels(labels))
+                counters[key] = counters.get(key, 0) + value
+        with self.lock:
+            self._check_process()
+            for key, value in self.counters.items():
+                counters[key] = counters.get(key, 0) + value
+            histograms = [
+                [name, labels, list(histogram[0]), histogram[1], histogram[2]]
+                for (name, labels), histogram in self.histograms.items()
+            ]
+        return {
+            'counters': [
+                [name, labels, value]
+                for (name, labels), value in counters.items()
+            ],
+            'histograms': histograms,
+        }
+
+    def write(self):
+        """
+        Save this process's metrics to its file, replacing the file
+        in one step so it is never read half written.
+        """
+        if not self.filename or self.pid != os.getpid():
+            return
+        snapshot = self.snapshot()
+        temp = '{0}.tmp'.format(self.filename)
+        try:
+            with open(temp, 'w') as metrics_file:
+                json.dump(snapshot, metrics_file)
+            os.rename(temp, self.filename)
+        except (IOError, OSError):
+            log.exception('Failed writing metrics to %s', self.filename)
+
+    def _run(self):
+        """
+        Write out changes forever, never letting an error kill the
+        thread.
+        """
+        while True:
+            time.sleep(self.interval)
+            # Collectors can change without us knowing, so keep writing
+            try:
+                self.write()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Failed writing metrics')
+
+    def collect(self):
+        """Add up the metrics of every process.
+
+        Returns:
+            tuple: Dictionaries of counter values and of histograms,
+                both keyed by name and labels.
+        """
+        snapshots = [self.snapshot()]
+        if self.path:
+            for filename in glob.glob(os.path.join(self.path, '*.json')):
+                if filename == self.filename:
+                    continue
+                try:
+                    with open(filename) as metrics_file:
+                        snapshots.append(json.load(metrics_file))
+                except (IOError, OSError, ValueError):
+                    log.warning('Skipping unreadable metrics %s', filename)
+
+        counters, histograms = {}, {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, buckets, total, count in snapshot['histograms']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histograms[key] = [list(buckets), total, count]
+                    continue
+                histogram[0] = [x + y for x, y in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+        return counters, histograms
+
+    def render(self):
+        """Every process's metrics in the Prometheus text format.
+
+        Returns:
+            str: The metrics
+        """
+        counters, histograms = self.collect()
+        lines = []
+        for name in sorted(METRICS):
+            metric_type, description, buckets = METRICS[name]
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            if metric_type == 'counter':
+                for (key_name, labels), value in sorted(counters.items()):
+                    if key_name == name:
+                        lines.append('{0}{1} {2}'.format(
+                            name, _format_labels(labels), _format_value(value)
+                        ))
+                continue
+            for (key_name, labels), histogram in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(
+                        list(buckets) + [float('inf')], histogram[0]
+                ):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name,
+                        _format_labels(labels, [('le', _format_value(bound))]),
+                        cumulative
+                    ))
+                lines.append('{0}_sum{1} {2}'.format(
+                    name, _format_labels(labels), _format_value(histogram[1])
+                ))
+                lines.append('{0}_count{1} {2}'.format(
+                    name, _format_labels(labels), histogram[2]
+                ))
+        return '\n'.join(lines) + '\n'
+
+    def init_app(self, app):
+        """Count and time every request to a Flask application.
+
+        Routes are labelled by their endpoint, and requests that
+        didn't match one as ``none``.  Streamed responses are timed
+        until they start.
+
+        Args:
+            app (flask.Flask): Application to measure
+        """
+        app.metrics = self
+
+        @app.before_request
+        def start_timer():
+            # pylint: disable=unused-variable
+            """Note when the request started."""
+            g.metrics_start = time.time()
+
+        @app.after_request
+        def record_request(response):
+            # pylint: disable=unused-variable
+            """Count and time the request."""
+            self._record_request(response.status_code)
+            return response
+
+        @app.teardown_request
+        def record_error(exception):
+            # pylint: disable=unused-variable
+            """Count and time requests that raised."""
+            if exception is not None:
+                self._record_request(500)
+
+    def _record_request(self, status_code):
+        """
+        Count and time the current request, once.
+        """
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return
+        labels = {
+            'route': request.endpoint or 'none',
+            'method': request.method,
+        }
+        self.observe('archelond_request_seconds', labels, time.time() - start)
+        labels['status'] = status_code
+        self.inc('archelond_requests_total', labels)
+
+
+def cache_collector(prefix, cache):
+    """Collector of the hit, miss, eviction and invalidation counters
+    of a cache.
+
+    Args:
+        prefix (str): Metric name up to ``_hits_total``
+        cache (object): Anything with a ``cache_stats`` method, such as
+            :py:class:`archelond.data.CachedData` or
+            :py:class:`archelond.auth.CachedHtPasswdAuth`
+
+    Returns:
+        function: Collector for :py:meth:`Metrics.add_collector`
+    """
+    def collect():
+        """Read the cache's counters."""
+        stats = cache.cache_stats()
+        return [
+            ('{0}_hits_total'.format(prefix), {}, stats['hits']),
+            ('{0}_misses_total'.format(prefix), {}, stats['misses']),
+            ('{0}_evictions_total'.format(prefix), {}, stats['evictions']),
+            (
+                '{0}_invalidations_total'.format(prefix), {},
+                stats['invalidations']
+            ),
+        ]
+    return collect
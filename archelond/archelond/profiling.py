@@ -0,0 +1,148 @@
+"""
+Profile a sample of requests, for finding where the time goes when
+latency gets worse in production.
+"""
+from __future__ import absolute_import, unicode_literals
+import cProfile
+import hmac
+import itertools
+import logging
+import os
+import re
+import time
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def _bytes(value, encoding):
+    """
+    Encode text to compare, leaving what is already bytes alone.  WSGI
+    header values are text decoded as latin-1 on Python 3.
+    """
+    if isinstance(value, bytes):
+        return value
+    return value.encode(encoding)
+
+
+class SamplingProfiler(object):
+    """WSGI middleware that profiles one in ``PROFILE_SAMPLE`` requests.
+
+    When ``PROFILE_SECRET`` is set, requests with it in the
+    ``PROFILE_HEADER`` header (``X-Archelond-Profile`` by default) are
+    always profiled, and a ``PROFILE_SAMPLE`` of 0 only profiles those.
+    Each profile is written to ``PROFILE_PATH`` as a ``pstats`` file
+    named for when it started, the process, the request and how long
+    it took, which ``python -m pstats``, snakeviz or flameprof can
+    read.  Streamed responses are profiled until the last of them is
+    sent.  Nothing more is profiled once ``PROFILE_MAX_FILES`` profiles
+    are in the directory, until some are cleared out.
+
+    Only wrap the application when ``PROFILE_PATH`` is set, so requests
+    don't pay anything for it otherwise.
+    """
+
+    def __init__(self, app, config):
+        """Wrap a WSGI application.
+
+        Args:
+            app (function): WSGI application to profile
+            config (dict): The flask application configuration
+                dictionary.
+        """
+        self.app = app
+        self.path = config['PROFILE_PATH']
+        self.sample = int(config.get('PROFILE_SAMPLE', 0))
+        self.secret = config.get('PROFILE_SECRET')
+        self.max_files = int(config.get('PROFILE_MAX_FILES', 1000))
+        self.header = 'HTTP_{0}'.format(
+            config.get('PROFILE_HEADER', 'X-Archelond-Profile')
+            .upper().replace('-', '_')
+        )
+        self.count = itertools.count(1)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _asked(self, environ):
+        """
+        Whether the request asked to be profiled with the secret.
+        """
+        if not self.secret or self.header not in environ:
+            return False
+        return hmac.compare_digest(
+            _bytes(environ[self.header], 'latin-1'),
+            _bytes(self.secret, 'utf-8')
+        )
+
+    def _full(self):
+        """
+        Whether there are as many profiles as we are allowed to keep.
+        """
+        try:
+            return len(os.listdir(self.path)) >= self.max_files
+        except (IOError, OSError):
+            return True
+
+    def _sampled(self, environ):
+        """
+        Whether to profile this request.
+        """
+        if not self._asked(environ) and not (
+                self.sample and next(self.count) % self.sample == 0
+        ):
+            return False
+        return not self._full()
+
+    def __call__(self, environ, start_response):
+        """
+        Call the application, profiling it if this request is sampled.
+        """
+        if not self._sampled(environ):
+            return self.app(environ, start_response)
+        profile = cProfile.Profile()
+        start = time.time()
+        profile.enable()
+        try:
+            app_iter = self.app(environ, start_response)
+        except Exception:
+            profile.disable()
+            self._write(profile, environ, start)
+            raise
+        profile.disable()
+        return self._profiled(profile, environ, start, app_iter)
+
+    def _profiled(self, profile, environ, start, app_iter):
+        """
+        Profile sending the response, then write the profile out.
+        """
+        # pylint: disable=too-many-arguments
+        try:
+            iterator = iter(app_iter)
+            while True:
+                profile.enable()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    profile.disable()
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            self._write(profile, environ, start)
+
+    def _write(self, profile, environ, start):
+        """
+        Save a profile, never failing the request for it.
+        """
+        elapsed = time.time() - start
+        request = re.sub(r'[^A-Za-z0-9]+', '_', '{0} {1}'.format(
+            environ.get('REQUEST_METHOD', ''), environ.get('PATH_INFO', '')
+        )).strip('_')[:60]
+        filename = os.path.join(self.path, '{0:.6f}-{1}-{2}-{3}ms.prof'.format(
+            start, os.getpid(), request, int(elapsed * 1000)
+        ))
+        try:
+            profile.dump_stats(filename)
+        except (IOError, OSError):
+            log.exception('Failed writing profile %s', filename)
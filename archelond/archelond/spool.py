@@ -0,0 +1,353 @@
+"""
+Durable write behind spool for adding commands, so POSTs don't have to
+wait on the data store.
+"""
+from __future__ import absolute_import, unicode_literals
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS spool (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT,
+        host TEXT,
+        command TEXT NOT NULL,
+        meta TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        enqueued REAL NOT NULL,
+        lease REAL NOT NULL DEFAULT 0,
+        claim TEXT
+    )
+"""
+
+
+class Spool(object):
+    """Queue of commands waiting to be added, kept in SQLite.
+
+    Every application process on a host can share the same spool file.
+    Batches are claimed with a lease, so a batch claimed by a process
+    that dies is picked up by another once the lease runs out, and a
+    command is only removed once the data store has it.
+    """
+
+    def __init__(self, path, lease=60):
+        """Open the spool, creating it if needed.
+
+        Args:
+            path (str): SQLite database file to keep the spool in
+            lease (float): Seconds a claimed batch is held before
+                someone else may take it.
+        """
+        self.path = path
+        self.lease = lease
+        self.local = threading.local()
+        # Connections made before a fork, kept so they aren't closed
+        self.inherited = []
+        connection = self._connection()
+        with connection:
+            connection.execute(SCHEMA)
+        # Application servers fork their workers after loading the app,
+        # so don't leave a connection open for them to inherit
+        connection.close()
+        self.local.connection = None
+
+    def _connection(self):
+        """
+        Get the connection for this thread, opening it if needed or if
+        it was opened before this process was forked.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid != os.getpid():
+            # Closing the parent's connection could upset its locks
+            self.inherited.append(connection)
+            connection = None
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def put(self, commands, username, host, **kwargs):
+        """Durably queue commands to be added.
+
+        Args:
+            commands (list): Commands to add
+            username (str): User adding them
+            host (str): IP address of the API caller
+            kwargs: Extra command metadata, as for ``HistoryData.add``
+        """
+        now = time.time()
+        meta = json.dumps(kwargs)
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(
+                'INSERT INTO spool (username, host, command, meta, enqueued) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(username, host, command, meta, now) for command in commands]
+            )
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def claim(self, limit):
+        """Take the oldest commands nobody else is working on.
+
+        Args:
+            limit (int): Most commands to take
+
+        Returns:
+            list: ``sqlite3.Row`` objects for the claimed commands
+        """
+        now = time.time()
+        claim = uuid.uuid4().hex
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'UPDATE spool SET lease = ?, claim = ? WHERE id IN ('
+                'SELECT id FROM spool WHERE lease < ? ORDER BY id LIMIT ?)',
+                (now + self.lease, claim, now, limit)
+            )
+            rows = connection.execute(
+                'SELECT * FROM spool WHERE claim = ? ORDER BY id', (claim,)
+            ).fetchall()
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return rows
+
+    def ack(self, ids):
+        """Remove commands that made it into the data store.
+
+        Args:
+            ids (list): Spool ids of the commands
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany(
+            'DELETE FROM spool WHERE id = ?', [(x,) for x in ids]
+        )
+        connection.execute('COMMIT')
+
+    def retry(self, ids, delay):
+        """Release commands to be tried again after a delay.
+
+        Args:
+            ids (list): Spool ids of the commands
+            delay (float): Seconds until they may be claimed again
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany(
+            'UPDATE spool SET attempts = attempts + 1, lease = ?, '
+            'claim = NULL WHERE id = ?',
+            [(time.time() + delay, x) for x in ids]
+        )
+        connection.execute('COMMIT')
+
+    def stats(self):
+        """How backed up the spool is.
+
+        Returns:
+            dict: ``depth`` in commands and ``oldest`` age in seconds
+        """
+        row = self._connection().execute(
+            'SELECT COUNT(*), MIN(enqueued) FROM spool'
+        ).fetchone()
+        return {
+            'depth': row[0],
+            'oldest': time.time() - row[1] if row[1] is not None else 0.0,
+        }
+
+
+class SpoolFlusher(object):
+    """Background thread that drains a spool into a data store.
+
+    A flush happens when ``SPOOL_BATCH_SIZE`` commands have been
+    queued by this process or ``SPOOL_FLUSH_INTERVAL`` seconds have
+    passed, whichever comes first.  Commands the data store fails to
+    add are retried with exponential backoff, and dropped with an
+    error logged after ``SPOOL_MAX_ATTEMPTS`` tries.
+
+    The thread is started by :py:meth:`start` on the first request
+    each process handles, rather than at import time, so that it
+    survives application servers forking workers after loading the
+    app, and commands left in the spool by a restart are drained
+    without waiting for more to be added.
+    """
+    # Seconds before the first retry, doubled for each one after
+    RETRY_DELAY = 1.0
+    MAX_RETRY_DELAY = 300.0
+
+    def __init__(self, spool, data, config):
+        """Set up, but don't start, the flusher.
+
+        Args:
+            spool (Spool): Spool to drain
+            data (HistoryData): Data store to add the commands to
+            config (dict): The flask application configuration
+                dictionary.
+        """
+        self.spool = spool
+        self.data = data
+        self.batch_size = int(config.get('SPOOL_BATCH_SIZE', 500))
+        self.interval = float(config.get('SPOOL_FLUSH_INTERVAL', 1))
+        self.max_attempts = int(config.get('SPOOL_MAX_ATTEMPTS', 10))
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = 0
+        self.thread = None
+        self.pid = None
+        self.flushed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_flush = None
+        self.last_latency = 0.0
+
+    def start(self):
+        """
+        Start the flusher thread, unless this process already has.
+        """
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(
+                    target=self._run, name='archelond-spool-flusher'
+                )
+                self.thread.daemon = True
+                self.thread.start()
+
+    def notify(self, count):
+        """Tell the flusher commands were queued.
+
+        Args:
+            count (int): How many commands were just put in the spool
+        """
+        self.start()
+        with self.lock:
+            self.pending += count
+            if self.pending >= self.batch_size:
+                self.wakeup.set()
+
+    def _run(self):
+        """
+        Flush forever, never letting an error kill the thread.
+        """
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            with self.lock:
+                self.pending = 0
+            try:
+                while self.flush() == self.batch_size:
+                    pass
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Failed flushing spool')
+
+    def flush(self):
+        """Move one batch of commands from the spool to the data store.
+
+        Returns:
+            int: Number of commands that were in the batch
+        """
+        rows = self.spool.claim(self.batch_size)
+        if not rows:
+            return 0
+        start = time.time()
+        # bulk_add takes one user and host at a time
+        groups = {}
+        for row in rows:
+            groups.setdefault(
+                (row['username'], row['host'], row['meta']), []
+            ).append(row)
+
+        done, failed = [], []
+        for (username, host, meta), group in groups.items():
+            try:
+                cmd_ids = self.data.bulk_add(
+                    [row['command'] for row in group], username, host,
+                    **json.loads(meta)
+                )
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Failed adding spooled commands')
+                cmd_ids = [None] * len(group)
+            for row, cmd_id in zip(group, cmd_ids):
+                (done if cmd_id is not None else failed).append(row)
+
+        self.spool.ack([row['id'] for row in done])
+        self._retry(failed)
+        latency = time.time() - start
+        with self.lock:
+            self.flushed += len(done)
+            self.last_flush = time.time()
+            self.last_latency = latency
+        log.debug(
+            'Flushed %s spooled commands in %.3fs, %s failed',
+            len(done), latency, len(failed)
+        )
+        return len(rows)
+
+    def _retry(self, rows):
+        """
+        Back off failed commands, or give up on them.
+        """
+        retry, drop = {}, []
+        for row in rows:
+            if row['attempts'] + 1 >= self.max_attempts:
+                log.error(
+                    'Dropping spooled command for %s after %s attempts',
+                    row['username'], row['attempts'] + 1
+                )
+                drop.append(row['id'])
+            else:
+                delay = min(
+                    self.RETRY_DELAY * 2 ** row['attempts'],
+                    self.MAX_RETRY_DELAY
+                )
+                retry.setdefault(delay, []).append(row['id'])
+        for delay, ids in retry.items():
+            self.spool.retry(ids, delay)
+        self.spool.ack(drop)
+        with self.lock:
+            self.failed += len(rows)
+            self.dropped += len(drop)
+
+    def stats(self):
+        """Spool backlog and how flushing in this process is going.
+
+        Returns:
+            dict: The spool's ``depth`` and ``oldest``, plus this
+                process's ``flushed``, ``failed`` and ``dropped``
+                command counts, seconds since the ``last_flush`` and
+                its ``flush_latency``.
+        """
+        stats = self.spool.stats()
+        with self.lock:
+            stats.update({
+                'flushed': self.flushed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'last_flush': (
+                    time.time() - self.last_flush
+                    if self.last_flush is not None else None
+                ),
+                'flush_latency': self.last_latency,
+            })
+        return stats
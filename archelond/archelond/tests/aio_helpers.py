@@ -0,0 +1,38 @@
+"""
+Coroutines for the asyncio tests.  They are kept out of the test
+modules because Python before 3.5 can't parse them, so only import
+this on Python 3.5 or newer.
+"""
+from __future__ import absolute_import, unicode_literals
+import asyncio  # pylint: disable=import-error
+
+
+def run(coroutine):
+    """
+    Run a coroutine to completion on a fresh event loop.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def call_asgi(app, scope, body):
+    """
+    Send a request with ``body`` through an ASGI application, and
+    return the messages it sends back.
+    """
+    messages = [{'type': 'http.request', 'body': body}]
+    sent = []
+
+    async def receive():
+        """Hand over the request body"""
+        return messages.pop(0)
+
+    async def send(message):
+        """Keep what the application sends"""
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent
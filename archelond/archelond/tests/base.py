@@ -24,6 +24,8 @@ class ElasticTestClass(unittest.TestCase):
         )
         self.config = wsgi_app().config
         self.data = archelond.data.ElasticData(self.config)
+        # Every test starts from a fresh index, so always create it
+        self.data.bootstrap()
         self.app = wsgi_app()
         # Set well known secret for known token generation
         self.app.config['FLASK_SECRET'] = 'wellknown'
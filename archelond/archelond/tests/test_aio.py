@@ -0,0 +1,280 @@
+"""
+Verify the asyncio data stores and ASGI application
+
+The coroutines these tests need are in ``aio_helpers`` so this module
+still parses on older Pythons, though ``conftest.py`` doesn't collect
+it there either.
+"""
+from __future__ import absolute_import, unicode_literals
+import base64
+import json
+import os
+import sys
+import time
+import unittest
+import zlib
+
+from archelond.tests.base import ElasticTestClass
+
+try:
+    import aiohttp  # pylint: disable=import-error,unused-import
+except ImportError:
+    aiohttp = None  # pylint: disable=invalid-name
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio API needs Python 3.5')
+class TestASGI(unittest.TestCase):
+    """
+    Verify the views and API of the ASGI application
+    """
+    USER = 'foo'
+    PASS = 'bar'
+
+    def setUp(self):
+        """
+        Build the ASGI application with the in memory store.
+        """
+        self.old_conf = os.environ.get('ARCHELOND_CONF')
+        os.environ['ARCHELOND_CONF'] = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            'config', 'basic.py'
+        )
+        from archelond.aio.web import asgi_app
+        self.app = asgi_app()
+
+    def tearDown(self):  # pragma: no cover
+        """
+        Restore previous config variable
+        """
+        if self.old_conf:
+            os.environ['ARCHELOND_CONF'] = self.old_conf
+        else:
+            del os.environ['ARCHELOND_CONF']
+
+    def _call(self, path, method='GET', query='', body=b'',
+              content_type=None, auth=True, headers=None):
+        """
+        Send a request through the application and collect the
+        status, headers and decoded body.
+        """
+        # pylint: disable=too-many-arguments
+        headers = list(headers or [])
+        if auth:
+            headers.append((b'authorization', b'Basic ' + base64.b64encode(
+                '{0}:{1}'.format(self.USER, self.PASS).encode('ascii')
+            )))
+        if content_type:
+            headers.append((b'content-type', content_type.encode('ascii')))
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query.encode('ascii'),
+            'headers': headers,
+            'client': ('127.0.0.1', 1234),
+        }
+        from archelond.tests.aio_helpers import call_asgi, run
+        start, body = run(call_asgi(self.app, scope, body))
+        headers = dict(
+            (key.decode('latin-1'), value.decode('latin-1'))
+            for key, value in start['headers']
+        )
+        payload = body['body'].decode('utf-8')
+        if headers.get('content-type') == 'application/json':
+            payload = json.loads(payload)
+        return start['status'], headers, payload
+
+    def test_auth(self):
+        """
+        Everything needs basic or token auth.
+        """
+        status, headers, _ = self._call('/api/v1/history', auth=False)
+        self.assertEqual(401, status)
+        self.assertIn('www-authenticate', headers)
+
+        status, _, payload = self._call('/api/v1/token')
+        self.assertEqual(200, status)
+        status, _, _ = self._call(
+            '/api/v1/history', auth=False,
+            query='access_token={0}'.format(payload['token'])
+        )
+        self.assertEqual(200, status)
+        self.assertEqual(404, self._call('/api/v1/nope')[0])
+
+    def test_flask_only(self):
+        """
+        Routes the Flask application serves alone say so.
+        """
+        for path in ('/api/v1/history/export', '/api/v1/stats', '/metrics'):
+            status, _, payload = self._call(path)
+            self.assertEqual(501, status)
+            self.assertIn('Flask', payload['error'])
+
+    def test_history(self):
+        """
+        Add, page, get, update and delete commands.
+        """
+        from archelond.data import MemoryData
+        status, headers, _ = self._call(
+            '/api/v1/history', method='POST', body=b'command=who',
+            content_type='application/x-www-form-urlencoded'
+        )
+        self.assertEqual(201, status)
+        location = headers['location']
+
+        status, _, payload = self._call(
+            '/api/v1/history', method='POST',
+            body=json.dumps({'commands': [
+                'turtle {0}'.format(x)
+                for x in range(MemoryData.NUM_RESULTS + 1)
+            ]}).encode('utf-8'),
+            content_type='application/json'
+        )
+        self.assertEqual(200, status)
+        self.assertEqual(
+            set([201]), set(x['status_code'] for x in payload['responses'])
+        )
+        status, _, payload = self._call(
+            '/api/v1/history', method='POST', query='response=summary',
+            body=json.dumps({'commands': ['a', 'b']}).encode('utf-8'),
+            content_type='application/json'
+        )
+        self.assertEqual(200, status)
+        self.assertEqual({'received': 2, 'added': 2, 'failed': []}, payload)
+        status, _, payload = self._call(
+            '/api/v1/history', method='POST', query='response=ids',
+            body=json.dumps({'commands': ['a']}).encode('utf-8'),
+            content_type='application/json'
+        )
+        self.assertEqual(1, len(payload['ids']))
+        self.assertEqual(422, self._call(
+            '/api/v1/history', method='POST', query='response=nope',
+            body=json.dumps({'commands': ['a']}).encode('utf-8'),
+            content_type='application/json'
+        )[0])
+
+        status, _, payload = self._call('/api/v1/history', query='q=turtle')
+        self.assertEqual(MemoryData.NUM_RESULTS, len(payload['commands']))
+        status, _, payload = self._call(
+            '/api/v1/history',
+            query='q=turtle&cursor={0}'.format(payload['cursor'])
+        )
+        self.assertEqual(1, len(payload['commands']))
+        self.assertEqual(
+            422, self._call('/api/v1/history', query='o=foo')[0]
+        )
+        self.assertEqual(
+            422, self._call('/api/v1/history', query='cursor=garbage')[0]
+        )
+
+        status, _, payload = self._call(location)
+        self.assertEqual('who', payload['command'])
+        status, _, _ = self._call(
+            location, method='PUT', content_type='application/json',
+            body=json.dumps({'payload': {'cwd': '/'}}).encode('utf-8')
+        )
+        self.assertEqual(204, status)
+        self.assertEqual('/', self._call(location)[2]['meta']['cwd'])
+        self.assertEqual(200, self._call(location, method='DELETE')[0])
+        self.assertEqual(404, self._call(location)[0])
+        self.assertEqual(404, self._call(location, method='DELETE')[0])
+
+    def test_import(self):
+        """
+        Newline delimited JSON, gzipped or not, is imported with a
+        summary of how it went.
+        """
+        body = b'"ls"\n{"command": "pwd"}\n\n42\n"who"\n'
+        status, _, payload = self._call(
+            '/api/v1/history/import', method='POST', body=body,
+            content_type='application/x-ndjson'
+        )
+        self.assertEqual(200, status)
+        self.assertEqual(
+            {'received': 4, 'added': 3, 'invalid': [2], 'failed': []},
+            payload
+        )
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        status, _, payload = self._call(
+            '/api/v1/history/import', method='POST',
+            body=compressor.compress(b'"cd"\n') + compressor.flush(),
+            content_type='application/x-ndjson',
+            headers=[(b'content-encoding', b'gzip')]
+        )
+        self.assertEqual(1, payload['added'])
+        status, _, payload = self._call(
+            '/api/v1/history/import', method='POST', body=b'not gzip',
+            headers=[(b'content-encoding', b'gzip')]
+        )
+        self.assertEqual(400, status)
+        self.assertIn('error', payload)
+        self.assertEqual(
+            405, self._call('/api/v1/history/import', method='GET')[0]
+        )
+        status, _, payload = self._call('/api/v1/history', query='q=cd')
+        self.assertEqual(['cd'], [x['command'] for x in payload['commands']])
+
+    def test_bad_posts(self):
+        """
+        Verify we validate what is posted.
+        """
+        for body, error in (
+                ({'fluffy': 'bunnies'}, 'Missing command(s) parameter'),
+                ({'command': True}, 'Command must be a string'),
+                ({'commands': {'a': 1}}, 'Commands must be list'),
+        ):
+            status, _, payload = self._call(
+                '/api/v1/history', method='POST',
+                body=json.dumps(body).encode('utf-8'),
+                content_type='application/json'
+            )
+            self.assertEqual(422, status)
+            self.assertEqual(error, payload['error'])
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio API needs Python 3.5')
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncElasticData(ElasticTestClass):
+    """
+    Verify the aiohttp Elasticsearch data store against a real one.
+    """
+
+    def setUp(self):
+        """
+        Make the asyncio data store alongside the normal one.
+        """
+        super(TestAsyncElasticData, self).setUp()
+        import asyncio  # pylint: disable=import-error
+        from archelond.aio import AsyncElasticData
+        self.async_data = AsyncElasticData(self.config)
+        # Everything runs on one loop, which the HTTP session belongs to
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.addCleanup(
+            self.loop.run_until_complete, self.async_data.close()
+        )
+
+    def test_add_get_filter_delete(self):
+        """
+        Commands added asynchronously can be found both ways.
+        """
+        user = 'archelon-jr'
+        wait = self.loop.run_until_complete
+        cmd_id = wait(self.async_data.add('is this on', user, None))
+        ids = wait(self.async_data.bulk_add(
+            ['cheesey petes', 'is that on'], user, None
+        ))
+        self.assertNotIn(None, ids)
+        self.assertEqual(
+            'is this on',
+            wait(self.async_data.get(cmd_id, user, None))['command']
+        )
+        time.sleep(2)
+        self.assertEqual(
+            2, len(wait(self.async_data.filter('is', None, user, None)))
+        )
+        self.assertEqual(3, len(wait(self.async_data.all('r', user, None))))
+        wait(self.async_data.delete(cmd_id, user, None))
+        with self.assertRaises(KeyError):
+            wait(self.async_data.get(cmd_id, user, None))
+        self.assertEqual(2, len(self.data.all(None, user, None)))
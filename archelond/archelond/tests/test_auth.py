@@ -0,0 +1,143 @@
+"""
+Test the cache of verified credentials
+"""
+from __future__ import absolute_import, unicode_literals
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from flask import Flask
+import mock
+from passlib.apache import HtpasswdFile
+
+from archelond.auth import CachedHtPasswdAuth
+
+
+class TestCachedHtPasswdAuth(unittest.TestCase):
+    """
+    Verify credentials are cached without changing who gets in
+    """
+
+    def setUp(self):
+        """
+        Copy the test htpasswd file somewhere we can change it.
+        """
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.htpasswd_path = os.path.join(path, 'htpasswd')
+        shutil.copy(
+            os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                'config', 'test_htpasswd'
+            ),
+            self.htpasswd_path
+        )
+        self.app = Flask('archelond')
+        self.app.config['FLASK_HTPASSWD_PATH'] = self.htpasswd_path
+        self.app.config['FLASK_SECRET'] = 'dummy'
+        self.app.config['AUTH_CACHE_SIZE'] = 2
+        self.auth = CachedHtPasswdAuth(self.app)
+
+    def _change_password(self, username, password):
+        """
+        Rewrite the htpasswd file with a new password, making sure it
+        looks modified.
+        """
+        users = HtpasswdFile(self.htpasswd_path)
+        users.set_password(username, password)
+        users.save()
+        stat = os.stat(self.htpasswd_path)
+        os.utime(self.htpasswd_path, (stat.st_atime, stat.st_mtime + 10))
+
+    def test_basic(self):
+        """
+        Passwords are only hashed the first time they're seen, and
+        wrong ones never get in.
+        """
+        with mock.patch.object(
+            self.auth.users, 'check_password',
+            wraps=self.auth.users.check_password
+        ) as check_mock:
+            self.assertEqual(
+                (True, 'foo'), self.auth.check_basic_auth('foo', 'bar')
+            )
+            self.assertEqual(
+                (True, 'foo'), self.auth.check_basic_auth('foo', 'bar')
+            )
+            self.assertEqual(1, check_mock.call_count)
+            for _ in range(2):
+                self.assertEqual(
+                    (False, 'foo'), self.auth.check_basic_auth('foo', 'baz')
+                )
+            self.assertEqual(3, check_mock.call_count)
+        self.assertFalse(self.auth.check_basic_auth('norm', 'bar')[0])
+        stats = self.auth.cache_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(4, stats['misses'])
+        self.assertEqual(0.2, stats['hit_rate'])
+        self.assertEqual(1, stats['entries'])
+
+    def test_token(self):
+        """
+        Tokens are cached, and bad ones are still refused.
+        """
+        token = self.auth.generate_token('foo')
+        self.assertEqual((True, 'foo'), self.auth.check_token_auth(token))
+        with mock.patch('flask_htpasswd.jwt') as jwt_mock:
+            self.assertEqual(
+                (True, 'foo'), self.auth.check_token_auth(token)
+            )
+            self.assertFalse(jwt_mock.decode.called)
+        self.assertEqual((False, None), self.auth.check_token_auth('bad'))
+        self.assertEqual(1, self.auth.cache_stats()['hits'])
+
+    def test_htpasswd_changed(self):
+        """
+        Changing the htpasswd file reloads it and forgets everything.
+        """
+        token = self.auth.generate_token('foo')
+        self.assertTrue(self.auth.check_basic_auth('foo', 'bar')[0])
+        self.assertTrue(self.auth.check_token_auth(token)[0])
+        self._change_password('foo', 'baz')
+
+        self.assertFalse(self.auth.check_basic_auth('foo', 'bar')[0])
+        self.assertFalse(self.auth.check_token_auth(token)[0])
+        self.assertTrue(self.auth.check_basic_auth('foo', 'baz')[0])
+        stats = self.auth.cache_stats()
+        self.assertEqual(2, stats['invalidations'])
+        self.assertEqual(0, stats['hits'])
+
+        # Keep the users we have if the file goes away
+        os.remove(self.htpasswd_path)
+        self.assertTrue(self.auth.check_basic_auth('foo', 'baz')[0])
+        self.assertEqual(3, self.auth.cache_stats()['invalidations'])
+
+    def test_expiry(self):
+        """
+        Credentials are checked again once they expire or are pushed
+        out of the cache.
+        """
+        self.assertTrue(self.auth.check_basic_auth('foo', 'bar')[0])
+        with mock.patch('archelond.auth.time') as time_mock:
+            time_mock.time.return_value = time.time() + self.auth.ttl + 1
+            self.assertTrue(self.auth.check_basic_auth('foo', 'bar')[0])
+        self.assertEqual(0, self.auth.cache_stats()['hits'])
+
+        self.assertTrue(self.auth.check_basic_auth('norm', 'god')[0])
+        self.assertTrue(self.auth.check_basic_auth('enigma', 'pass')[0])
+        stats = self.auth.cache_stats()
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(2, stats['entries'])
+
+    def test_disabled(self):
+        """
+        A cache size of 0 checks every time.
+        """
+        self.app.config['AUTH_CACHE_SIZE'] = 0
+        auth = CachedHtPasswdAuth(self.app)
+        for _ in range(2):
+            self.assertTrue(auth.check_basic_auth('foo', 'bar')[0])
+        self.assertEqual(0, auth.cache_stats()['entries'])
+        self.assertEqual(0, auth.cache_stats()['misses'])
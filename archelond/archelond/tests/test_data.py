@@ -1,16 +1,29 @@
+# -*- coding: utf-8 -*-
 """
 Test out the server data classes
 """
 from __future__ import absolute_import, unicode_literals
+from datetime import datetime, timedelta
 import os
+import shutil
+import sqlite3
+import tempfile
 import time
 import unittest
 
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import RequestError
+import mock
+import pytz
 from six.moves import range  # pylint: disable=import-error,redefined-builtin
 
 import archelond.data
 from archelond.data.abstract import HistoryData
+from archelond.data.cursor import decode_cursor, encode_cursor
+from archelond.data.frecency import HALF_LIFE, frecency
+from archelond.data.journal import Journal
+from archelond.data.trigram import TrigramIndex
+from archelond.metrics import Metrics
 from archelond.tests.base import ElasticTestClass
 from archelond.web import wsgi_app
 
@@ -33,7 +46,10 @@ class TestBaseHistoryData(unittest.TestCase):
         """
         Verify that the methods are what we expect.
         """
-        expected_set = ('__init__', 'add', 'all', 'delete', 'filter', 'get',)
+        expected_set = (
+            '__init__', 'add', 'all', 'bulk_add', 'delete', 'filter', 'get',
+            'update_meta',
+        )
         # pylint: disable=no-member
         abstract_methods = HistoryData.__abstractmethods__
         self.assertEqual(0, len(abstract_methods.difference(expected_set)))
@@ -55,6 +71,68 @@ class TestBaseHistoryData(unittest.TestCase):
             )
 
 
+class TestTrigramIndex(unittest.TestCase):
+    """
+    Verify the trigram posting lists used for substring search
+    """
+
+    def test_trigrams(self):
+        """
+        Make sure we split strings up as expected.
+        """
+        self.assertEqual(
+            set(['ech', 'cho', 'ho ', 'o h', ' hi']),
+            TrigramIndex.trigrams('echo hi')
+        )
+        self.assertEqual(set(), TrigramIndex.trigrams('ls'))
+
+    def test_add_remove_candidates(self):
+        """
+        Verify postings are kept up to date and intersected.
+        """
+        index = TrigramIndex()
+        index.add('a', 'pip install -e .')
+        index.add('b', 'apt-get install vim')
+        index.add('c', 'vim foo')
+
+        self.assertEqual(set(['a', 'b']), index.candidates('install'))
+        self.assertEqual(set(['b', 'c']), index.candidates('vim'))
+        self.assertEqual(set(), index.candidates('emacs'))
+        self.assertIsNone(index.candidates('vi'))
+
+        index.remove('b', 'apt-get install vim')
+        self.assertEqual(set(['a']), index.candidates('install'))
+        self.assertEqual(set(['c']), index.candidates('vim'))
+        # Empty postings are dropped
+        self.assertNotIn('apt', index.postings)
+        # Removing something that isn't there is harmless
+        index.remove('z', 'zzz')
+
+
+class TestFrecency(unittest.TestCase):
+    """
+    Verify the frecency rank
+    """
+
+    def test_frecency(self):
+        """
+        More uses rank higher, and old uses fade.
+        """
+        now = datetime.utcnow().replace(tzinfo=pytz.utc)
+        once = frecency(None, now)
+        twice = frecency(frecency(None, now), now)
+        self.assertAlmostEqual(1, twice - once)
+
+        # Four uses a couple of half lives ago are worth one today
+        old = now - timedelta(seconds=2 * HALF_LIFE)
+        rank = None
+        for _ in range(4):
+            rank = frecency(rank, old)
+        self.assertAlmostEqual(once, rank)
+        self.assertAlmostEqual(twice, frecency(rank, now))
+        self.assertLess(frecency(None, old), once)
+
+
 class TestMemoryData(unittest.TestCase):
     """
     Validate the MemoryData to be working as expected
@@ -88,11 +166,20 @@ class TestMemoryData(unittest.TestCase):
         # Assert super init being done
         self.assertEqual(self.config, self.data.config)
 
-        # assert data set is equal to INITIAL_DATA
-        data = list(self.data.data.values())
+        # No partitions until someone shows up
+        self.assertEqual({}, self.data.users)
+
+        # Reading doesn't make one
+        self.assertEqual([], self.data.all(None, None, None))
+        self.assertEqual([], list(self.data.export(None, None)))
+        self.assertEqual({}, self.data.users)
+
+        # assert a new user's data set is INITIAL_DATA, and what they
+        # added
+        self.data.add('ls', None, None)
+        data = list(self.data.users[None].data.values())
         commands = [x['command'] for x in data]
-        for command in commands:
-            self.assertTrue(command in self.data.INITIAL_DATA)
+        self.assertEqual(self.data.INITIAL_DATA + ['ls'], commands)
 
     def test_add_get_delete(self):
         """
@@ -124,11 +211,28 @@ class TestMemoryData(unittest.TestCase):
         with self.assertRaises(KeyError):
             self.data.get(command_id, None, None)
 
+    def test_update_meta(self):
+        """
+        Updating a command's meta replaces it without counting a use.
+        """
+        user = 'enigma'
+        command_id = self.data.add('ls', user, None, pumpkins=True)
+        for _ in range(3):
+            self.data.update_meta(command_id, user, None, squash=1)
+        command = self.data.get(command_id, user, None)
+        self.assertEqual({'squash': 1}, command['meta'])
+        self.assertEqual(1, command['count'])
+        with self.assertRaises(KeyError):
+            self.data.update_meta('nope', user, None)
+
     def test_all(self):
         """
         Make sure ``all`` works as expected.
         """
-        # Start by deleting everything from all
+        # Nothing before the first add, which brings INITIAL_DATA along,
+        # so start by deleting everything from all
+        self.assertEqual(0, len(self.data.all(None, None, None)))
+        self.data.add('foo', None, None)
         for cmd in self.data.all(None, None, None):
             self.data.delete(cmd['id'], None, None)
         self.assertEqual(0, len(self.data.all(None, None, None)))
@@ -149,15 +253,761 @@ class TestMemoryData(unittest.TestCase):
             self.assertEqual(item['command'], commands[index])
             index -= 1
 
-    def test_page_not_used(self):
+    def test_user_partitions(self):
+        """
+        Verify users only see, get and delete their own commands.
+        """
+        command_id = self.data.add('whoami', 'enigma', None)
+        self.assertEqual(
+            1, len(self.data.filter('whoami', None, 'enigma', None))
+        )
+        self.assertEqual(
+            0, len(self.data.filter('whoami', None, 'norm', None))
+        )
+        self.assertEqual(0, len(self.data.all(None, 'norm', None)))
+        with self.assertRaises(KeyError):
+            self.data.get(command_id, 'norm', None)
+        with self.assertRaises(KeyError):
+            self.data.delete(command_id, 'norm', None)
+        with self.assertRaises(KeyError):
+            self.data.get(command_id, 'nobody', None)
+        self.assertEqual(
+            'whoami', self.data.get(command_id, 'enigma', None)['command']
+        )
+
+    def test_stats(self):
+        """
+        Verify the per user accounting.
+        """
+        empty = {'commands': 0, 'pages': 0, 'bytes': 0, 'trigrams': 0}
+        self.assertEqual(empty, self.data.stats('enigma'))
+        # Asking doesn't make a partition
+        self.assertEqual({}, self.data.users)
+
+        command_id = self.data.add('echo ☠', 'enigma', None)
+        stats = self.data.stats('enigma')
+        self.assertEqual(len(self.data.INITIAL_DATA) + 1, stats['commands'])
+        self.assertEqual(1, stats['pages'])
+        initial_bytes = sum(len(x) for x in self.data.INITIAL_DATA)
+        self.assertEqual(initial_bytes + 8, stats['bytes'])
+        self.assertGreater(stats['trigrams'], 0)
+        # Other users aren't affected
+        self.assertEqual(empty, self.data.stats('norm'))
+
+        self.data.delete(command_id, 'enigma', None)
+        self.assertEqual(initial_bytes, self.data.stats('enigma')['bytes'])
+
+    def test_bulk_add(self):
+        """
+        Verify bulk adds store everything in order and journal it.
+        """
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        data = archelond.data.MemoryData({'MEMORY_JOURNAL_PATH': path})
+        commands = ['bulk 1', 'bulk 2', 'bulk 1', 'bulk 3']
+        cmd_ids = data.bulk_add(commands, 'enigma', 'host', pumpkins=True)
+        self.assertEqual([data._doc_id(x) for x in commands], cmd_ids)
+        results = data.filter('bulk', None, 'enigma', None)
+        self.assertEqual(
+            ['bulk 1', 'bulk 2', 'bulk 3'], [x['command'] for x in results]
+        )
+        self.assertEqual({'pumpkins': True}, results[0]['meta'])
+        data.journal.close()
+
+        restored = archelond.data.MemoryData({'MEMORY_JOURNAL_PATH': path})
+        results = restored.filter('bulk', None, 'enigma', None)
+        self.assertEqual(
+            ['bulk 1', 'bulk 2', 'bulk 3'], [x['command'] for x in results]
+        )
+        restored.journal.close()
+
+    def test_journal(self):
+        """
+        Verify a journaled store comes back the same after a restart.
+        """
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        config = {'MEMORY_JOURNAL_PATH': path, 'MEMORY_SNAPSHOT_INTERVAL': 8}
+
+        def dump(data):
+            """Everything about a user's history that should survive"""
+            return [
+                (x['id'], x['command'], x['host'], x['timestamp'], x['meta'],
+                 x['count'], x['last_used'], x['frecency'])
+                for x in data.all(None, 'enigma', None)
+            ]
+
+        data = archelond.data.MemoryData(config)
+        for number in range(10):
+            data.add('restart {}'.format(number), 'enigma', 'host')
+        # Snapshot taken, with just the log after it left
+        self.assertEqual(1, data.journal.generation)
+        data.delete(data._doc_id('restart 2'), 'enigma', None)
+        data.add('restart 1', 'enigma', None, pumpkins=True)
+        data.add('☠', 'norm', None)
+        before = dump(data)
+        data.journal.close()
+
+        restored = archelond.data.MemoryData(config)
+        self.assertEqual(before, dump(restored))
+        self.assertEqual(
+            '☠', restored.all(None, 'norm', None)[-1]['command']
+        )
+        self.assertEqual(
+            restored.stats('enigma'), data.stats('enigma')
+        )
+        # Old logs are cleaned up after snapshots
+        self.assertEqual(
+            sorted(os.listdir(path)),
+            [Journal.LOCK_NAME, 'log.{}'.format(data.journal.generation),
+             Journal.SNAPSHOT_NAME]
+        )
+
+        # A torn write at the end of the log is dropped
+        restored.journal.close()
+        log_path = os.path.join(
+            path, Journal.LOG_NAME.format(data.journal.generation)
+        )
+        with open(log_path, 'ab') as log_file:
+            log_file.write(b'{"op": "add", "docu')
+        restored = archelond.data.MemoryData(config)
+        self.assertEqual(before, dump(restored))
+        restored.add('after the tear', 'enigma', None)
+        restored.journal.close()
+        restored = archelond.data.MemoryData(config)
+        self.assertEqual(
+            'after the tear',
+            restored.all(None, 'enigma', None)[-1]['command']
+        )
+        restored.journal.close()
+
+        # Something else in the snapshot's place is refused
+        with open(os.path.join(path, Journal.SNAPSHOT_NAME), 'wb') as bad:
+            bad.write(b'x' * Journal.HEADER.size)
+        with self.assertRaises(ValueError):
+            archelond.data.MemoryData(config)
+
+    def test_journal_background(self):
+        """
+        Changes made while a snapshot is written are kept, even if the
+        snapshot is never finished, and the directory can't be shared.
+        """
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        config = {'MEMORY_JOURNAL_PATH': path}
+        data = archelond.data.MemoryData(config)
+        with self.assertRaises(IOError):
+            Journal(path)
+        data.add('before', 'enigma', None)
+        # Die before the snapshot is written
+        with mock.patch.object(data.journal, 'write_snapshot'):
+            data.journal.snapshot_later([])
+        data.add('during', 'enigma', None)
+        data.journal.close()
+
+        restored = archelond.data.MemoryData(config)
+        self.assertEqual(
+            ['before', 'during'],
+            [x['command'] for x in restored.all(None, 'enigma', None)][-2:]
+        )
+        self.assertEqual(1, restored.journal.generation)
+        restored.add('after', 'enigma', None)
+        restored.journal.snapshot_later([])
+        restored.journal.close()
+        self.assertEqual(
+            sorted(os.listdir(path)),
+            [Journal.LOCK_NAME, 'log.2', Journal.SNAPSHOT_NAME]
+        )
+
+    def test_filter_index(self):
+        """
+        Verify indexed and short term searches find the same things
+        in the right order.
+        """
+        commands = ['pip install -e .', 'pip freeze', 'make install']
+        for command in commands:
+            self.data.add(command, None, None)
+
+        def search(term, order=None):
+            """Get just the matching commands"""
+            return [
+                x['command']
+                for x in self.data.filter(term, order, None, None)
+            ]
+
+        self.assertEqual(
+            ['pip install -e .', 'make install'], search('install')
+        )
+        self.assertEqual(
+            ['make install', 'pip install -e .'], search('install', 'r')
+        )
+        # Trigrams match but the substring doesn't
+        self.assertEqual([], search('pip make'))
+        # Too short for the index
+        self.assertEqual(['pip install -e .', 'pip freeze'], search('pi'))
+        # Re-adding keeps the original position
+        self.data.add('pip install -e .', None, None)
+        self.assertEqual(
+            'pip install -e .',
+            self.data.filter('install', None, None, None)[0]['command']
+        )
+
+    def test_page_past_end(self):
         """
-        Assert that there is only ever one page
+        Assert that pages past the end are empty
         """
         self.assertEqual(0, len(self.data.all('r', None, None, page=2)))
         self.assertEqual(0, len(self.data.filter(
             'stuff', 'r', None, None, page=23
         )))
 
+    def test_paging(self):
+        """
+        Verify page numbers and cursors walk through every result once.
+        """
+        self.data.INITIAL_DATA = []
+        num_commands = self.data.NUM_RESULTS * 3 + 3
+        commands = [
+            'go giant turtle number {}'.format(x) for x in range(num_commands)
+        ]
+        for command in commands:
+            self.data.add(command, 'enigma', None)
+        # Delete some to make holes, enough to force a compaction
+        for command in commands[10:90]:
+            self.data.delete(self.data._doc_id(command), 'enigma', None)
+        expected = commands[:10] + commands[90:]
+        self.assertLess(
+            len(self.data.users['enigma'].order), num_commands
+        )
+
+        for term in (None, 'turtle', 'go'):
+            for order, ordered in ((None, expected),
+                                   ('r', list(reversed(expected)))):
+                pages = []
+                cursor = None
+                while True:
+                    results = self.data.filter(
+                        term, order, 'enigma', None, cursor=cursor
+                    )
+                    pages.append([x['command'] for x in results])
+                    cursor = results.cursor
+                    if cursor is None:
+                        break
+                self.assertEqual(ordered, sum(pages, []))
+                self.assertEqual(self.data.NUM_RESULTS, len(pages[0]))
+
+                # Page numbers land in the same place
+                self.assertEqual(
+                    pages[1],
+                    [x['command'] for x in self.data.filter(
+                        term, order, 'enigma', None, page=1
+                    )]
+                )
+
+        # Cursors stay valid through deletes before them
+        results = self.data.all(None, 'enigma', None)
+        self.data.delete(results[0]['id'], 'enigma', None)
+        self.assertEqual(
+            expected[self.data.NUM_RESULTS],
+            self.data.all(
+                None, 'enigma', None, cursor=results.cursor
+            )[0]['command']
+        )
+
+        for cursor in ('garbage', 'WyJhIl0=', 'e30='):
+            with self.assertRaises(ValueError):
+                self.data.all(None, 'enigma', None, cursor=cursor)
+
+    def test_export(self):
+        """
+        Verify exports have every matching command in order, whether
+        read straight out or paged through by the default.
+        """
+        self.data.INITIAL_DATA = []
+        commands = [
+            'go giant turtle number {}'.format(x)
+            for x in range(self.data.NUM_RESULTS * 2 + 3)
+        ]
+        self.data.bulk_add(commands, 'enigma', None)
+        self.data.add('ls', 'enigma', None)
+        self.data.add('ls', 'norm', None)
+        now = datetime.utcnow().replace(tzinfo=pytz.utc)
+        hour = timedelta(hours=1)
+
+        for export in (self.data.export,
+                       lambda *args, **kwargs: HistoryData.export(
+                           self.data, *args, **kwargs
+                       )):
+            self.assertEqual(
+                commands + ['ls'],
+                [x['command'] for x in export('enigma', None)]
+            )
+            self.assertEqual(
+                commands,
+                [x['command'] for x in export('enigma', None, term='turtle')]
+            )
+            self.assertEqual(
+                [], list(export('enigma', None, since=now + hour))
+            )
+            self.assertEqual(
+                commands + ['ls'],
+                [x['command'] for x in export(
+                    'enigma', None, since=now - hour, until=now + hour
+                )]
+            )
+
+    def test_frecency(self):
+        """
+        Verify adds count uses and the ``f`` ordering pages through
+        the most used first.
+        """
+        self.data.INITIAL_DATA = []
+        commands = [
+            'go giant turtle number {}'.format(x)
+            for x in range(self.data.NUM_RESULTS * 2 + 3)
+        ]
+        self.data.bulk_add(commands, 'enigma', None)
+        for _ in range(3):
+            self.data.add(commands[7], 'enigma', None)
+        self.data.bulk_add([commands[3], commands[3]], 'enigma', None)
+
+        command = self.data.get(
+            self.data._doc_id(commands[7]), 'enigma', None
+        )
+        self.assertEqual(4, command['count'])
+        self.assertEqual(command['timestamp'], command['last_used'])
+        # Updating in place keeps the command where it was
+        self.assertEqual(
+            commands, [x['command'] for x in self.data.all(
+                None, 'enigma', None, page=0
+            )] + [x['command'] for x in self.data.all(
+                None, 'enigma', None, page=1
+            )] + [x['command'] for x in self.data.all(
+                None, 'enigma', None, page=2
+            )]
+        )
+
+        for term in (None, 'turtle'):
+            seen = []
+            cursor = None
+            while True:
+                results = self.data.filter(
+                    term, 'f', 'enigma', None, cursor=cursor
+                )
+                seen.extend(results)
+                cursor = results.cursor
+                if cursor is None:
+                    break
+            self.assertEqual(
+                [commands[7], commands[3]], [x['command'] for x in seen[:2]]
+            )
+            self.assertEqual(
+                sorted(commands), sorted(x['command'] for x in seen)
+            )
+            ranks = [x['frecency'] for x in seen]
+            self.assertEqual(sorted(ranks, reverse=True), ranks)
+
+        for cursor in ('WyJhIl0=', 'WzFd'):
+            with self.assertRaises(ValueError):
+                self.data.all('f', 'enigma', None, cursor=cursor)
+
+
+class TestSQLiteData(unittest.TestCase):
+    """
+    Validate the SQLiteData against a throwaway database
+    """
+
+    def setUp(self):
+        """
+        Build a data store on a temporary database file
+        """
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.config = {'SQLITE_PATH': os.path.join(path, 'test.sqlite')}
+        self.data = archelond.data.SQLiteData(self.config)
+
+    def _commands(self, results):
+        """
+        Get just the commands from results
+        """
+        return [x['command'] for x in results]
+
+    def test_init(self):
+        """
+        Verify the schema is in place and in WAL mode.
+        """
+        self.assertEqual(self.config, self.data.config)
+        self.assertTrue(self.data.fts)
+        connection = self.data._connection()
+        self.assertEqual(
+            'wal', connection.execute('PRAGMA journal_mode').fetchone()[0]
+        )
+        # Creating it again on an existing database is fine
+        archelond.data.SQLiteData(self.config)
+
+    def test_fork(self):
+        """
+        Verify no connection is left open to be inherited by forked
+        workers, and each process opens its own.
+        """
+        data = archelond.data.SQLiteData(self.config)
+        self.assertIsNone(data.local.connection)
+        connection = data._connection()
+        self.assertIs(connection, data._connection())
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            forked = data._connection()
+            self.assertIsNot(connection, forked)
+            self.assertIs(forked, data._connection())
+        self.assertEqual([connection], data.inherited)
+        data.add('ls', 'enigma', None)
+        self.assertEqual(['ls'], self._commands(data.all('r', 'enigma', None)))
+
+    def test_migrate(self):
+        """
+        Verify databases from before use counting get the new columns.
+        """
+        path = self.config['SQLITE_PATH'] + '.old'
+        connection = sqlite3.connect(path)
+        connection.execute(
+            'CREATE TABLE history ('
+            'seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL, '
+            'username TEXT NOT NULL, command TEXT NOT NULL, host TEXT, '
+            'timestamp TEXT NOT NULL, meta TEXT NOT NULL, '
+            'UNIQUE (username, id))'
+        )
+        connection.execute(
+            "INSERT INTO history (id, username, command, timestamp, meta) "
+            "VALUES ('x', 'enigma', 'ls', '2016-01-01T00:00:00.000000', '{}')"
+        )
+        connection.commit()
+        connection.close()
+
+        data = archelond.data.SQLiteData({'SQLITE_PATH': path})
+        command = data.get('x', 'enigma', None)
+        self.assertEqual(1, command['count'])
+        self.assertEqual(command['timestamp'], command['last_used'])
+        data.add('pwd', 'enigma', None)
+        self.assertEqual(
+            ['pwd', 'ls'], self._commands(data.all('f', 'enigma', None))
+        )
+
+    def test_add_get_delete(self):
+        """
+        Verify the three single item operations work as expected.
+        """
+        command = 'echo "archelond is awesome"'
+        command_id = self.data.add(command, 'enigma', 'host', pumpkins=True)
+        self.assertEqual(command_id, self.data._doc_id(command))
+
+        command = self.data.get(command_id, 'enigma', None)
+        self.assertEqual(command['command'], 'echo "archelond is awesome"')
+        self.assertEqual(command['id'], command_id)
+        self.assertEqual(command['host'], 'host')
+        self.assertEqual(command['meta'], {'pumpkins': True})
+        self.assertIsNotNone(command['timestamp'].tzinfo)
+
+        # Other users can't see it
+        with self.assertRaises(KeyError):
+            self.data.get(command_id, 'norm', None)
+        with self.assertRaises(KeyError):
+            self.data.delete(command_id, 'norm', None)
+
+        # Adding again replaces it
+        self.data.add('echo "archelond is awesome"', 'enigma', None)
+        self.assertEqual(1, len(self.data.all(None, 'enigma', None)))
+        self.assertEqual({}, self.data.get(command_id, 'enigma', None)['meta'])
+
+        self.data.delete(command_id, 'enigma', None)
+        with self.assertRaises(KeyError):
+            self.data.get(command_id, 'enigma', None)
+        with self.assertRaises(KeyError):
+            self.data.delete(command_id, 'enigma', None)
+
+        # No user is allowed too
+        command_id = self.data.add('pwd', None, None)
+        self.assertIsNone(self.data.get(command_id, None, None)['username'])
+
+    def test_update_meta(self):
+        """
+        Updating a command's meta replaces it without counting a use.
+        """
+        user = 'enigma'
+        command_id = self.data.add('ls', user, None, pumpkins=True)
+        for _ in range(3):
+            self.data.update_meta(command_id, user, None, squash=1)
+        command = self.data.get(command_id, user, None)
+        self.assertEqual({'squash': 1}, command['meta'])
+        self.assertEqual(1, command['count'])
+        with self.assertRaises(KeyError):
+            self.data.update_meta('nope', user, None)
+
+    def test_bulk_add(self):
+        """
+        Verify bulk adds store everything, only once, and index it.
+        """
+        self.data.add('bulk 2', 'enigma', None)
+        commands = ['bulk 1', 'bulk 2', 'bulk 1', 'bulk 3']
+        cmd_ids = self.data.bulk_add(commands, 'enigma', None, pumpkins=True)
+        self.assertEqual([self.data._doc_id(x) for x in commands], cmd_ids)
+        results = self.data.filter('bulk', None, 'enigma', None)
+        self.assertEqual(
+            ['bulk 1', 'bulk 2', 'bulk 3'], self._commands(results)
+        )
+        self.assertEqual({'pumpkins': True}, results[1]['meta'])
+        self.assertEqual([2, 2, 1], [x['count'] for x in results])
+        self.assertEqual([], self.data.bulk_add([], 'enigma', None))
+
+    def test_all_filter(self):
+        """
+        Verify ordering and searching with and without the index.
+        """
+        commands = ['pip install -e .', 'pip freeze', 'make INSTALL', 'ls']
+        for command in commands:
+            self.data.add(command, 'enigma', None)
+        self.data.add('pip install six', 'norm', None)
+
+        self.assertEqual(
+            commands, self._commands(self.data.all(None, 'enigma', None))
+        )
+        self.assertEqual(
+            list(reversed(commands)),
+            self._commands(self.data.all('r', 'enigma', None))
+        )
+        self.assertEqual(
+            ['pip install -e .'],
+            self._commands(self.data.filter('install', None, 'enigma', None))
+        )
+        self.assertEqual(
+            ['pip freeze', 'pip install -e .'],
+            self._commands(self.data.filter('pi', 'r', 'enigma', None))
+        )
+        self.assertEqual(
+            [], self._commands(self.data.filter('"', None, 'enigma', None))
+        )
+
+        # Same answers without the index
+        self.data.fts = False
+        self.assertEqual(
+            ['pip install -e .'],
+            self._commands(self.data.filter('install', None, 'enigma', None))
+        )
+
+    def test_export(self):
+        """
+        Verify exports stream every matching command in order.
+        """
+        commands = ['pip install -e .', 'pip freeze', 'make INSTALL']
+        for command in commands:
+            self.data.add(command, 'enigma', None)
+        self.data.add('pip install six', 'norm', None)
+        now = datetime.utcnow().replace(tzinfo=pytz.utc)
+        hour = timedelta(hours=1)
+
+        self.assertEqual(
+            commands, self._commands(self.data.export('enigma', None))
+        )
+        self.assertEqual(
+            ['pip install -e .'],
+            self._commands(self.data.export('enigma', None, term='install'))
+        )
+        self.assertEqual(
+            [], self._commands(
+                self.data.export('enigma', None, until=now - hour)
+            )
+        )
+        self.assertEqual(
+            commands,
+            self._commands(self.data.export(
+                'enigma', None, since=now - hour, until=now + hour
+            ))
+        )
+
+    def test_paging(self):
+        """
+        Verify page numbers and cursors walk through every result once.
+        """
+        num_commands = self.data.NUM_RESULTS * 2 + 3
+        commands = [
+            'go giant turtle number {}'.format(x) for x in range(num_commands)
+        ]
+        for command in commands:
+            self.data.add(command, 'enigma', None)
+
+        for order, ordered in ((None, commands),
+                               ('r', list(reversed(commands)))):
+            pages = []
+            cursor = None
+            while True:
+                results = self.data.filter(
+                    'turtle', order, 'enigma', None, cursor=cursor
+                )
+                pages.append(self._commands(results))
+                cursor = results.cursor
+                if cursor is None:
+                    break
+            self.assertEqual(ordered, sum(pages, []))
+            self.assertEqual(
+                pages[1],
+                self._commands(
+                    self.data.all(order, 'enigma', None, page=1)
+                )
+            )
+
+        for cursor in ('garbage', 'WzFd', 'WyJhIiwiYiJd'):
+            with self.assertRaises(ValueError):
+                self.data.all(None, 'enigma', None, cursor=cursor)
+
+
+class TestCachedData(unittest.TestCase):
+    """
+    Verify the result cache in front of a MemoryData
+    """
+
+    def setUp(self):
+        """
+        Wrap an empty MemoryData with a small cache.
+        """
+        backend = archelond.data.MemoryData({})
+        backend.INITIAL_DATA = []
+        self.backend = mock.MagicMock(wraps=backend)
+        self.data = archelond.data.CachedData(
+            {'CACHE_SIZE': 2, 'CACHE_TTL': 10}, self.backend
+        )
+
+    def test_hits_and_misses(self):
+        """
+        Repeated searches are served from the cache.
+        """
+        self.data.add('echo hi', 'enigma', None)
+        first = self.data.filter('echo', None, 'enigma', None)
+        second = self.data.filter('echo', None, 'enigma', None)
+        self.assertEqual(first, second)
+        self.assertEqual(1, self.backend.filter.call_count)
+        # Different pages, orders and users are different entries
+        self.data.filter('echo', 'r', 'enigma', None)
+        self.data.filter('echo', None, 'norm', None)
+        self.assertEqual(3, self.backend.filter.call_count)
+        stats = self.data.cache_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(2, stats['entries'])
+
+    def test_invalidation(self):
+        """
+        Changes drop only the changing user's cached pages.
+        """
+        self.data.all(None, 'enigma', None)
+        self.data.all(None, 'norm', None)
+        cmd_id = self.data.add('echo hi', 'enigma', None)
+        self.assertEqual(
+            ['echo hi'],
+            [x['command'] for x in self.data.all(None, 'enigma', None)]
+        )
+        self.data.all(None, 'norm', None)
+        self.assertEqual(3, self.backend.all.call_count)
+
+        self.data.delete(cmd_id, 'enigma', None)
+        self.assertEqual([], self.data.all(None, 'enigma', None))
+        self.data.bulk_add(['ls', 'pwd'], 'enigma', None)
+        self.assertEqual(2, len(self.data.all(None, 'enigma', None)))
+        self.assertEqual(5, self.backend.all.call_count)
+        # A failed delete still invalidates, leaving only norm's page
+        with self.assertRaises(KeyError):
+            self.data.delete('nope', 'enigma', None)
+        self.assertEqual(1, self.data.cache_stats()['entries'])
+
+    def test_ttl(self):
+        """
+        Cached pages expire.
+        """
+        with mock.patch('archelond.data.cache.time') as time_mock:
+            time_mock.time.return_value = 100
+            self.data.all(None, 'enigma', None)
+            time_mock.time.return_value = 109
+            self.data.all(None, 'enigma', None)
+            self.assertEqual(1, self.backend.all.call_count)
+            time_mock.time.return_value = 111
+            self.data.all(None, 'enigma', None)
+            self.assertEqual(2, self.backend.all.call_count)
+
+    def test_cursor(self):
+        """
+        Cursors are part of the key and survive the cache.
+        """
+        self.data.bulk_add(
+            [str(x) for x in range(self.data.NUM_RESULTS + 1)],
+            'enigma', None
+        )
+        first = self.data.all(None, 'enigma', None)
+        self.assertIsNotNone(first.cursor)
+        self.assertEqual(
+            first.cursor, self.data.all(None, 'enigma', None).cursor
+        )
+        self.assertEqual(
+            1, len(self.data.all(None, 'enigma', None, cursor=first.cursor))
+        )
+
+
+class TestMeteredData(unittest.TestCase):
+    """
+    Verify calls to a MemoryData are measured
+    """
+
+    def setUp(self):
+        """
+        Wrap an empty MemoryData.
+        """
+        backend = archelond.data.MemoryData({})
+        backend.INITIAL_DATA = []
+        self.metrics = Metrics({})
+        self.data = archelond.data.MeteredData({}, backend, self.metrics)
+
+    def _counters(self, name):
+        """
+        Values of a counter by labels.
+        """
+        return dict(
+            (labels, value)
+            for (key_name, labels), value in self.metrics.collect()[0].items()
+            if key_name == name
+        )
+
+    def test_calls(self):
+        """
+        Latency of every call, results returned and bulk sizes.
+        """
+        self.data.add('ls', 'enigma', None)
+        self.data.bulk_add(['pwd', 'id'], 'enigma', None)
+        self.assertEqual(2, len(self.data.filter('d', None, 'enigma', None)))
+        self.assertEqual(3, len(self.data.all(None, 'enigma', None)))
+        self.assertEqual(3, len(list(self.data.export('enigma', None))))
+        with self.assertRaises(KeyError):
+            self.data.get('nope', 'enigma', None)
+
+        histograms = self.metrics.collect()[1]
+        for method in ('add', 'bulk_add', 'filter', 'all', 'export', 'get'):
+            self.assertEqual(
+                1,
+                histograms[(
+                    'archelond_data_seconds', (('method', method),)
+                )][2]
+            )
+        self.assertEqual({
+            (('method', 'filter'),): 2,
+            (('method', 'all'),): 3,
+            (('method', 'export'),): 3,
+        }, self._counters('archelond_data_results_total'))
+        self.assertEqual(
+            {(('error', 'KeyError'), ('method', 'get')): 1},
+            self._counters('archelond_data_errors_total')
+        )
+        bulk_size = histograms[
+            ('archelond_bulk_size', (('method', 'bulk_add'),))
+        ]
+        self.assertEqual([0, 1], bulk_size[0][:2])
+        self.assertEqual(2, bulk_size[1])
+
 
 class TestElasticData(ElasticTestClass):
     """Test out elastic search backed data store.
@@ -209,6 +1059,31 @@ class TestElasticData(ElasticTestClass):
             }
         )
 
+    def test_lazy_bootstrap(self):
+        """
+        Verify we don't touch Elasticsearch until the data store is
+        used, and then only create the index once per process.
+        """
+        client = self.data.elasticsearch
+        client.indices.delete(self.config['ELASTICSEARCH_INDEX'])
+        self.data._verified.clear()
+
+        data = archelond.data.ElasticData(self.config)
+        self.assertFalse(
+            client.indices.exists(self.config['ELASTICSEARCH_INDEX'])
+        )
+        self.assertEqual([], data.all(None, 'enigma', None))
+        self.assertTrue(
+            client.indices.exists(self.config['ELASTICSEARCH_INDEX'])
+        )
+        self.assertIn(data._index_key(), data._verified)
+
+        # Nothing to connect to, but nothing is sent until it's used
+        archelond.data.ElasticData({
+            'ELASTICSEARCH_URL': 'localhost:1',
+            'ELASTICSEARCH_INDEX': 'nowhere',
+        })
+
     def test_doc_type(self):
         """
         Test that we are using the right document type
@@ -252,6 +1127,20 @@ class TestElasticData(ElasticTestClass):
         with self.assertRaises(KeyError):
             self.data.delete(command_id, user, None)
 
+    def test_update_meta(self):
+        """
+        Updating a command's meta replaces it without counting a use.
+        """
+        user = 'archelon-jr'
+        command_id = self.data.add('ls', user, None, pumpkins=True)
+        for _ in range(3):
+            self.data.update_meta(command_id, user, None, squash=1)
+        command = self.data.get(command_id, user, None)
+        self.assertEqual({'squash': 1}, command['meta'])
+        self.assertEqual(1, command['count'])
+        with self.assertRaises(KeyError):
+            self.data.update_meta('nope', user, None)
+
     def test_all(self):
         """
         Since this is paged and we don't support paging yet, we won't
@@ -294,6 +1183,53 @@ class TestElasticData(ElasticTestClass):
         self.assertEqual(1, len(results))
         self.assertFalse('petes' in results[0]['command'])
 
+    def test_ngram_search(self):
+        """
+        Recreate the index with the n-gram subfield and verify we
+        find terms in the middle of commands.
+        """
+        user = 'archelon-jr'
+        client = self.data.elasticsearch
+        client.indices.delete(self.config['ELASTICSEARCH_INDEX'])
+        config = dict(self.config)
+        config['ELASTICSEARCH_NGRAM'] = True
+        data = archelond.data.ElasticData(config)
+        data.bootstrap()
+        self.assertTrue(data.ngram)
+
+        data.add('pip install -e .', user, None)
+        data.add('pip freeze', user, None)
+        data.add('ls', user, None)
+        time.sleep(2)
+        self.assertEqual(
+            ['pip install -e .'],
+            [x['command'] for x in data.filter('install', None, user, None)]
+        )
+        self.assertEqual(
+            [], data.filter('install pip', None, user, None)
+        )
+        # Too short for an n-gram, so we match the start
+        self.assertEqual(
+            ['ls'],
+            [x['command'] for x in data.filter('l', None, user, None)]
+        )
+
+    def test_ngram_unmapped(self):
+        """
+        Configuring n-grams for an index created without them warns
+        and keeps searching the start of commands.
+        """
+        config = dict(self.config)
+        config['ELASTICSEARCH_NGRAM'] = True
+        data = archelond.data.ElasticData(config)
+        with mock.patch('archelond.data.elastic.log') as log:
+            data.bootstrap()
+        self.assertFalse(data.ngram)
+        self.assertIn('without', log.warning.call_args[0])
+        self.assertIn(
+            'match_phrase_prefix', data._query('install')
+        )
+
     def test_page(self):
         """
         Test that paging works
@@ -318,6 +1254,197 @@ class TestElasticData(ElasticTestClass):
         results = self.data.all('r', user, None, page=2)
         self.assertEqual(0, len(results))
 
+    def test_cursor(self):
+        """
+        Walk all the pages with cursors and make sure nothing is
+        skipped or repeated.
+        """
+        user = 'archelon-jr'
+        commands = [
+            'go giant turtle number {}'.format(x)
+            for x in range(self.data.NUM_RESULTS * 2 + 1)
+        ]
+        self.data.bulk_add(commands, user, None)
+        time.sleep(2)
+
+        seen = []
+        cursor = None
+        while True:
+            results = self.data.all('r', user, None, cursor=cursor)
+            seen.extend(x['command'] for x in results)
+            cursor = results.cursor
+            if cursor is None:
+                break
+        self.assertEqual(sorted(commands), sorted(seen))
+
+        with self.assertRaises(ValueError):
+            self.data.all('r', user, None, cursor='WyJiIiwxXQ==')
+
+    def test_cursor_kind(self):
+        """
+        Cursors only use search_after when the cluster has it, and
+        page by offset otherwise.
+        """
+        self.assertTrue(
+            self.data.has_search_after({'version': {'number': '5.6.16'}})
+        )
+        self.assertFalse(
+            self.data.has_search_after({'version': {'number': '1.7.5'}})
+        )
+        self.assertFalse(self.data.has_search_after({}))
+
+        user = 'archelon-jr'
+        self.data.bulk_add(
+            ['ls {}'.format(x) for x in range(self.data.NUM_RESULTS + 1)],
+            user, None
+        )
+        time.sleep(2)
+        cursor = self.data.all('r', user, None).cursor
+        kind = decode_cursor(cursor)[0]
+        self.assertEqual(
+            'after' if self.data.search_after else 'from', kind
+        )
+
+    def test_sort_tiebreaker(self):
+        """
+        Only clusters that page with search_after sort on the
+        tiebreaker, since it loads fielddata.
+        """
+        key = self.data._index_key()
+        self.addCleanup(
+            self.data._search_after.__setitem__, key, self.data.search_after
+        )
+        self.data._search_after[key] = False
+        for order in (None, 'r', 'f'):
+            sort = '{0}'.format(self.data._sort(order))
+            self.assertNotIn(self.data.TIEBREAKER_FIELD, sort)
+        self.data._search_after[key] = True
+        self.assertEqual(
+            [{'timestamp': 'desc'}, {self.data.TIEBREAKER_FIELD: 'desc'}],
+            self.data._sort('r')
+        )
+
+    def test_cursor_scroll(self):
+        """
+        With ELASTICSEARCH_SCROLL set, first pages don't open scroll
+        contexts, and cursors scroll through everything once.
+        """
+        self.config['ELASTICSEARCH_SCROLL'] = '1m'
+        data = archelond.data.ElasticData(self.config)
+        user = 'archelon-jr'
+        commands = [
+            'go giant turtle number {}'.format(x)
+            for x in range(data.NUM_RESULTS * 2 + 1)
+        ]
+        data.bulk_add(commands, user, None)
+        time.sleep(2)
+
+        first = data.all('r', user, None)
+        self.assertNotEqual('scroll', decode_cursor(first.cursor)[0])
+        seen = [x['command'] for x in first]
+        cursor = first.cursor
+        while cursor:
+            results = data.all('r', user, None, cursor=cursor)
+            seen.extend(x['command'] for x in results)
+            cursor = results.cursor
+            if cursor:
+                self.assertEqual('scroll', decode_cursor(cursor)[0])
+        self.assertEqual(sorted(commands), sorted(seen))
+
+        # Deeper offsets page with from instead of scrolling to them
+        deep = encode_cursor(['from', data.NUM_RESULTS * 2])
+        with mock.patch.object(data, '_scroll') as scroll:
+            results = data.all('r', user, None, cursor=deep)
+        self.assertFalse(scroll.called)
+        self.assertEqual(1, len(results))
+
+    def test_bulk_add(self):
+        """
+        Verify bulk adds index everything and report ids in order
+        """
+        user = 'archelon-jr'
+        commands = [
+            'go giant turtle number {}'.format(x)
+            for x in range(self.data.BULK_CHUNK_SIZE + 1)
+        ]
+        cmd_ids = self.data.bulk_add(commands, user, None)
+        self.assertEqual([self.data._doc_id(x) for x in commands], cmd_ids)
+        time.sleep(2)
+        self.assertEqual(
+            commands[-1], self.data.get(cmd_ids[-1], user, None)['command']
+        )
+
+    def test_export(self):
+        """
+        Verify exports scan every matching command.
+        """
+        user = 'archelon-jr'
+        commands = [
+            'go giant turtle number {}'.format(x)
+            for x in range(self.data.BULK_CHUNK_SIZE + 1)
+        ]
+        self.data.bulk_add(commands + ['ls'], user, None)
+        time.sleep(2)
+        self.assertEqual(
+            sorted(commands + ['ls']),
+            sorted(x['command'] for x in self.data.export(user, None))
+        )
+        self.assertEqual(
+            sorted(commands),
+            sorted(x['command'] for x in self.data.export(
+                user, None, term='go giant'
+            ))
+        )
+        future = datetime.utcnow().replace(tzinfo=pytz.utc) + timedelta(
+            hours=1
+        )
+        self.assertEqual([], list(self.data.export(user, None, since=future)))
+
+    def test_frecency(self):
+        """
+        Verify adds are counted without scripts and the ``f``
+        ordering puts the most used first.
+        """
+        user = 'archelon-jr'
+        self.assertFalse(self.data.scripted)
+        self.data.bulk_add(['ls', 'make', 'git status'], user, None)
+        self.data.add('make', user, None)
+        self.data.bulk_add(['make', 'git status'], user, None)
+        time.sleep(2)
+        command = self.data.get(self.data._doc_id('make'), user, None)
+        self.assertEqual(3, command['count'])
+        self.assertEqual(
+            ['make', 'git status', 'ls'],
+            [x['command'] for x in self.data.all('f', user, None)]
+        )
+
+    def test_unscripted(self):
+        """
+        Uses are still counted once the cluster refuses to run the
+        use counting script.
+        """
+        user = 'archelon-jr'
+        self.data.script = True
+        self.addCleanup(self.data._unscripted.discard, self.data._index_key())
+        cmd_id = self.data.add('make', user, None)
+        refusal = RequestError(
+            400, 'ScriptException[scripts of type [inline], operation '
+            '[update] and lang [groovy] are disabled]', {}
+        )
+        with mock.patch.object(
+                self.data.elasticsearch, 'update', side_effect=refusal
+        ):
+            self.assertEqual(cmd_id, self.data.add('make', user, None))
+        self.assertFalse(self.data.scripted)
+        self.assertEqual(
+            [cmd_id, self.data._doc_id('ls'), self.data._doc_id('ls')],
+            self.data.bulk_add(['make', 'ls', 'ls'], user, None)
+        )
+        self.assertEqual(3, self.data.get(cmd_id, user, None)['count'])
+        self.assertEqual(
+            2, self.data.get(self.data._doc_id('ls'), user, None)['count']
+        )
+
     def test_bad_connection(self):
         """
         Replace the data storage class instance with a dead one
@@ -2,37 +2,71 @@
 Validate log configuration
 """
 from __future__ import absolute_import, unicode_literals
+import itertools
+import logging
 import os
+import threading
 import unittest
 
 import mock
 from six import assertRaisesRegex
 
+import archelond.log
+from archelond.log import configure_logging, log_payload
 from archelond.web import app
 
 TEST_LOG_LEVEL = 'DEBUG'
 
 
+class CaptureHandler(logging.Handler):
+    """
+    Keep records and the thread that handled them.
+    """
+
+    def __init__(self):
+        """
+        Start with nothing captured.
+        """
+        logging.Handler.__init__(self)
+        self.records = []
+        self.threads = []
+
+    def emit(self, record):
+        """
+        Capture the record.
+        """
+        self.records.append(record)
+        self.threads.append(threading.current_thread())
+
+
 class TestLogConfiguration(unittest.TestCase):
     """
     Make sure we are setting up logging like we expect.
     """
     # pylint: disable=R0904
 
+    def setUp(self):
+        """
+        Keep the root logger how we found it.
+        """
+        root_logger = logging.getLogger()
+        self.addCleanup(root_logger.setLevel, root_logger.level)
+        self.addCleanup(
+            setattr, root_logger, 'handlers', list(root_logger.handlers)
+        )
+        self.addCleanup(
+            archelond.log._stop_listener  # pylint: disable=protected-access
+        )
+
     @mock.patch.dict(app.config,
                      {'LOG_LEVEL': TEST_LOG_LEVEL})
     def test_config_log_level(self):
         """
         Patch config and make sure we are setting to it
         """
-        import logging
-        root_logger = logging.getLogger()
-        log_level = root_logger.level
-        self.assertEqual(logging.NOTSET, log_level)
-
-        from archelond.log import configure_logging
         log_level = configure_logging(app)
         root_logger = logging.getLogger()
+        self.assertEqual(log_level, getattr(logging, TEST_LOG_LEVEL))
         self.assertEqual(root_logger.level, getattr(logging, TEST_LOG_LEVEL))
 
     @mock.patch.dict(app.config,
@@ -41,51 +75,25 @@ class TestLogConfiguration(unittest.TestCase):
         """
         Set a non-existent log level and make sure we raise properly
         """
-        import logging
-        root_logger = logging.getLogger()
-        log_level = root_logger.level
-        self.assertEqual(logging.NOTSET, log_level)
-
-        from archelond.log import configure_logging
         with assertRaisesRegex(self, ValueError, 'Invalid log level.+'):
-            log_level = configure_logging(app)
+            configure_logging(app)
 
     @mock.patch.dict(app.config,
                      {'LOG_LEVEL': None})
     def test_no_log_level(self):
         """
-        Make sure we leave things alone if no log level is set.
+        Make sure we don't pay for debug messages if no log level is
+        set.
         """
-        import logging
-        root_logger = logging.getLogger()
-        log_level = root_logger.level
-        self.assertEqual(logging.NOTSET, log_level)
-
-        from archelond.log import configure_logging
         log_level = configure_logging(app)
-        self.assertEqual(logging.NOTSET, log_level)
+        self.assertEqual(logging.INFO, log_level)
+        self.assertEqual(logging.INFO, logging.getLogger().level)
 
     def test_syslog_devices(self):
         """
         Test syslog address handling and handler
         """
-        # Pylint in Python 3.4 (not 3.3 or 2.7), is triggering
-        # this for syslog_handler.address even though the asserts
-        # show it is available at runtime.
-        # pylint: disable=no-member
-        import logging
-
         for log_device in ['/dev/log', '/var/run/syslog', '']:
-            root_logger = logging.getLogger()
-            # Nuke syslog handlers from init
-            syslog_handlers = []
-            for handler in root_logger.handlers:
-                if isinstance(handler, logging.handlers.SysLogHandler):
-                    syslog_handlers.append(handler)
-            for handler in syslog_handlers:
-                root_logger.removeHandler(handler)
-
-            real_exists = os.path.exists(log_device)
 
             def mock_effect(*args):
                 """Contextual choice of log device."""
@@ -93,23 +101,93 @@ class TestLogConfiguration(unittest.TestCase):
                     return True
                 return False
 
-            # Call so that it will think /dev/log exists
-            with mock.patch('os.path') as os_exists:
+            with mock.patch('archelond.log.os.path') as os_exists, \
+                    mock.patch('archelond.log.SysLogHandler') as syslog_mock:
                 os_exists.exists.side_effect = mock_effect
-                from archelond.log import configure_logging
-                if not real_exists and log_device != '':
-                    with self.assertRaises(Exception):
-                        configure_logging(app)
-                else:
-                    configure_logging(app)
-                    syslog_handler = None
-                    for handler in root_logger.handlers:
-                        if isinstance(handler, logging.handlers.SysLogHandler):
-                            syslog_handler = handler
-                    self.assertIsNotNone(syslog_handler)
-                    if log_device == '':
-                        self.assertEqual(
-                            syslog_handler.address, ('127.0.0.1', 514)
-                        )
-                    else:
-                        self.assertEqual(syslog_handler.address, log_device)
+                configure_logging(app)
+            self.assertIn(
+                syslog_mock.return_value, app.log_listener.handlers
+            )
+            syslog_mock.assert_called_once_with(
+                address=log_device or ('127.0.0.1', 514),
+                facility=syslog_mock.LOG_LOCAL0
+            )
+
+    def test_reconfigure(self):
+        """
+        Configuring again replaces our handler and listener.
+        """
+        root_logger = logging.getLogger()
+        configure_logging(app)
+        first = app.log_listener
+        configure_logging(app)
+        self.assertNotIn(first.queue_handler, root_logger.handlers)
+        self.assertIn(app.log_listener.queue_handler, root_logger.handlers)
+        # pylint: disable=protected-access
+        self.assertIsNone(first._thread)
+        self.assertIsNotNone(app.log_listener._thread)
+
+    def test_queued(self):
+        """
+        Records are handled by the listener thread, with the message
+        as it was when logged.
+        """
+        configure_logging(app)
+        capture = CaptureHandler()
+        app.log_listener.handlers = (capture,)
+        arguments = ['there']
+        logging.getLogger('archelond.test').info('hello %s', arguments)
+        arguments.append('again')
+        archelond.log._stop_listener()  # pylint: disable=protected-access
+
+        self.assertEqual(1, len(capture.records))
+        self.assertEqual("hello ['there']", capture.records[0].getMessage())
+        self.assertNotEqual(threading.current_thread(), capture.threads[0])
+
+    def test_after_fork(self):
+        """
+        Forked processes get their own queue and listener thread.
+        """
+        configure_logging(app)
+        listener = app.log_listener
+        capture = CaptureHandler()
+        listener.handlers = (capture,)
+        old_queue = listener.queue
+        # Only the forking thread is left in the child
+        listener.stop()
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            logging.getLogger('archelond.test').warning('forked')
+            self.assertIsNot(old_queue, listener.queue)
+            self.assertIs(listener.queue, listener.queue_handler.queue)
+            self.assertEqual(os.getpid(), listener.pid)
+            # pylint: disable=protected-access
+            archelond.log._stop_listener()
+        self.assertEqual(['forked'], [x.msg for x in capture.records])
+
+    @mock.patch.dict(app.config,
+                     {'LOG_PAYLOAD_SAMPLE': 3, 'LOG_PAYLOAD_MAX_SIZE': 100})
+    def test_log_payload(self):
+        """
+        Payloads are sampled and cut short, and not even looked at
+        when their level is off.
+        """
+        configure_logging(app)
+        logger = mock.Mock()
+        logger.isEnabledFor.return_value = True
+        payload = {'hits': [{'command': 'x' * 1000}] * 1000}
+        with mock.patch('archelond.log._PAYLOAD_COUNT', itertools.count()):
+            for _ in range(6):
+                log_payload(logger, 'Payload: %s', payload)
+        self.assertEqual(2, logger.log.call_count)
+        level, message, text = logger.log.call_args[0]
+        self.assertEqual(logging.DEBUG, level)
+        self.assertEqual('Payload: %s', message)
+        self.assertEqual(103, len(text))
+        self.assertTrue(text.startswith("{'hits': [{'command': 'xxx"))
+
+        logger.reset_mock()
+        logger.isEnabledFor.return_value = False
+        with mock.patch('archelond.log._PAYLOAD_REPR') as repr_mock:
+            log_payload(logger, 'Payload: %s', payload)
+        self.assertFalse(repr_mock.repr.called)
+        self.assertFalse(logger.log.called)
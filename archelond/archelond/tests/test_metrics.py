@@ -0,0 +1,146 @@
+"""
+Test metrics and their text format
+"""
+from __future__ import absolute_import, unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from archelond.metrics import Metrics, cache_collector
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Verify counting, rendering and adding up processes
+    """
+
+    def setUp(self):
+        """
+        Make a directory for processes to write their metrics to.
+        """
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def _metrics(self):
+        """
+        Metrics writing to our directory until the test is over.
+        """
+        metrics = Metrics({'METRICS_PATH': self.path})
+        self.addCleanup(setattr, metrics, 'filename', None)
+        return metrics
+
+    def test_render(self):
+        """
+        Counters and cumulative histograms in the text format.
+        """
+        metrics = Metrics({})
+        labels = {'route': 'history', 'method': 'GET', 'status': 200}
+        metrics.inc('archelond_requests_total', labels)
+        metrics.inc('archelond_requests_total', labels)
+        for value in (0.002, 0.002, 20):
+            metrics.observe(
+                'archelond_request_seconds',
+                {'route': 'history', 'method': 'GET'}, value
+            )
+        cache = mock.Mock()
+        cache.cache_stats.return_value = {
+            'hits': 3, 'misses': 1, 'evictions': 2, 'invalidations': 4
+        }
+        metrics.add_collector(cache_collector('archelond_auth_cache', cache))
+
+        text = metrics.render()
+        self.assertIn('# TYPE archelond_requests_total counter\n', text)
+        self.assertIn(
+            'archelond_requests_total{method="GET",route="history",'
+            'status="200"} 2\n', text
+        )
+        self.assertIn(
+            'archelond_request_seconds_bucket{method="GET",route="history",'
+            'le="0.001"} 0\n', text
+        )
+        self.assertIn(
+            'archelond_request_seconds_bucket{method="GET",route="history",'
+            'le="0.0025"} 2\n', text
+        )
+        self.assertIn(
+            'archelond_request_seconds_bucket{method="GET",route="history",'
+            'le="+Inf"} 3\n', text
+        )
+        self.assertIn(
+            'archelond_request_seconds_sum{method="GET",route="history"} '
+            '20.004\n', text
+        )
+        self.assertIn(
+            'archelond_request_seconds_count{method="GET",route="history"} '
+            '3\n', text
+        )
+        self.assertIn('archelond_auth_cache_hits_total 3\n', text)
+        self.assertIn('archelond_auth_cache_misses_total 1\n', text)
+        self.assertIn('archelond_auth_cache_evictions_total 2\n', text)
+        self.assertIn('archelond_auth_cache_invalidations_total 4\n', text)
+        self.assertIn(
+            '# TYPE archelond_auth_cache_invalidations_total counter\n', text
+        )
+
+    def test_processes(self):
+        """
+        Every process's file is added to the one scraped.
+        """
+        first = self._metrics()
+        second = self._metrics()
+        for metrics in (first, second):
+            metrics.inc('archelond_data_results_total', {'method': 'all'}, 5)
+            metrics.observe(
+                'archelond_bulk_size', {'method': 'bulk_add'}, 100
+            )
+        first.write()
+        self.assertEqual(1, len(os.listdir(self.path)))
+        # Unreadable files are skipped
+        with open(os.path.join(self.path, 'bad.json'), 'w') as bad_file:
+            bad_file.write('{"counters": [')
+
+        counters, histograms = second.collect()
+        self.assertEqual(
+            10,
+            counters[('archelond_data_results_total', (('method', 'all'),))]
+        )
+        histogram = histograms[
+            ('archelond_bulk_size', (('method', 'bulk_add'),))
+        ]
+        self.assertEqual(2, histogram[0][3])
+        self.assertEqual(2, histogram[2])
+
+        # Writing again replaces the process's file
+        first.inc('archelond_data_results_total', {'method': 'all'})
+        first.write()
+        self.assertEqual(2, len(os.listdir(self.path)))
+        counters = second.collect()[0]
+        self.assertEqual(
+            11,
+            counters[('archelond_data_results_total', (('method', 'all'),))]
+        )
+
+    def test_fork(self):
+        """
+        Forked processes start counting from nothing in a file of
+        their own.
+        """
+        metrics = self._metrics()
+        metrics.inc('archelond_data_results_total', {'method': 'all'})
+        metrics.write()
+        filename = metrics.filename
+        with mock.patch('archelond.metrics.os.getpid', return_value=-1):
+            self.assertEqual([], metrics.snapshot()['counters'])
+            metrics.write()
+            self.assertNotEqual(filename, metrics.filename)
+            # The parent's counts are still in its file
+            self.assertEqual(
+                1,
+                metrics.collect()[0][
+                    ('archelond_data_results_total', (('method', 'all'),))
+                ]
+            )
+        self.assertEqual(2, len(os.listdir(self.path)))
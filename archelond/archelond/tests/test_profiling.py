@@ -0,0 +1,111 @@
+"""
+Test the sampling request profiler
+"""
+from __future__ import absolute_import, unicode_literals
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from archelond.profiling import SamplingProfiler
+
+
+def application(environ, start_response):
+    """
+    WSGI application streaming a response in a few chunks.
+    """
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    for chunk in (b'a', b'b', b'c'):
+        yield chunk
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    """
+    Verify which requests are profiled and what is written
+    """
+
+    def setUp(self):
+        """
+        Make a directory for profiles.
+        """
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.path = os.path.join(path, 'profiles')
+
+    def _request(self, profiler, **environ):
+        """
+        Send a request through the profiler and read the response.
+        """
+        environ.setdefault('REQUEST_METHOD', 'GET')
+        environ.setdefault('PATH_INFO', '/api/v1/history')
+        return b''.join(profiler(environ, lambda status, headers: None))
+
+    def test_sample(self):
+        """
+        One in PROFILE_SAMPLE requests is profiled, including
+        streaming the response.
+        """
+        profiler = SamplingProfiler(
+            application, {'PROFILE_PATH': self.path, 'PROFILE_SAMPLE': 2}
+        )
+        for _ in range(4):
+            self.assertEqual(b'abc', self._request(profiler))
+        profiles = sorted(os.listdir(self.path))
+        self.assertEqual(2, len(profiles))
+        self.assertIn('-GET_api_v1_history-', profiles[0])
+        self.assertTrue(profiles[0].endswith('ms.prof'))
+
+        stats = pstats.Stats(os.path.join(self.path, profiles[0]))
+        functions = [function[2] for function in stats.stats]
+        self.assertIn('application', functions)
+
+    def test_header(self):
+        """
+        Requests with the secret in the header are always profiled,
+        others only when sampling.
+        """
+        profiler = SamplingProfiler(
+            application, {'PROFILE_PATH': self.path, 'PROFILE_SAMPLE': 0}
+        )
+        self.assertEqual(b'abc', self._request(profiler))
+        # Without a secret the header does nothing
+        self._request(profiler, HTTP_X_ARCHELOND_PROFILE='1')
+        self.assertEqual([], os.listdir(self.path))
+
+        profiler = SamplingProfiler(application, {
+            'PROFILE_PATH': self.path, 'PROFILE_SECRET': 'sesame'
+        })
+        self._request(profiler, HTTP_X_ARCHELOND_PROFILE='1')
+        self.assertEqual([], os.listdir(self.path))
+        self._request(profiler, HTTP_X_ARCHELOND_PROFILE='sesame')
+        self.assertEqual(1, len(os.listdir(self.path)))
+
+    def test_max_files(self):
+        """
+        Nothing more is profiled once there are PROFILE_MAX_FILES
+        profiles.
+        """
+        profiler = SamplingProfiler(application, {
+            'PROFILE_PATH': self.path, 'PROFILE_SAMPLE': 1,
+            'PROFILE_SECRET': 'sesame', 'PROFILE_MAX_FILES': 2
+        })
+        for _ in range(3):
+            self.assertEqual(b'abc', self._request(profiler))
+        self._request(profiler, HTTP_X_ARCHELOND_PROFILE='sesame')
+        self.assertEqual(2, len(os.listdir(self.path)))
+
+    def test_error(self):
+        """
+        Requests that raise are still written out.
+        """
+        def broken(environ, start_response):
+            """Fail before responding."""
+            raise ValueError('oops')
+
+        profiler = SamplingProfiler(
+            broken, {'PROFILE_PATH': self.path, 'PROFILE_SAMPLE': 1}
+        )
+        with self.assertRaises(ValueError):
+            self._request(profiler)
+        self.assertEqual(1, len(os.listdir(self.path)))
@@ -0,0 +1,144 @@
+"""
+Test the write behind ingestion spool
+"""
+from __future__ import absolute_import, unicode_literals
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from archelond.data import MemoryData
+from archelond.spool import Spool, SpoolFlusher
+
+
+class TestSpool(unittest.TestCase):
+    """
+    Verify spooling and flushing commands
+    """
+
+    def setUp(self):
+        """
+        Make a spool in a temporary directory and an empty data store.
+        """
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.spool = Spool(os.path.join(self.path, 'spool.sqlite'))
+        self.data = MemoryData({})
+        self.data.INITIAL_DATA = []
+        self.flusher = SpoolFlusher(
+            self.spool, self.data,
+            {'SPOOL_BATCH_SIZE': 2, 'SPOOL_MAX_ATTEMPTS': 2}
+        )
+
+    def _commands(self, username):
+        """
+        All of a user's commands in the data store.
+        """
+        return [x['command'] for x in self.data.all(None, username, None)]
+
+    def test_claim_ack(self):
+        """
+        Claimed commands are hidden from other claims until acked or
+        their lease runs out.
+        """
+        self.spool.put(['ls', 'pwd', 'id'], 'enigma', '127.0.0.1', foo=1)
+        self.assertEqual(3, self.spool.stats()['depth'])
+        rows = self.spool.claim(2)
+        self.assertEqual(['ls', 'pwd'], [x['command'] for x in rows])
+        self.assertEqual(['id'], [x['command'] for x in self.spool.claim(2)])
+        self.assertEqual([], self.spool.claim(2))
+
+        self.spool.ack([x['id'] for x in rows])
+        self.assertEqual(1, self.spool.stats()['depth'])
+        with mock.patch('archelond.spool.time') as time_mock:
+            time_mock.time.return_value = time.time() + self.spool.lease + 1
+            self.assertEqual(
+                ['id'], [x['command'] for x in self.spool.claim(2)]
+            )
+
+    def test_flush(self):
+        """
+        Flushing moves commands to the data store in batches, by user.
+        """
+        self.spool.put(['ls', 'pwd'], 'enigma', None)
+        self.spool.put(['id'], 'norm', None)
+        self.assertEqual(2, self.flusher.flush())
+        self.assertEqual(['ls', 'pwd'], self._commands('enigma'))
+        self.assertEqual(1, self.flusher.flush())
+        self.assertEqual(['id'], self._commands('norm'))
+        self.assertEqual(0, self.flusher.flush())
+
+        stats = self.flusher.stats()
+        self.assertEqual(0, stats['depth'])
+        self.assertEqual(3, stats['flushed'])
+        self.assertIsNotNone(stats['last_flush'])
+
+    def test_retry(self):
+        """
+        Failed commands back off and are eventually dropped.
+        """
+        self.spool.put(['ls'], 'enigma', None)
+        with mock.patch.object(self.data, 'bulk_add') as bulk_mock:
+            bulk_mock.side_effect = Exception('down')
+            self.flusher.flush()
+            # Backing off, so nothing to claim right away
+            self.assertEqual(0, self.flusher.flush())
+            self.assertEqual(1, self.spool.stats()['depth'])
+
+            bulk_mock.side_effect = None
+            bulk_mock.return_value = [None]
+            with mock.patch('archelond.spool.time') as time_mock:
+                time_mock.time.return_value = time.time() + 10
+                self.assertEqual(1, self.flusher.flush())
+        stats = self.flusher.stats()
+        self.assertEqual(0, stats['depth'])
+        self.assertEqual(2, stats['failed'])
+        self.assertEqual(1, stats['dropped'])
+
+    def test_notify(self):
+        """
+        The flusher thread starts on demand and drains the spool.
+        """
+        self.flusher.interval = 0.01
+        self.spool.put(['ls', 'pwd'], 'enigma', None)
+        self.flusher.notify(2)
+        self.assertTrue(self.flusher.thread.is_alive())
+        for _ in range(100):
+            if self.flusher.stats()['flushed'] == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(['ls', 'pwd'], self._commands('enigma'))
+
+    def test_start(self):
+        """
+        The first request in a process starts draining what is already
+        spooled, without anything new being added.
+        """
+        self.flusher.interval = 0.01
+        self.spool.put(['ls'], 'enigma', None)
+        self.flusher.start()
+        thread = self.flusher.thread
+        self.assertTrue(thread.is_alive())
+        self.flusher.start()
+        self.assertIs(thread, self.flusher.thread)
+        for _ in range(100):
+            if self.flusher.stats()['flushed'] == 1:
+                break
+            time.sleep(0.05)
+        self.assertEqual(['ls'], self._commands('enigma'))
+
+    def test_fork(self):
+        """
+        No connection is left open to be inherited by forked workers,
+        and each process opens its own.
+        """
+        self.assertIsNone(self.spool.local.connection)
+        connection = self.spool._connection()
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(connection, self.spool._connection())
+        self.assertEqual([connection], self.spool.inherited)
+        self.spool.put(['ls'], 'enigma', None)
+        self.assertEqual(1, self.spool.stats()['depth'])
@@ -2,12 +2,17 @@
 Unit tests for :py:module:`archelond.util`.
 """
 from __future__ import absolute_import, unicode_literals
+from io import BytesIO
+import json
 import unittest
+import zlib
 
 from flask import Response
 from six import assertRaisesRegex
 
-from archelond.util import jsonify_code
+from archelond.util import (
+    gzip_chunks, jsonify_code, ndjson_chunks, ndjson_lines
+)
 from archelond.web import app
 
 
@@ -36,3 +41,47 @@ class TestUtil(unittest.TestCase):
                 'a number is required'
             ):
                 jsonify_code({'test': 1}, 'foo')
+
+    def test_ndjson_chunks(self):
+        """
+        Verify documents are written a line each, a chunk at a time.
+        """
+        documents = [{'command': 'ls {0}'.format(x)} for x in range(5)]
+        chunks = list(ndjson_chunks(documents, chunk_size=2))
+        self.assertEqual(3, len(chunks))
+        lines = b''.join(chunks).decode('utf-8').splitlines()
+        self.assertEqual(documents, [json.loads(line) for line in lines])
+        self.assertEqual([], list(ndjson_chunks([])))
+
+    def test_gzip_chunks(self):
+        """
+        Verify each chunk can be decompressed as soon as it arrives.
+        """
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = gzip_chunks(iter([b'first\n', b'second\n']))
+        self.assertEqual(b'first\n', decompressor.decompress(next(chunks)))
+        self.assertEqual(
+            b'second\n', decompressor.decompress(b''.join(chunks))
+        )
+        self.assertTrue(decompressor.eof)
+
+    def test_ndjson_lines(self):
+        """
+        Verify bodies are split into lines however they are chunked.
+        """
+        body = b'"ls"\n\n{"command": "pwd"}\n  \n"who"'
+        self.assertEqual(
+            [b'"ls"', b'{"command": "pwd"}', b'"who"'],
+            list(ndjson_lines(BytesIO(body), chunk_size=3))
+        )
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzipped = compressor.compress((body + b'\n') * 100)
+        gzipped += compressor.flush()
+        self.assertEqual(
+            300, len(list(ndjson_lines(BytesIO(gzipped), gzipped=True,
+                                       chunk_size=16)))
+        )
+        with self.assertRaises(ValueError):
+            list(ndjson_lines(BytesIO(b'not gzip'), gzipped=True))
+        with self.assertRaises(ValueError):
+            list(ndjson_lines(BytesIO(b'x' * 100), max_line=10))
@@ -5,12 +5,18 @@ from __future__ import absolute_import, unicode_literals
 import base64
 import json
 import os
+import shutil
+import tempfile
+import time
 import unittest
+import zlib
 
 import mock
 from six import assertRaisesRegex
 
-from archelond.data import MemoryData
+from archelond.data import CachedData, MemoryData, MeteredData
+from archelond.metrics import Metrics
+from archelond.spool import Spool, SpoolFlusher
 import archelond.web
 
 
@@ -40,6 +46,7 @@ class TestWeb(unittest.TestCase):
         app = archelond.web.app
         app.config.from_envvar('ARCHELOND_CONF')
         app.data = MemoryData(app.config)
+        app.flusher = None
         htpasswd = archelond.web.htpasswd
         htpasswd.load_users(app)
 
@@ -58,15 +65,15 @@ class TestWeb(unittest.TestCase):
         else:
             caller = self.client.get
 
-        return caller(url, headers={
-            'Authorization': 'Basic {0}'.format(
-                base64.b64encode(
-                    '{0}:{1}'.format(
-                        self.USER, self.PASS
-                    ).encode('ascii')
-                ).decode('ascii')
-            )
-        }, **kwargs)
+        headers = dict(kwargs.pop('headers', {}))
+        headers['Authorization'] = 'Basic {0}'.format(
+            base64.b64encode(
+                '{0}:{1}'.format(
+                    self.USER, self.PASS
+                ).encode('ascii')
+            ).decode('ascii')
+        )
+        return caller(url, headers=headers, **kwargs)
 
     def _create_command(self, command=DEFAULT_COMMAND):
         """
@@ -162,6 +169,15 @@ class TestWeb(unittest.TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 401)
 
+        # Nothing until the user adds something, which starts their
+        # history with INITIAL_DATA
+        response = self._authed(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [], json.loads(response.get_data(as_text=True))['commands']
+        )
+        archelond.web.app.data.add(MemoryData.INITIAL_DATA[0], self.USER, None)
+
         # Verify get of all
         response = self._authed(url)
         self.assertEqual(response.status_code, 200)
@@ -197,6 +213,88 @@ class TestWeb(unittest.TestCase):
             'Order specified is not an option'
         )
 
+    def test_history_get_cursor(self):
+        """
+        Validate paging through history with cursors
+        """
+        url = '/api/v1/history'
+        num_commands = MemoryData.NUM_RESULTS + 10
+        for number in range(num_commands):
+            archelond.web.app.data.add(
+                'turtle {}'.format(number), self.USER, None
+            )
+
+        response = self._authed('{}?q=turtle'.format(url))
+        payload = json.loads(response.get_data(as_text=True))
+        self.assertEqual(MemoryData.NUM_RESULTS, len(payload['commands']))
+
+        response = self._authed(
+            '{}?q=turtle&cursor={}'.format(url, payload['cursor'])
+        )
+        payload = json.loads(response.get_data(as_text=True))
+        self.assertEqual(10, len(payload['commands']))
+        self.assertEqual(
+            'turtle {}'.format(num_commands - 1),
+            payload['commands'][-1]['command']
+        )
+        self.assertNotIn('cursor', payload)
+
+        response = self._authed('{}?cursor=garbage'.format(url))
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(
+            json.loads(response.get_data(as_text=True))['error'],
+            'Invalid cursor'
+        )
+
+    def test_history_export(self):
+        """
+        Validate streaming out the whole history
+        """
+        url = '/api/v1/history/export'
+        self.assertEqual(401, self.client.get(url).status_code)
+        commands = ['turtle {}'.format(x) for x in range(1001)]
+        archelond.web.app.data.bulk_add(commands, self.USER, None)
+
+        def exported(response):
+            """Commands in an export response"""
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('application/x-ndjson', response.mimetype)
+            data = response.get_data()
+            if response.headers.get('Content-Encoding') == 'gzip':
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            return [
+                json.loads(line)['command']
+                for line in data.decode('utf-8').splitlines()
+            ]
+
+        expected = MemoryData.INITIAL_DATA + commands
+        response = self._authed(url)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(expected, exported(response))
+        response = self._authed(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual(expected, exported(response))
+
+        self.assertEqual(
+            ['cat /proc/cpuinfo'], exported(self._authed(url + '?q=cpu'))
+        )
+        self.assertEqual(
+            [], exported(self._authed(
+                '{0}?since={1}'.format(url, time.time() + 60)
+            ))
+        )
+        self.assertEqual(
+            1005, len(exported(self._authed(
+                '{0}?since=0&until={1}'.format(url, time.time() + 60)
+            )))
+        )
+        response = self._authed(url + '?until=tomorrow')
+        self.assertEqual(422, response.status_code)
+        self.assertEqual(
+            'until must be seconds since the epoch',
+            json.loads(response.get_data(as_text=True))['error']
+        )
+
     def test_history_single_post(self):
         """
         Test adding history items via API
@@ -264,6 +362,23 @@ class TestWeb(unittest.TestCase):
         for response in responses:
             self.assertEqual(201, response['status_code'])
 
+        # Report failures from the data store for each command
+        with mock.patch.object(
+            archelond.web.app.data, 'bulk_add', return_value=[None, 'a']
+        ):
+            response = self._authed(
+                url, method='POST', content_type='application/json',
+                data=json.dumps({'commands': ['fail', 'a']})
+            )
+        self.assertEqual(200, response.status_code)
+        responses = json.loads(response.get_data(as_text=True))['responses']
+        self.assertEqual(
+            [500, 201], [x['status_code'] for x in responses]
+        )
+        self.assertEqual(
+            '/api/v1/history/a', responses[1]['headers']['location']
+        )
+
         # Post a dictionary instead of a list
         response = self._authed(
             url, method='POST', content_type='application/json',
@@ -275,6 +390,212 @@ class TestWeb(unittest.TestCase):
             'Commands must be list'
         )
 
+    def test_multi_post_compact(self):
+        """
+        Verify bulk posts can answer with a summary or bare ids
+        """
+        url = '/api/v1/history?response={0}'
+        with mock.patch.object(
+            archelond.web.app.data, 'bulk_add',
+            return_value=['a', None, 'c']
+        ):
+            response = self._authed(
+                url.format('summary'), method='POST',
+                content_type='application/json',
+                data=json.dumps({'commands': ['a', 'fail', 'c']})
+            )
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(
+                {'received': 3, 'added': 2, 'failed': [1]},
+                json.loads(response.get_data(as_text=True))
+            )
+            response = self._authed(
+                url.format('ids'), method='POST',
+                data={'commands': json.dumps(['a', 'fail', 'c'])}
+            )
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(
+                {'ids': ['a', None, 'c']},
+                json.loads(response.get_data(as_text=True))
+            )
+
+        response = self._authed(
+            url.format('verbose'), method='POST',
+            content_type='application/json',
+            data=json.dumps({'commands': ['ls']})
+        )
+        self.assertEqual(422, response.status_code)
+        self.assertEqual(
+            'Response specified is not an option',
+            json.loads(response.get_data(as_text=True))['error']
+        )
+
+    def test_stats(self):
+        """
+        Verify the user's history accounting is served from under any
+        wrapped data stores, and only by stores that keep it.
+        """
+        app = archelond.web.app
+        url = '/api/v1/stats'
+        self.assertEqual(401, self.client.get(url).status_code)
+        app.data.add(self.DEFAULT_COMMAND, self.USER, None)
+        app.data = CachedData(
+            app.config, MeteredData(app.config, app.data, Metrics({}))
+        )
+        response = self._authed(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            len(MemoryData.INITIAL_DATA) + 1,
+            json.loads(response.get_data(as_text=True))['commands']
+        )
+        app.data = mock.Mock(spec=['all'])
+        self.assertEqual(404, self._authed(url).status_code)
+
+    def test_spooled_post(self):
+        """
+        Verify posts are queued and accepted when spooling.
+        """
+        url = '/api/v1/history'
+        app = archelond.web.app
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.assertEqual(404, self._authed('/api/v1/spool').status_code)
+        app.flusher = SpoolFlusher(
+            Spool(os.path.join(path, 'spool.sqlite')), app.data, {}
+        )
+        with mock.patch.object(app.flusher, 'notify') as notify_mock:
+            response = self._authed(
+                url, method='POST', data={'command': 'who'}
+            )
+            self.assertEqual(202, response.status_code)
+            notify_mock.assert_called_with(1)
+            response = self._authed(
+                url, method='POST', content_type='application/json',
+                data=json.dumps({'commands': ['ls', 'pwd']})
+            )
+            self.assertEqual(202, response.status_code)
+            responses = json.loads(
+                response.get_data(as_text=True)
+            )['responses']
+            self.assertEqual([202, 202], [x['status_code'] for x in responses])
+            notify_mock.assert_called_with(2)
+            # Ids aren't known yet, so compact responses are summaries
+            response = self._authed(
+                url + '?response=ids', method='POST',
+                content_type='application/json',
+                data=json.dumps({'commands': ['ls', 'pwd']})
+            )
+            self.assertEqual(202, response.status_code)
+            self.assertEqual(
+                {'received': 2, 'added': 0, 'queued': 2, 'failed': []},
+                json.loads(response.get_data(as_text=True))
+            )
+            # Imports are queued the same way
+            response = self._authed(
+                url + '/import', method='POST', data=b'"ls"\n"pwd"\n'
+            )
+            self.assertEqual(202, response.status_code)
+            self.assertEqual(
+                {'received': 2, 'added': 0, 'queued': 2, 'invalid': [],
+                 'failed': []},
+                json.loads(response.get_data(as_text=True))
+            )
+
+        # Nothing is in the data store until the spool is flushed
+        self.assertEqual(0, len(app.data.filter('who', None, self.USER, None)))
+        response = self._authed('/api/v1/spool')
+        self.assertEqual(
+            7, json.loads(response.get_data(as_text=True))['depth']
+        )
+        app.flusher.flush()
+        self.assertEqual(1, len(app.data.filter('who', None, self.USER, None)))
+
+    def test_history_import(self):
+        """
+        Validate streamed imports are added in batches and summarized
+        """
+        url = '/api/v1/history/import'
+        app = archelond.web.app
+        self.assertEqual(
+            401, self.client.post(url, data=b'"ls"\n').status_code
+        )
+        body = '\n'.join([
+            '"ls"', '{"command": "pwd☠"}', 'garbage', '', '{"nope": 1}',
+            '[1]', '"who"', '"ls"',
+        ]).encode('utf-8')
+
+        with mock.patch.dict(app.config, {'IMPORT_BATCH_SIZE': 2}):
+            with mock.patch.object(
+                app.data, 'bulk_add', wraps=app.data.bulk_add
+            ) as bulk_add:
+                response = self._authed(url, method='POST', data=body)
+                self.assertEqual(2, bulk_add.call_count)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            {'received': 7, 'added': 4, 'invalid': [2, 3, 4], 'failed': []},
+            json.loads(response.get_data(as_text=True))
+        )
+        self.assertEqual(
+            1, len(app.data.filter('pwd☠', None, self.USER, None))
+        )
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        gzipped = compressor.compress(
+            ''.join('"gz {0}"\n'.format(x) for x in range(1000)).encode(
+                'utf-8'
+            )
+        ) + compressor.flush()
+        with mock.patch.object(app.data, 'bulk_add') as bulk_add:
+            bulk_add.side_effect = lambda commands, *args: (
+                [None] + ['x'] * (len(commands) - 1)
+            )
+            response = self._authed(
+                url, method='POST', data=gzipped,
+                headers={'Content-Encoding': 'gzip'}
+            )
+        summary = json.loads(response.get_data(as_text=True))
+        self.assertEqual(1000, summary['received'])
+        self.assertEqual(998, summary['added'])
+        self.assertEqual([0, 500], summary['failed'])
+
+        response = self._authed(
+            url, method='POST', data=gzipped[:-20] + b'x' * 20,
+            headers={'Content-Encoding': 'gzip'}
+        )
+        self.assertEqual(400, response.status_code)
+        summary = json.loads(response.get_data(as_text=True))
+        self.assertIn('Invalid gzip', summary['error'])
+
+    def test_metrics(self):
+        """
+        Verify requests are counted and timed by route and served
+        from ``/metrics``.
+        """
+        metrics = archelond.web.app.metrics
+        key = (
+            'archelond_requests_total',
+            (('method', 'GET'), ('route', 'history'), ('status', 200))
+        )
+        before = metrics.collect()[0].get(key, 0)
+        self._authed('/api/v1/history')
+        self._authed('/api/v1/history?q=cheese')
+        self.assertEqual(2, metrics.collect()[0][key] - before)
+
+        self.assertEqual(401, self.client.get('/metrics').status_code)
+        response = self._authed('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text = response.get_data(as_text=True)
+        self.assertIn(
+            'archelond_requests_total{method="GET",route="metrics_view",'
+            'status="401"}', text
+        )
+        self.assertIn(
+            'archelond_request_seconds_count{method="GET",route="history"}',
+            text
+        )
+        self.assertIn('archelond_auth_cache_hits_total', text)
+
     def test_history_item_get(self):
         """
         Grab a single history item by id
@@ -345,6 +666,10 @@ class TestWeb(unittest.TestCase):
         self.assertTrue(
             json.loads(response.get_data(as_text=True))['meta']['pumpkins']
         )
+        # Updates aren't uses of the command
+        self.assertEqual(
+            1, json.loads(response.get_data(as_text=True))['count']
+        )
 
         # Make sure our PUT can't do bad things
         response = self._authed(
@@ -3,9 +3,10 @@
 Classic utility module for removing repetitive tasks and such
 """
 from __future__ import absolute_import, unicode_literals
+import zlib
 
-
-from flask import jsonify
+from flask import json, jsonify
+from six import string_types
 
 
 def jsonify_code(src_object, status_code):
@@ -22,3 +23,126 @@ def jsonify_code(src_object, status_code):
     response = jsonify(src_object)
     response.status_code = status_code
     return response
+
+
+def ndjson_chunks(documents, chunk_size=500):
+    """Serialize to newline delimited JSON, a chunk of lines at a time.
+
+    Args:
+        documents (iterable): JSON serializable objects
+        chunk_size (int): Number of lines in each chunk
+
+    Yields:
+        bytes: UTF-8 encoded lines, each ending with a newline
+    """
+    lines = []
+    for document in documents:
+        lines.append(json.dumps(document))
+        if len(lines) == chunk_size:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def gzip_chunks(chunks, level=6):
+    """Gzip a stream of chunks without waiting for the end of it.
+
+    Each chunk is flushed out of the compressor as it comes in, so
+    the client can start decompressing straight away.
+
+    Args:
+        chunks (iterable): Chunks of bytes to compress
+        level (int): zlib compression level
+
+    Yields:
+        bytes: The gzip stream
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def _read_chunks(stream, chunk_size, gzipped):
+    """
+    Read a body a chunk at a time, inflating it if it is gzipped
+    without letting any one piece grow past ``chunk_size``.
+    """
+    decompressor = None
+    if gzipped:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if decompressor is None:
+            yield chunk
+            continue
+        while chunk:
+            yield decompressor.decompress(chunk, chunk_size)
+            chunk = decompressor.unconsumed_tail
+    if decompressor is not None:
+        yield decompressor.flush()
+        # Python 2 can't tell us if the body was cut short
+        if not getattr(decompressor, 'eof', True):
+            raise zlib.error('Body ended before the gzip stream did')
+
+
+def ndjson_lines(stream, gzipped=False, chunk_size=64 * 1024,
+                 max_line=1024 * 1024):
+    """Split a newline delimited JSON body into lines as it is read.
+
+    Only the line being read is held in memory, so a body of any size
+    can be taken in with flat memory use.
+
+    Args:
+        stream (file): Body to read from
+        gzipped (bool): Whether the body is gzip compressed
+        chunk_size (int): Bytes to read and inflate at a time
+        max_line (int): Longest line to accept in bytes
+
+    Raises:
+        ValueError: If a line is longer than ``max_line``, or the body
+            isn't valid gzip.
+
+    Yields:
+        bytes: Each line that isn't blank
+    """
+    pending = b''
+    try:
+        for data in _read_chunks(stream, chunk_size, gzipped):
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            if len(pending) > max_line:
+                raise ValueError('Line is longer than {0} bytes'.format(
+                    max_line
+                ))
+            for line in lines:
+                if line.strip():
+                    yield line
+    except zlib.error as ex:
+        raise ValueError('Invalid gzip body: {0}'.format(ex))
+    if pending.strip():
+        yield pending
+
+
+def import_command(line):
+    """The command in a line of an import.
+
+    Args:
+        line (bytes): A command string or an object with a
+            ``command`` key, as JSON
+
+    Returns:
+        str: The command, or ``None`` if the line isn't valid
+    """
+    try:
+        item = json.loads(line.decode('utf-8'))
+    except ValueError:
+        return None
+    if isinstance(item, dict):
+        item = item.get('command')
+    if isinstance(item, string_types) and item:
+        return item
+    return None
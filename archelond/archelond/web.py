@@ -2,25 +2,39 @@
 Main entry point for flask application
 """
 from __future__ import absolute_import, unicode_literals
+from datetime import datetime
 import json
 import logging
 import os
 
-from flask import Flask, jsonify, request, render_template, url_for, g
+from flask import (
+    Flask, Response, jsonify, request, render_template, url_for, g
+)
 # pylint: disable=no-name-in-module, import-error
 from flask.ext.assets import Environment
-from flask.ext.htpasswd import HtPasswdAuth
 from werkzeug.contrib.fixers import ProxyFix
+import pytz
 from six import string_types
 
-from archelond.data import MemoryData, ElasticData, ORDER_TYPES
+from archelond.auth import CachedHtPasswdAuth
+from archelond.data import (
+    CachedData, MemoryData, MeteredData, ElasticData, SQLiteData, ORDER_TYPES
+)
 from archelond.log import configure_logging
-from archelond.util import jsonify_code
+from archelond.metrics import Metrics, cache_collector
+from archelond.profiling import SamplingProfiler
+from archelond.spool import Spool, SpoolFlusher
+from archelond.util import (
+    gzip_chunks, import_command, jsonify_code, ndjson_chunks, ndjson_lines
+)
 
 log = logging.getLogger('archelond')  # pylint: disable=invalid-name
 
 V1_ROOT = '/api/v1/'
 
+# Ways a bulk POST can report what happened to each command
+BULK_RESPONSES = ('full', 'summary', 'ids')
+
 
 def run_server():
     """
@@ -41,11 +55,20 @@ def run_server():
     app.run(host=host, port=port)
 
 
+def bootstrap():
+    """
+    Create the configured data store's index or schema ahead of
+    time, so application servers don't have to.
+    """
+    app.data.bootstrap()
+    log.info('Bootstrapped %s', app.config['DATABASE_TYPE'])
+
+
 def wsgi_app():
     """
     Start flask application runtime
     """
-    # Disabling check since both types are implementations of same base class
+    # Disabling check since all types are implementations of same base class
     # pylint: disable=redefined-variable-type
 
     # Setup the app
@@ -61,9 +84,32 @@ def wsgi_app():
         new_app.data = MemoryData(new_app.config)
     elif new_app.config['DATABASE_TYPE'] == 'ElasticData':
         new_app.data = ElasticData(new_app.config)
+    elif new_app.config['DATABASE_TYPE'] == 'SQLiteData':
+        new_app.data = SQLiteData(new_app.config)
     else:
         raise Exception('No valid database type is set')
 
+    # Measure requests and calls to the data store, not the cache
+    metrics = Metrics(new_app.config)
+    metrics.init_app(new_app)
+    new_app.data = MeteredData(new_app.config, new_app.data, metrics)
+    if new_app.config.get('CACHE_SIZE'):
+        new_app.data = CachedData(new_app.config, new_app.data)
+        metrics.add_collector(
+            cache_collector('archelond_search_cache', new_app.data)
+        )
+
+    # Optionally queue added commands instead of waiting on the store
+    new_app.flusher = None
+    if new_app.config.get('SPOOL_PATH'):
+        new_app.flusher = SpoolFlusher(
+            Spool(new_app.config['SPOOL_PATH']),
+            new_app.data,
+            new_app.config
+        )
+        # Drain what an earlier process left without waiting for a POST
+        new_app.before_request(new_app.flusher.start)
+
     # Set up logging
     configure_logging(new_app)
     return new_app
@@ -72,9 +118,13 @@ def wsgi_app():
 # Setup flask application
 app = wsgi_app()  # pylint: disable=invalid-name
 assets = Environment(app)  # pylint: disable=invalid-name
-htpasswd = HtPasswdAuth(app)  # pylint: disable=invalid-name
+htpasswd = CachedHtPasswdAuth(app)  # pylint: disable=invalid-name
+app.metrics.add_collector(cache_collector('archelond_auth_cache', htpasswd))
 # Add proxy fixer
 app.wsgi_app = ProxyFix(app.wsgi_app)
+# Only profile when asked to, so nothing else pays for it
+if app.config.get('PROFILE_PATH'):
+    app.wsgi_app = SamplingProfiler(app.wsgi_app, app.config)
 
 
 @app.route('/')
@@ -85,6 +135,17 @@ def index():
     return render_template('index.html', user=g.user), 200
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Metrics of every application process in the Prometheus text
+    format, see :py:mod:`archelond.metrics`.
+    """
+    return Response(
+        app.metrics.render(), content_type='text/plain; version=0.0.4'
+    )
+
+
 @app.route('{}token'.format(V1_ROOT), methods=['GET'])
 def token():
     """
@@ -99,6 +160,24 @@ def history():
     """
     POST=Add entry
     GET=Get entries with query
+
+    When ``SPOOL_PATH`` is configured, POSTs queue the commands and
+    return 202 straight away instead of waiting for the data store.
+
+    GET results are paged.  Either ask for a page number with ``p``,
+    or pass the ``cursor`` returned with the previous page to get the
+    one after it.  ``cursor`` is only in the response when the data
+    store thinks there may be more results.  ``o`` orders them, ``r``
+    for newest first or ``f`` for the most frequently and recently
+    used first.
+
+    Bulk POSTs (``commands``) respond with the status and location of
+    every command by default.  ``response=summary`` instead counts the
+    commands ``received`` and ``added`` and lists the positions of any
+    that ``failed``, and ``response=ids`` lists each command's id, or
+    ``null`` if it failed.  Spooled bulk POSTs get the summary for
+    either, since ids aren't known until the spool is flushed, and
+    count the commands as ``queued`` rather than ``added``.
     """
     # We have a lot of logic here since we are doing query string
     # handling, so let pylint know that is ok.
@@ -107,6 +186,7 @@ def history():
         query = request.args.get('q')
         order = request.args.get('o')
         page = int(request.args.get('p', 0))
+        cursor = request.args.get('cursor')
 
         order_type = None
         if order:
@@ -118,15 +198,24 @@ def history():
             else:
                 order_type = order
 
-        if query:
-            results = app.data.filter(
-                query, order_type, g.user, request.remote_addr, page=page
-            )
-        else:
-            results = app.data.all(
-                order_type, g.user, request.remote_addr, page=page
-            )
-        return jsonify({'commands': results})
+        try:
+            if query:
+                results = app.data.filter(
+                    query, order_type, g.user, request.remote_addr,
+                    page=page, cursor=cursor
+                )
+            else:
+                results = app.data.all(
+                    order_type, g.user, request.remote_addr,
+                    page=page, cursor=cursor
+                )
+        except ValueError:
+            return jsonify_code({'error': 'Invalid cursor'}, 422)
+        response = {'commands': results}
+        next_cursor = getattr(results, 'cursor', None)
+        if next_cursor:
+            response['cursor'] = next_cursor
+        return jsonify(response)
 
     if request.method == 'POST':
         # Accept json or form type
@@ -145,11 +234,51 @@ def history():
         if commands:
             if from_form:
                 commands = json.loads(commands)
-            results_list = []
             if not isinstance(commands, list):
                 return jsonify_code({'error': 'Commands must be list'}, 422)
-            for command in commands:
-                cmd_id = app.data.add(command, g.user, request.remote_addr)
+            response_type = request.args.get('response', 'full')
+            if response_type not in BULK_RESPONSES:
+                return jsonify_code(
+                    {'error': 'Response specified is not an option'},
+                    422
+                )
+            if app.flusher:
+                app.flusher.spool.put(commands, g.user, request.remote_addr)
+                app.flusher.notify(len(commands))
+                if response_type != 'full':
+                    # There are no ids until the spool is flushed
+                    return jsonify_code({
+                        'received': len(commands),
+                        'added': 0,
+                        'queued': len(commands),
+                        'failed': [],
+                    }, 202)
+                return jsonify_code({'responses': [
+                    {'response': '', 'status_code': 202, 'headers': {}}
+                    for _ in commands
+                ]}, 202)
+            cmd_ids = app.data.bulk_add(commands, g.user, request.remote_addr)
+            if response_type == 'ids':
+                return jsonify({'ids': cmd_ids})
+            if response_type == 'summary':
+                failed = [
+                    index for index, cmd_id in enumerate(cmd_ids)
+                    if cmd_id is None
+                ]
+                return jsonify({
+                    'received': len(commands),
+                    'added': len(commands) - len(failed),
+                    'failed': failed,
+                })
+            results_list = []
+            for cmd_id in cmd_ids:
+                if cmd_id is None:
+                    results_list.append({
+                        'response': 'Failed to add command',
+                        'status_code': 500,
+                        'headers': {},
+                    })
+                    continue
                 results_list.append(
                     {
                         'response': '',
@@ -163,6 +292,10 @@ def history():
         if not isinstance(command, string_types):
             return jsonify_code({'error': 'Command must be a string'}, 422)
 
+        if app.flusher:
+            app.flusher.spool.put([command], g.user, request.remote_addr)
+            app.flusher.notify(1)
+            return '', 202
         cmd_id = app.data.add(command, g.user, request.remote_addr)
         return '', 201, {'location': url_for('history_item', cmd_id=cmd_id)}
     else:  # pragma: no cover
@@ -170,6 +303,137 @@ def history():
         raise Exception('Unsupported http method used')
 
 
+@app.route('{}history/export'.format(V1_ROOT), methods=['GET'])
+def history_export():
+    """
+    Stream all of the user's commands as newline delimited JSON, one
+    command dictionary per line, in one response instead of a request
+    per page.
+
+    ``q`` only exports commands containing it, and ``since`` and
+    ``until`` limit the export to commands last added in that range,
+    given in seconds since the epoch.  The response is gzipped for
+    clients that accept it.
+    """
+    time_range = {}
+    for key in ('since', 'until'):
+        value = request.args.get(key)
+        if value is None:
+            continue
+        try:
+            time_range[key] = datetime.fromtimestamp(float(value), pytz.utc)
+        except (ValueError, OverflowError):
+            return jsonify_code(
+                {'error': '{0} must be seconds since the epoch'.format(key)},
+                422
+            )
+    commands = app.data.export(
+        g.user, request.remote_addr, term=request.args.get('q'),
+        **time_range
+    )
+    chunks = ndjson_chunks(commands)
+    headers = {'Vary': 'Accept-Encoding'}
+    if 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks, mimetype='application/x-ndjson', headers=headers)
+
+
+def _import_batch(commands, indices, summary):
+    """
+    Add a batch of imported commands, or queue them if we spool, and
+    count how it went in the summary.
+    """
+    if app.flusher:
+        app.flusher.spool.put(commands, g.user, request.remote_addr)
+        app.flusher.notify(len(commands))
+        summary['queued'] += len(commands)
+        return
+    cmd_ids = app.data.bulk_add(commands, g.user, request.remote_addr)
+    for index, cmd_id in zip(indices, cmd_ids):
+        if cmd_id is None:
+            summary['failed'].append(index)
+        else:
+            summary['added'] += 1
+
+
+@app.route('{}history/import'.format(V1_ROOT), methods=['POST'])
+def history_import():
+    """
+    Add commands from a newline delimited JSON body, which can be
+    sent chunked and gzipped (``Content-Encoding: gzip``).  Each line
+    is either a command string or an object with a ``command`` key.
+
+    The body is read as it arrives and added ``IMPORT_BATCH_SIZE``
+    commands at a time, so an import of any size takes the same
+    memory.  The response counts the commands ``received`` and
+    ``added``, and lists the zero based positions (not counting blank
+    lines) of any that were ``invalid`` or ``failed`` to be added.
+    When spooling, commands are counted as ``queued`` instead of
+    ``added``.  Bodies that can't be read stop the import with a 400,
+    and the summary of what was imported before that.
+    """
+    batch_size = app.config.get('IMPORT_BATCH_SIZE', 500)
+    gzipped = request.headers.get('Content-Encoding', '').lower() == 'gzip'
+    summary = {'received': 0, 'added': 0, 'invalid': [], 'failed': []}
+    if app.flusher:
+        summary['queued'] = 0
+    commands, indices = [], []
+    try:
+        for line in ndjson_lines(request.stream, gzipped):
+            index = summary['received']
+            summary['received'] += 1
+            command = import_command(line)
+            if command is None:
+                summary['invalid'].append(index)
+                continue
+            commands.append(command)
+            indices.append(index)
+            if len(commands) == batch_size:
+                _import_batch(commands, indices, summary)
+                commands, indices = [], []
+    except ValueError as ex:
+        if commands:
+            _import_batch(commands, indices, summary)
+        summary['error'] = str(ex)
+        return jsonify_code(summary, 400)
+    if commands:
+        _import_batch(commands, indices, summary)
+    return jsonify_code(summary, 202 if app.flusher else 200)
+
+
+@app.route('{}spool'.format(V1_ROOT), methods=['GET'])
+def spool():
+    """
+    Backlog and flush timing of the ingestion spool.
+    """
+    if not app.flusher:
+        return jsonify_code({'error': 'Spool is not enabled'}, 404)
+    return jsonify(app.flusher.stats())
+
+
+def _store(data):
+    """
+    The data store underneath any caching or metering wrapped around
+    it.
+    """
+    while isinstance(data, (CachedData, MeteredData)):
+        data = data.data
+    return data
+
+
+@app.route('{}stats'.format(V1_ROOT), methods=['GET'])
+def stats():
+    """
+    Page and memory accounting of the user's history, from data stores
+    that keep it, see :py:meth:`archelond.data.MemoryData.stats`.
+    """
+    store = _store(app.data)
+    if not hasattr(store, 'stats'):
+        return jsonify_code({'error': 'Data store has no stats'}, 404)
+    return jsonify(store.stats(g.user))
+
+
 @app.route('{}history/<cmd_id>'.format(V1_ROOT),
            methods=['GET', 'PUT', 'DELETE'])
 def history_item(cmd_id):
@@ -177,10 +441,11 @@ def history_item(cmd_id):
 
     Updates, gets, or deletes a command from the active data store.
 
-    PUT: Takes a payload in either form or JSON request, and runs the
-    add routine by passing the dictinoary minus ``command``,
-    ``username``, and ``host`` as kwargs to the data stores ``add``
-    routine.
+    PUT: Takes a payload in either form or JSON request, and replaces
+    the command's metadata by passing the dictinoary minus
+    ``command``, ``username``, and ``host`` as kwargs to the data
+    stores ``update_meta`` routine, which doesn't count a use of the
+    command the way ``add`` does.
     """
     # We have to handle several methods, which requires branches and
     # extra returns.  Until/when we switch to pluggable views, let
@@ -199,7 +464,7 @@ def history_item(cmd_id):
         # have a deduplicated data structure by command.
         log.debug('Updating %s for %s', cmd_id, g.user)
         try:
-            cmd = app.data.get(cmd_id, g.user, request.remote_addr)
+            app.data.get(cmd_id, g.user, request.remote_addr)
         except KeyError:
             return jsonify_code({'error': 'No such history item'}, 404)
         from_form = True
@@ -229,9 +494,12 @@ def history_item(cmd_id):
             del put_command['host']
         except KeyError:
             pass
-        app.data.add(
-            cmd['command'], g.user, request.remote_addr, **put_command
-        )
+        try:
+            app.data.update_meta(
+                cmd_id, g.user, request.remote_addr, **put_command
+            )
+        except KeyError:
+            return jsonify_code({'error': 'No such history item'}, 404)
         return '', 204
 
     if request.method == 'DELETE':
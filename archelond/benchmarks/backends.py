@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Compare load and search latency of the data store implementations.
+
+Usage::
+
+    python benchmarks/backends.py [size ...]
+
+``MemoryData`` and ``SQLiteData`` are always run.  ``ElasticData`` is
+run too when ``ARCHELOND_BENCHMARK_ELASTICSEARCH_URL`` is set, using a
+throwaway ``archelond_benchmark`` index that is deleted afterwards.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from archelond.data import ElasticData, MemoryData, SQLiteData
+
+from workload import SEARCH_TERMS, generate_commands, percentile, time_calls
+
+DEFAULT_SIZES = [10000, 100000]
+REPEAT = 5
+USER = 'benchmark'
+
+
+def build_stores(directory):
+    """
+    Build one of each data store we can reach.
+    """
+    stores = [
+        ('MemoryData', MemoryData({})),
+        ('SQLiteData', SQLiteData(
+            {'SQLITE_PATH': os.path.join(directory, 'benchmark.sqlite')}
+        )),
+    ]
+    elastic_url = os.environ.get('ARCHELOND_BENCHMARK_ELASTICSEARCH_URL')
+    if elastic_url:
+        stores.append(('ElasticData', ElasticData({
+            'ELASTICSEARCH_URL': elastic_url,
+            'ELASTICSEARCH_INDEX': 'archelond_benchmark',
+        })))
+    return stores
+
+
+def cleanup(name, store):
+    """
+    Drop anything a data store left outside of our temp directory.
+    """
+    if name == 'ElasticData':
+        store.elasticsearch.indices.delete(store.index)
+
+
+def run(size):
+    """
+    Load ``size`` commands into each store and time searching them.
+    """
+    commands = generate_commands(size)
+    directory = tempfile.mkdtemp()
+    try:
+        for name, store in build_stores(directory):
+            start = time.time()
+            for command in commands:
+                store.add(command, USER, None)
+            load_time = time.time() - start
+            if name == 'ElasticData':
+                store.elasticsearch.indices.refresh(store.index)
+
+            searches = time_calls(
+                store.filter,
+                [(term, 'r', USER, None) for term in SEARCH_TERMS],
+                REPEAT
+            )
+            pages = time_calls(
+                store.all,
+                [('r', USER, None, page) for page in range(10)],
+                REPEAT
+            )
+            print(
+                '{name:<12} {size:>8} commands  load {load:8.2f}s  '
+                'search p50 {sp50:8.3f}ms p99 {sp99:8.3f}ms  '
+                'page p50 {pp50:8.3f}ms p99 {pp99:8.3f}ms'.format(
+                    name=name,
+                    size=size,
+                    load=load_time,
+                    sp50=percentile(searches, 0.5) * 1000,
+                    sp99=percentile(searches, 0.99) * 1000,
+                    pp50=percentile(pages, 0.5) * 1000,
+                    pp99=percentile(pages, 0.99) * 1000,
+                )
+            )
+            cleanup(name, store)
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    """
+    Run the benchmark for each requested size
+    """
+    sizes = [int(x) for x in sys.argv[1:]] or DEFAULT_SIZES
+    for size in sizes:
+        run(size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Compare index size and search latency of the default ``ElasticData``
+mapping against the n-gram one.
+
+Usage::
+
+    ARCHELOND_BENCHMARK_ELASTICSEARCH_URL=http://localhost:9200 \\
+        python benchmarks/elastic_ngram.py [size ...]
+
+Each mapping gets a throwaway index that is deleted afterwards.  Hits
+are reported next to latency since the default mapping only matches
+the start of commands.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import os
+import sys
+import time
+
+from archelond.data import ElasticData
+
+from workload import SEARCH_TERMS, generate_commands, percentile, time_calls
+
+DEFAULT_SIZES = [10000, 100000]
+REPEAT = 5
+USER = 'benchmark'
+MAPPINGS = [('keyword', False), ('ngram', True)]
+
+
+def run(url, size):
+    """
+    Load ``size`` commands into an index per mapping and time
+    searching them.
+    """
+    commands = generate_commands(size)
+    for name, ngram in MAPPINGS:
+        store = ElasticData({
+            'ELASTICSEARCH_URL': url,
+            'ELASTICSEARCH_INDEX': 'archelond_benchmark_{0}'.format(name),
+            'ELASTICSEARCH_NGRAM': ngram,
+        })
+        try:
+            start = time.time()
+            store.bulk_add(commands, USER, None)
+            load_time = time.time() - start
+            client = store.elasticsearch
+            client.indices.refresh(store.index)
+            client.indices.optimize(store.index, max_num_segments=1)
+            index_bytes = client.indices.stats(store.index)[
+                'indices'
+            ][store.index]['primaries']['store']['size_in_bytes']
+
+            searches = time_calls(
+                store.filter,
+                [(term, None, USER, None) for term in SEARCH_TERMS],
+                REPEAT
+            )
+            hits = sum(
+                len(store.filter(term, None, USER, None))
+                for term in SEARCH_TERMS
+            )
+            print(
+                '{name:<8} {size:>8} commands  load {load:8.2f}s  '
+                'index {mbytes:9.2f}MB  search p50 {p50:8.3f}ms '
+                'p99 {p99:8.3f}ms  first page hits {hits}'.format(
+                    name=name,
+                    size=size,
+                    load=load_time,
+                    mbytes=index_bytes / 1024.0 / 1024.0,
+                    p50=percentile(searches, 0.5) * 1000,
+                    p99=percentile(searches, 0.99) * 1000,
+                    hits=hits,
+                )
+            )
+        finally:
+            store.elasticsearch.indices.delete(store.index)
+
+
+def main():
+    """
+    Run the benchmark for each requested size
+    """
+    url = os.environ.get('ARCHELOND_BENCHMARK_ELASTICSEARCH_URL')
+    if not url:
+        print('Set ARCHELOND_BENCHMARK_ELASTICSEARCH_URL to run this')
+        sys.exit(1)
+    sizes = [int(x) for x in sys.argv[1:]] or DEFAULT_SIZES
+    for size in sizes:
+        run(url, size)
+
+
+if __name__ == '__main__':
+    main()
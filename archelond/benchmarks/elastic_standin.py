@@ -0,0 +1,744 @@
+#!/usr/bin/env python
+"""
+Stand in for Elasticsearch, serving the part of its REST API that
+``ElasticData`` uses out of memory, so its code paths can be
+benchmarked and load tested without a cluster or a network.
+
+Usage::
+
+    python benchmarks/elastic_standin.py [--port 9200] [--latency 0.005] \\
+        [--jitter 0.01] [--failure-rate 0.01] [--bulk-failure-rate 0.01] \\
+        [--stall-rate 0.001] [--stall 15] [--no-scripts]
+
+Then point ``ELASTICSEARCH_URL`` (or ``ARCHELOND_TEST_ELASTICSEARCH_URL``
+for the tests, or ``benchmarks/server.py --elastic``) at it.
+
+Served are creating, refreshing and deleting indexes, indexing,
+updating (with the use counting script of ``ElasticData``, partial
+documents and upserts), getting and deleting documents, ``_mget``,
+``_bulk``, and searches with ``match_all``, ``match_phrase_prefix`` and
+``match_phrase`` on ``command.ngram``, timestamp ranges, sorting,
+``from``/``size``, ``search_after``, scrolls and scans.  Analysis is
+approximated: phrase prefixes match from the start of any word of the
+lower cased command, phrases match anywhere in it, and every hit
+scores 1.
+
+Every request waits ``--latency`` plus up to ``--jitter`` seconds.
+``--failure-rate`` of requests are answered with ``--failure-status``
+(503 by default, which the Elasticsearch client retries), and
+``--bulk-failure-rate`` of the items in bulk requests are rejected
+with a 429 like a full bulk queue.  ``--stall-rate`` of requests
+instead wait ``--stall`` seconds, longer than the client's default
+timeout of 10 seconds.  ``--no-scripts`` refuses to run scripts, like
+a cluster with dynamic scripting disabled.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+import functools
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+
+# pylint: disable=import-error
+from six.moves import socketserver
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.urllib.parse import parse_qs, urlparse
+
+DEFAULT_PORT = 9200
+DEFAULT_SIZE = 10
+
+
+class StandInError(Exception):
+    """
+    Error answered with an Elasticsearch style body.
+    """
+
+    def __init__(self, status, error):
+        """
+        Keep the status and error to answer with.
+        """
+        super(StandInError, self).__init__(error)
+        self.status = status
+        self.error = error
+
+
+def _compare(first, second, directions):
+    """
+    Compare two lists of sort values, with missing values last.
+    """
+    for left, right, direction in zip(first, second, directions):
+        if left == right:
+            continue
+        if left is None:
+            return 1
+        if right is None:
+            return -1
+        result = -1 if left < right else 1
+        return -result if direction == 'desc' else result
+    return 0
+
+
+class Store(object):
+    """
+    Indexes of documents kept in memory, and open scroll contexts.
+
+    Each index has the body it was created with, and a dictionary of
+    documents keyed by type and id holding their source and version.
+    """
+
+    def __init__(self):
+        """
+        Start without any indexes.
+        """
+        self.lock = threading.Lock()
+        self.indices = {}
+        self.bodies = {}
+        self.scrolls = {}
+        self.scripts = True
+
+    def _index(self, name):
+        """
+        Documents of an index that must exist.
+        """
+        if name not in self.indices:
+            raise StandInError(
+                404, 'IndexMissingException[[{0}] missing]'.format(name)
+            )
+        return self.indices[name]
+
+    def create_index(self, name, body):
+        """
+        Create an empty index.
+        """
+        with self.lock:
+            if name in self.indices:
+                raise StandInError(
+                    400, 'IndexAlreadyExistsException[[{0}] already '
+                    'exists]'.format(name)
+                )
+            self.indices[name] = {}
+            self.bodies[name] = body
+        return {'acknowledged': True}
+
+    def get_index(self, name):
+        """
+        Settings and mappings of an index.
+        """
+        with self.lock:
+            self._index(name)
+            body = self.bodies.get(name, {})
+        return {name: {
+            'settings': {'index': body.get('settings', {})},
+            'mappings': body.get('mappings', {}),
+        }}
+
+    def get_field_mapping(self, name, field):
+        """
+        Mapping of a field, by document type, in the types that have
+        it.  Subfields are only found under their parent.
+        """
+        with self.lock:
+            self._index(name)
+            body = self.bodies.get(name, {})
+        mappings = {}
+        parent, _, child = field.partition('.')
+        for doc_type, mapping in body.get('mappings', {}).items():
+            found = mapping.get('properties', {}).get(parent)
+            if found and child:
+                found = found.get('fields', {}).get(child)
+            if found:
+                mappings[doc_type] = {field: {
+                    'full_name': field,
+                    'mapping': {field.split('.')[-1]: found},
+                }}
+        return {name: {'mappings': mappings}}
+
+    def delete_index(self, name):
+        """
+        Delete an index and everything in it.
+        """
+        with self.lock:
+            self._index(name)
+            del self.indices[name]
+            self.bodies.pop(name, None)
+        return {'acknowledged': True}
+
+    def exists(self, name):
+        """
+        Whether an index exists.
+        """
+        return name in self.indices
+
+    @staticmethod
+    def _result(index, doc_type, doc_id, document, **extra):
+        """
+        Response describing a document.
+        """
+        result = {
+            '_index': index,
+            '_type': doc_type,
+            '_id': doc_id,
+            '_version': document['version'] if document else 1,
+        }
+        result.update(extra)
+        return result
+
+    def index(self, index, doc_type, doc_id, source):
+        """
+        Index a whole document, replacing any with the same id.
+        """
+        with self.lock:
+            documents = self.indices.setdefault(index, {})
+            doc_id = doc_id or uuid.uuid4().hex
+            old = documents.get((doc_type, doc_id))
+            document = documents[(doc_type, doc_id)] = {
+                'source': source,
+                'version': old['version'] + 1 if old else 1,
+            }
+            return self._result(
+                index, doc_type, doc_id, document, created=old is None
+            )
+
+    def get(self, index, doc_type, doc_id):
+        """
+        Get a document.
+        """
+        with self.lock:
+            document = self._index(index).get((doc_type, doc_id))
+            if document is None:
+                raise StandInError(404, self._result(
+                    index, doc_type, doc_id, None, found=False
+                ))
+            return self._result(
+                index, doc_type, doc_id, document, found=True,
+                _source=json.loads(json.dumps(document['source']))
+            )
+
+    def mget(self, index, doc_type, doc_ids):
+        """
+        Get documents by id, noting the ones that aren't there.
+        """
+        docs = []
+        for doc_id in doc_ids:
+            try:
+                docs.append(self.get(index, doc_type, doc_id))
+            except StandInError as ex:
+                docs.append(ex.error)
+        return {'docs': docs}
+
+    def delete(self, index, doc_type, doc_id):
+        """
+        Delete a document.
+        """
+        with self.lock:
+            document = self._index(index).pop((doc_type, doc_id), None)
+            if document is None:
+                raise StandInError(404, self._result(
+                    index, doc_type, doc_id, None, found=False
+                ))
+            return self._result(
+                index, doc_type, doc_id, document, found=True
+            )
+
+    @staticmethod
+    def _script(source, body):
+        """
+        Run the use counting script of ``ElasticData`` on a document.
+        """
+        params = body.get('params', {})
+        rank = source.get('frecency')
+        now = params['when'] / params['half_life']
+        source.update(params['document'])
+        source['count'] = (source.get('count') or 0) + 1
+        source['frecency'] = now if rank is None else (
+            now + math.log(math.pow(2, rank - now) + 1) / math.log(2)
+        )
+
+    def update(self, index, doc_type, doc_id, body):
+        """
+        Update a document with a script or partial document, or
+        create it from the upsert.
+        """
+        with self.lock:
+            documents = self.indices.setdefault(index, {})
+            document = documents.get((doc_type, doc_id))
+            if document is None:
+                if 'upsert' not in body:
+                    raise StandInError(
+                        404, 'DocumentMissingException[[{0}][{1}]: '
+                        'document missing]'.format(index, doc_id)
+                    )
+                document = documents[(doc_type, doc_id)] = {
+                    'source': body['upsert'], 'version': 1
+                }
+                return self._result(index, doc_type, doc_id, document)
+            if 'script' in body:
+                if not self.scripts:
+                    raise StandInError(
+                        400, 'ElasticsearchIllegalArgumentException[failed '
+                        'to execute script]; nested: ScriptException['
+                        'scripts of type [inline], operation [update] and '
+                        'lang [groovy] are disabled]'
+                    )
+                self._script(document['source'], body)
+            else:
+                document['source'].update(body.get('doc', {}))
+            document['version'] += 1
+            return self._result(index, doc_type, doc_id, document)
+
+    def _matches(self, query, source):
+        """
+        Whether a document source matches a query.
+        """
+        command = (source.get('command') or '').lower()
+        if not query or 'match_all' in query:
+            return True
+        if 'match_phrase_prefix' in query:
+            term = query['match_phrase_prefix']['command']
+            if isinstance(term, dict):
+                term = term['query']
+            return re.search(
+                r'(^|\W){0}'.format(re.escape(term.lower())), command
+            ) is not None
+        if 'match_phrase' in query:
+            term = list(query['match_phrase'].values())[0]
+            if isinstance(term, dict):
+                term = term['query']
+            return term.lower() in command
+        if 'filtered' in query:
+            if not self._matches(query['filtered'].get('query'), source):
+                return False
+            for field, bounds in query['filtered']['filter'][
+                    'range'
+            ].items():
+                value = source.get(field)
+                if value is None:
+                    return False
+                for operator, bound in bounds.items():
+                    if not {
+                            'gt': value > bound, 'gte': value >= bound,
+                            'lt': value < bound, 'lte': value <= bound,
+                    }[operator]:
+                        return False
+            return True
+        raise StandInError(
+            400, 'SearchParseException[Unsupported query {0}]'.format(
+                json.dumps(query)
+            )
+        )
+
+    @staticmethod
+    def _sort_fields(sort):
+        """
+        Field and direction of each sort clause.
+        """
+        fields = []
+        for clause in sort or ['_score']:
+            if not isinstance(clause, dict):
+                fields.append(
+                    (clause, 'desc' if clause == '_score' else 'asc')
+                )
+                continue
+            field, order = list(clause.items())[0]
+            if isinstance(order, dict):
+                order = order.get('order', 'asc')
+            fields.append((field, order))
+        return fields
+
+    def search(self, index, doc_type, body, params):
+        """
+        Run a search, sorting every matching document.
+
+        Returns:
+            tuple: The sorted hits, and how many to return
+        """
+        with self.lock:
+            documents = list(self._index(index).items())
+        fields = self._sort_fields(body.get('sort'))
+        hits = []
+        for (hit_type, hit_id), document in documents:
+            if doc_type and hit_type != doc_type:
+                continue
+            source = document['source']
+            if not self._matches(body.get('query'), source):
+                continue
+            values = {'_score': 1.0, '_uid': '{0}#{1}'.format(
+                hit_type, hit_id
+            )}
+            hits.append({
+                '_index': index,
+                '_type': hit_type,
+                '_id': hit_id,
+                '_score': 1.0,
+                '_source': json.loads(json.dumps(source)),
+                'sort': [
+                    values[field] if field in values else source.get(field)
+                    for field, _ in fields
+                ],
+            })
+        directions = [direction for _, direction in fields]
+        hits.sort(key=functools.cmp_to_key(
+            lambda first, second: _compare(
+                first['sort'], second['sort'], directions
+            )
+        ))
+        if 'search_after' in body:
+            hits = [
+                hit for hit in hits
+                if _compare(hit['sort'], body['search_after'], directions) > 0
+            ]
+        start = int(params.get('from', body.get('from', 0)))
+        size = int(params.get('size', body.get('size', DEFAULT_SIZE)))
+        hits = hits[start:]
+        if not body.get('sort'):
+            for hit in hits:
+                del hit['sort']
+        return hits, size
+
+    def open_scroll(self, hits, size):
+        """
+        Keep the rest of a search's hits for scrolling through.
+        """
+        scroll_id = uuid.uuid4().hex
+        with self.lock:
+            self.scrolls[scroll_id] = [hits, size]
+        return scroll_id
+
+    def scroll(self, scroll_id):
+        """
+        Next hits of a scroll, and how many there were in all.
+        """
+        with self.lock:
+            if scroll_id not in self.scrolls:
+                raise StandInError(
+                    404, 'SearchContextMissingException[No search context '
+                    'found for id [{0}]]'.format(scroll_id)
+                )
+            hits, size = self.scrolls[scroll_id]
+            self.scrolls[scroll_id][0] = hits[size:]
+        return hits[:size]
+
+    def clear_scroll(self, scroll_ids):
+        """
+        Forget scroll contexts.
+        """
+        with self.lock:
+            for scroll_id in scroll_ids:
+                self.scrolls.pop(scroll_id, None)
+        return {'succeeded': True}
+
+
+class StandInServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    HTTP server for a store, with its injected latency and failures.
+    """
+    # pylint: disable=too-many-instance-attributes
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 failure_status=503, bulk_failure_rate=0.0, stall_rate=0.0,
+                 stall=15.0, seed=None, scripts=True):
+        """
+        Listen on ``address`` with an empty store.
+        """
+        # pylint: disable=too-many-arguments
+        HTTPServer.__init__(self, address, StandInHandler)
+        self.store = Store()
+        self.store.scripts = scripts
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.bulk_failure_rate = bulk_failure_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.random = random.Random(seed)
+
+    @property
+    def url(self):
+        """
+        URL to give the Elasticsearch client.
+        """
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+    def start(self):
+        """
+        Serve from a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Route requests to the store.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server_version = 'ElasticStandIn/1.0'
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """
+        Don't log every request.
+        """
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Handle every method the same way.
+        """
+        self._handle()
+
+    do_POST = do_PUT = do_DELETE = do_HEAD = do_GET
+
+    def _respond(self, status, body):
+        """
+        Send a JSON response.
+        """
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _body(self):
+        """
+        Raw request body.
+        """
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode('utf-8') if length else ''
+
+    def _handle(self):
+        """
+        Wait, maybe fail, then answer the request.
+        """
+        server = self.server
+        body = self._body()
+        rand = server.random
+        if server.stall_rate and rand.random() < server.stall_rate:
+            time.sleep(server.stall)
+        elif server.latency or server.jitter:
+            time.sleep(server.latency + rand.uniform(0, server.jitter))
+        if server.failure_rate and rand.random() < server.failure_rate:
+            self._respond(server.failure_status, {
+                'error': 'Injected failure', 'status': server.failure_status
+            })
+            return
+        url = urlparse(self.path)
+        params = dict(
+            (key, values[-1]) for key, values in parse_qs(url.query).items()
+        )
+        parts = [part for part in url.path.split('/') if part]
+        try:
+            status, response = self._route(parts, params, body)
+        except StandInError as ex:
+            status, response = ex.status, (
+                ex.error if isinstance(ex.error, dict)
+                else {'error': ex.error, 'status': ex.status}
+            )
+        except (KeyError, TypeError, ValueError) as ex:
+            status, response = 400, {
+                'error': 'ElasticsearchParseException[{0!r}]'.format(ex),
+                'status': 400,
+            }
+        self._respond(status, response)
+
+    def _route(self, parts, params, body):
+        """
+        Call the store for a request.
+
+        Returns:
+            tuple: Status and response body
+        """
+        # pylint: disable=too-many-return-statements,too-many-branches
+        store = self.server.store
+        method = self.command
+        if not parts:
+            return 200, {'status': 200, 'version': {'number': '1.7.0'}}
+        if parts[-1] == '_bulk':
+            return 200, self._bulk(parts[:-1], body)
+        if parts[:2] == ['_search', 'scroll']:
+            if method == 'DELETE':
+                ids = parts[2:] or [body]
+                return 200, store.clear_scroll(
+                    ','.join(ids).split(',')
+                )
+            scroll_id = params.get('scroll_id') or body.strip()
+            if scroll_id.startswith('{'):
+                scroll_id = json.loads(scroll_id)['scroll_id']
+            return 200, self._hits(store.scroll(scroll_id), scroll_id)
+        if parts[-1] == '_search':
+            return 200, self._search(
+                parts[0], parts[1] if len(parts) == 3 else None,
+                json.loads(body or '{}'), params
+            )
+        if parts[-1] == '_mget':
+            return 200, store.mget(
+                parts[0], parts[1] if len(parts) == 3 else None,
+                json.loads(body)['ids']
+            )
+        if len(parts) == 4 and parts[1:3] == ['_mapping', 'field']:
+            return 200, store.get_field_mapping(parts[0], parts[3])
+        if parts[-1] == '_refresh':
+            return 200, {'_shards': {'total': 1, 'successful': 1}}
+        if len(parts) == 1:
+            if method == 'PUT' or method == 'POST':
+                return 200, store.create_index(
+                    parts[0], json.loads(body or '{}')
+                )
+            if method == 'DELETE':
+                return 200, store.delete_index(parts[0])
+            if method == 'HEAD':
+                return (200 if store.exists(parts[0]) else 404), {}
+            return 200, store.get_index(parts[0])
+        if len(parts) == 4 and parts[3] == '_update':
+            return 200, store.update(
+                parts[0], parts[1], parts[2], json.loads(body)
+            )
+        if len(parts) in (2, 3):
+            index, doc_type = parts[:2]
+            doc_id = parts[2] if len(parts) == 3 else None
+            if method in ('PUT', 'POST'):
+                result = store.index(index, doc_type, doc_id, json.loads(body))
+                return (201 if result['created'] else 200), result
+            if method == 'DELETE':
+                return 200, store.delete(index, doc_type, doc_id)
+            return 200, store.get(index, doc_type, doc_id)
+        raise StandInError(400, 'No handler found for uri [{0}]'.format(
+            self.path
+        ))
+
+    @staticmethod
+    def _hits(hits, scroll_id=None, total=None):
+        """
+        Search response for a page of hits.
+        """
+        response = {
+            'took': 1,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {
+                'total': len(hits) if total is None else total,
+                'max_score': 1.0 if hits else None,
+                'hits': hits,
+            },
+        }
+        if scroll_id:
+            response['_scroll_id'] = scroll_id
+        return response
+
+    def _search(self, index, doc_type, body, params):
+        """
+        Search, opening a scroll context if asked to.
+        """
+        store = self.server.store
+        hits, size = store.search(index, doc_type, body, params)
+        if 'scroll' not in params:
+            return self._hits(hits[:size], total=len(hits))
+        scroll_id = store.open_scroll(hits, size)
+        # Scans only return hits from scrolling
+        if params.get('search_type') == 'scan':
+            return self._hits([], scroll_id, total=len(hits))
+        return self._hits(store.scroll(scroll_id), scroll_id, len(hits))
+
+    def _bulk(self, parts, body):
+        """
+        Run each action of a bulk request, rejecting some if asked.
+        """
+        store = self.server.store
+        lines = iter(line for line in body.split('\n') if line.strip())
+        items = []
+        for line in lines:
+            operation, action = list(json.loads(line).items())[0]
+            index = action.get('_index') or parts[0]
+            doc_type = action.get('_type') or parts[1]
+            doc_id = action.get('_id')
+            source = None if operation == 'delete' else json.loads(next(lines))
+            item = {'_index': index, '_type': doc_type, '_id': doc_id}
+            if (self.server.bulk_failure_rate and
+                    self.server.random.random() <
+                    self.server.bulk_failure_rate):
+                item.update(status=429, error='EsRejectedExecutionException['
+                            'rejected execution (queue capacity 50)]')
+                items.append({operation: item})
+                continue
+            try:
+                if operation == 'update':
+                    item = store.update(index, doc_type, doc_id, source)
+                elif operation == 'delete':
+                    item = store.delete(index, doc_type, doc_id)
+                else:
+                    item = store.index(index, doc_type, doc_id, source)
+                item['status'] = 201 if item.pop('created', False) else 200
+            except StandInError as ex:
+                item.update(status=ex.status, error='{0}'.format(ex.error))
+            items.append({operation: item})
+        return {
+            'took': 1,
+            'errors': any(
+                list(item.values())[0]['status'] >= 300 for item in items
+            ),
+            'items': items,
+        }
+
+
+def main():
+    """
+    Parse arguments and serve until interrupted.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds every request waits')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Most extra seconds a request randomly waits')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of requests that fail')
+    parser.add_argument('--failure-status', type=int, default=503,
+                        help='Status failed requests get')
+    parser.add_argument('--bulk-failure-rate', type=float, default=0.0,
+                        help='Fraction of bulk items rejected')
+    parser.add_argument('--stall-rate', type=float, default=0.0,
+                        help='Fraction of requests that stall')
+    parser.add_argument('--stall', type=float, default=15.0,
+                        help='Seconds stalled requests wait')
+    parser.add_argument('--seed', type=int,
+                        help='Seed for repeatable failures and latency')
+    parser.add_argument('--no-scripts', dest='scripts', action='store_false',
+                        help='Refuse to run scripts')
+    args = parser.parse_args()
+
+    server = StandInServer(
+        (args.host, args.port), latency=args.latency, jitter=args.jitter,
+        failure_rate=args.failure_rate, failure_status=args.failure_status,
+        bulk_failure_rate=args.bulk_failure_rate,
+        stall_rate=args.stall_rate, stall=args.stall, seed=args.seed,
+        scripts=args.scripts
+    )
+    print('Serving Elasticsearch stand-in on {0}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Compare trigram indexed ``MemoryData.filter`` against a full scan.
+
+Usage::
+
+    python benchmarks/memory_filter.py [size ...]
+
+Sizes default to 10k, 100k and 1M commands.  The 1M run needs a few
+gigabytes of memory for the index.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import sys
+import time
+
+from archelond.data import MemoryData
+
+from workload import SEARCH_TERMS, generate_commands, percentile, time_calls
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+REPEAT = 5
+
+
+def scan_filter(data, term):
+    """
+    The pre-index ``MemoryData.filter``: check every command.
+    """
+    return [
+        meta for meta in data.users[None].data.values()
+        if term in meta['command']
+    ]
+
+
+def run(size):
+    """
+    Load ``size`` commands and time both search strategies.
+    """
+    data = MemoryData({})
+    start = time.time()
+    for command in generate_commands(size):
+        data.add(command, None, None)
+    load_time = time.time() - start
+
+    arguments = [(term, None, None, None) for term in SEARCH_TERMS]
+    indexed = time_calls(data.filter, arguments, REPEAT)
+    scanned = time_calls(
+        scan_filter, [(data, term) for term in SEARCH_TERMS], REPEAT
+    )
+    print(
+        '{size:>9} commands  load {load:8.2f}s  '
+        'index p50 {ip50:9.3f}ms p99 {ip99:9.3f}ms  '
+        'scan p50 {sp50:9.3f}ms p99 {sp99:9.3f}ms'.format(
+            size=size,
+            load=load_time,
+            ip50=percentile(indexed, 0.5) * 1000,
+            ip99=percentile(indexed, 0.99) * 1000,
+            sp50=percentile(scanned, 0.5) * 1000,
+            sp99=percentile(scanned, 0.99) * 1000,
+        )
+    )
+
+
+def main():
+    """
+    Run the benchmark for each requested size
+    """
+    sizes = [int(x) for x in sys.argv[1:]] or DEFAULT_SIZES
+    for size in sizes:
+        run(size)
+
+
+if __name__ == '__main__':
+    main()
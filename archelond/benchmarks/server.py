@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+"""
+Replay realistic workloads through the archelond API against each data
+store, and report throughput and latency by history size.
+
+Usage::
+
+    python benchmarks/server.py [--sizes 1000 10000] [--wsgi] \\
+        [--elastic http://localhost:9200] [--json results.json] \\
+        [--compare baseline.json]
+
+Requests go through the Flask test client, or with ``--wsgi`` over
+HTTP to a threaded WSGI server in this process.  ``MemoryData`` and
+``SQLiteData`` are always run, and ``ElasticData`` too when given an
+Elasticsearch URL, using a throwaway ``archelond_benchmark_server``
+index that is deleted afterwards.  ``--elastic standin`` runs
+``benchmarks/elastic_standin.py`` in this process instead; run it
+separately to inject latency or failures.
+
+Workloads, each against a fresh store loaded with ``size`` commands:
+
+``bulk``
+    Load the history with bulk POSTs of 500 commands
+``keystroke``
+    Prefix searches growing a character at a time, like typing in
+    the TUI
+``cursor``
+    Page through the whole history with cursors
+``offset``
+    Page through the history by page number
+``mixed``
+    Mostly searches, with commands being added and pages read
+
+``--json`` writes the results for comparing with ``--compare`` on
+another commit, which prints how the p50 and p99 latencies changed.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from passlib.apache import HtpasswdFile
+from six.moves import http_client  # pylint: disable=import-error
+from six.moves.urllib.parse import quote  # pylint: disable=import-error
+
+from workload import SEARCH_TERMS, generate_commands, percentile
+
+DEFAULT_SIZES = [1000, 10000]
+BULK_CHUNK = 500
+MAX_PAGES = 50
+MIXED_REQUESTS = 1000
+USER = 'benchmark'
+PASSWORD = 'benchmark'
+
+CONFIG = """
+from archelond.config import *
+DEBUG = False
+FLASK_SECRET = 'benchmark'
+LOG_LEVEL = 'WARNING'
+DATABASE_TYPE = 'MemoryData'
+FLASK_HTPASSWD_PATH = {htpasswd!r}
+"""
+
+
+def load_app(directory):
+    """
+    Import the archelond application configured with a benchmark
+    user, and return it with a token for that user.
+    """
+    htpasswd = HtpasswdFile(os.path.join(directory, 'htpasswd'), new=True)
+    htpasswd.set_password(USER, PASSWORD)
+    htpasswd.save()
+    config_path = os.path.join(directory, 'config.py')
+    with open(config_path, 'w') as config_file:
+        config_file.write(CONFIG.format(htpasswd=htpasswd.path))
+    os.environ['ARCHELOND_CONF'] = config_path
+
+    import archelond.web
+    app = archelond.web.app
+    token = archelond.web.htpasswd.generate_token(USER)
+    if isinstance(token, bytes):
+        token = token.decode('ascii')
+    return app, token
+
+
+def build_stores(directory, elastic_url):
+    """
+    Functions building a fresh one of each data store we can reach,
+    and cleaning up after it.
+    """
+    from archelond.data import ElasticData, MemoryData, SQLiteData
+
+    def memory():
+        """Empty in memory store"""
+        store = MemoryData({})
+        store.INITIAL_DATA = []
+        return store, lambda: None
+
+    def sqlite():
+        """SQLite store in a new file"""
+        path = os.path.join(directory, 'benchmark.sqlite')
+        if os.path.exists(path):
+            os.remove(path)
+        return SQLiteData({'SQLITE_PATH': path}), lambda: None
+
+    def elastic():
+        """Elasticsearch store in a throwaway index"""
+        store = ElasticData({
+            'ELASTICSEARCH_URL': elastic_url,
+            'ELASTICSEARCH_INDEX': 'archelond_benchmark_server',
+        })
+        store.elasticsearch.indices.delete(store.index, ignore=404)
+        return store, lambda: store.elasticsearch.indices.delete(
+            store.index, ignore=404
+        )
+
+    stores = [('MemoryData', memory), ('SQLiteData', sqlite)]
+    if elastic_url:
+        stores.append(('ElasticData', elastic))
+    return stores
+
+
+def wrap(app, store):
+    """
+    Measure and cache a store the way the application does.
+    """
+    from archelond.data import CachedData, MeteredData
+    data = MeteredData(app.config, store, app.metrics)
+    if app.config.get('CACHE_SIZE'):
+        data = CachedData(app.config, data)
+    return data
+
+
+class TestClientTransport(object):
+    """
+    Send requests through the Flask test client.
+    """
+
+    def __init__(self, app, token):
+        """
+        Make a test client for the application.
+        """
+        self.client = app.test_client()
+        self.headers = {'Authorization': 'token {0}'.format(token)}
+
+    def request(self, method, path, body=None):
+        """
+        Send a request and return the status and decoded JSON body.
+        """
+        kwargs = {'headers': self.headers}
+        if body is not None:
+            kwargs['data'] = json.dumps(body)
+            kwargs['content_type'] = 'application/json'
+        response = self.client.open(path, method=method, **kwargs)
+        return response.status_code, json.loads(
+            response.get_data(as_text=True) or 'null'
+        )
+
+    def close(self):
+        """
+        Nothing to clean up.
+        """
+        pass
+
+
+class HTTPTransport(object):
+    """
+    Serve the application from a threaded WSGI server and send
+    requests to it over one keep alive connection.
+    """
+
+    def __init__(self, app, token):
+        """
+        Start the server on a free port.
+        """
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class RequestHandler(WSGIRequestHandler):
+            """
+            Keep connections alive, send responses without waiting on
+            delayed acknowledgements, and don't log every request.
+            """
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_request(self, *args, **kwargs):
+                """
+                Don't log requests.
+                """
+                pass
+
+        self.server = make_server(
+            '127.0.0.1', 0, app, threaded=True, request_handler=RequestHandler
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.connection = http_client.HTTPConnection(
+            '127.0.0.1', self.server.server_port
+        )
+        self.headers = {'Authorization': 'token {0}'.format(token)}
+
+    def request(self, method, path, body=None):
+        """
+        Send a request and return the status and decoded JSON body.
+        """
+        headers = dict(self.headers)
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        data = response.read().decode('utf-8')
+        return response.status, json.loads(data or 'null')
+
+    def close(self):
+        """
+        Stop the server.
+        """
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def timed(transport, latencies, method, path, body=None):
+    """
+    Send a request, adding its latency to ``latencies``.
+    """
+    start = time.time()
+    status, data = transport.request(method, path, body)
+    latencies.append(time.time() - start)
+    if status >= 300:
+        raise Exception('{0} {1} failed with {2}: {3}'.format(
+            method, path, status, data
+        ))
+    return data
+
+
+def bulk(transport, commands):
+    """
+    Load the history a chunk at a time.
+    """
+    latencies = []
+    for start in range(0, len(commands), BULK_CHUNK):
+        timed(
+            transport, latencies, 'POST', '/api/v1/history?response=summary',
+            {'commands': commands[start:start + BULK_CHUNK]}
+        )
+    return latencies
+
+
+def keystroke(transport, commands):
+    """
+    Search for every prefix of each search term, in order.
+    """
+    # pylint: disable=unused-argument
+    latencies = []
+    for term in SEARCH_TERMS:
+        for end in range(1, len(term) + 1):
+            timed(transport, latencies, 'GET', '/api/v1/history?q={0}'.format(
+                quote(term[:end])
+            ))
+    return latencies
+
+
+def cursor(transport, commands):
+    """
+    Page through the history following cursors.
+    """
+    # pylint: disable=unused-argument
+    latencies = []
+    path = '/api/v1/history?o=r'
+    data = timed(transport, latencies, 'GET', path)
+    while data.get('cursor') and len(latencies) < MAX_PAGES:
+        data = timed(transport, latencies, 'GET', '{0}&cursor={1}'.format(
+            path, quote(data['cursor'])
+        ))
+    return latencies
+
+
+def offset(transport, commands):
+    """
+    Page through the history by page number.
+    """
+    # pylint: disable=unused-argument
+    latencies = []
+    for page in range(MAX_PAGES):
+        data = timed(
+            transport, latencies, 'GET',
+            '/api/v1/history?o=r&p={0}'.format(page)
+        )
+        if not data['commands']:
+            break
+    return latencies
+
+
+def mixed(transport, commands):
+    """
+    Mostly searches, with some commands added and pages read.
+    """
+    rand = random.Random(0)
+    latencies = []
+    for number in range(MIXED_REQUESTS):
+        choice = rand.random()
+        if choice < 0.8:
+            term = rand.choice(SEARCH_TERMS)
+            timed(transport, latencies, 'GET', '/api/v1/history?q={0}'.format(
+                quote(term[:rand.randint(1, len(term))])
+            ))
+        elif choice < 0.95:
+            timed(transport, latencies, 'POST', '/api/v1/history', {
+                'command': '{0} mixed-{1}'.format(
+                    rand.choice(commands), number
+                )
+            })
+        else:
+            timed(transport, latencies, 'GET', '/api/v1/history?o=r')
+    return latencies
+
+
+WORKLOADS = [
+    ('keystroke', keystroke),
+    ('cursor', cursor),
+    ('offset', offset),
+    ('mixed', mixed),
+]
+
+
+def result(backend, size, workload, latencies, elapsed):
+    """
+    Summary of one workload's latencies.
+    """
+    # pylint: disable=too-many-arguments
+    return {
+        'backend': backend,
+        'size': size,
+        'workload': workload,
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def report(row):
+    """
+    Print a result as a table row.
+    """
+    print(
+        '{backend:<12} {size:>8} {workload:<10} {requests:>6} requests  '
+        '{throughput:9.1f} req/s  p50 {p50_ms:8.2f}ms  '
+        'p99 {p99_ms:8.2f}ms'.format(**row)
+    )
+    sys.stdout.flush()
+
+
+def run(app, token, stores, sizes, transport_class):
+    """
+    Run every workload against every store at every size.
+    """
+    # pylint: disable=too-many-locals
+    results = []
+    for size in sizes:
+        commands = generate_commands(size)
+        for name, build in stores:
+            store, cleanup = build()
+            app.data = wrap(app, store)
+            transport = transport_class(app, token)
+            try:
+                start = time.time()
+                latencies = bulk(transport, commands)
+                results.append(result(
+                    name, size, 'bulk', latencies, time.time() - start
+                ))
+                report(results[-1])
+                if name == 'ElasticData':
+                    store.elasticsearch.indices.refresh(store.index)
+                for workload, function in WORKLOADS:
+                    start = time.time()
+                    latencies = function(transport, commands)
+                    results.append(result(
+                        name, size, workload, latencies, time.time() - start
+                    ))
+                    report(results[-1])
+            finally:
+                transport.close()
+                cleanup()
+    return results
+
+
+def commit():
+    """
+    The git commit being benchmarked, if we can tell.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, transport, results):
+    """
+    Print how latencies changed against a baseline run.
+    """
+    before = dict(
+        ((row['backend'], row['size'], row['workload']), row)
+        for row in baseline['results']
+    )
+    print('\nChange from {0}:'.format(baseline.get('commit') or 'baseline'))
+    if baseline.get('transport') != transport:
+        print('Warning: baseline sent requests by {0}, not {1}'.format(
+            baseline.get('transport'), transport
+        ))
+    for row in results:
+        old = before.get((row['backend'], row['size'], row['workload']))
+        if not old:
+            continue
+        print(
+            '{backend:<12} {size:>8} {workload:<10} '
+            'p50 {p50:+7.1%}  p99 {p99:+7.1%}'.format(
+                backend=row['backend'],
+                size=row['size'],
+                workload=row['workload'],
+                p50=row['p50_ms'] / old['p50_ms'] - 1 if old['p50_ms'] else 0,
+                p99=row['p99_ms'] / old['p99_ms'] - 1 if old['p99_ms'] else 0,
+            )
+        )
+
+
+def main():
+    """
+    Parse arguments, run the benchmark and save or compare results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--wsgi', action='store_true',
+                        help='Send requests over HTTP to a WSGI server')
+    parser.add_argument('--elastic', metavar='URL',
+                        help='Also benchmark ElasticData against this URL, '
+                        'or a stand-in with "standin"')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Write results to this file')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare with results written by --json')
+    args = parser.parse_args()
+
+    standin = None
+    if args.elastic == 'standin':
+        from elastic_standin import StandInServer
+        standin = StandInServer(('127.0.0.1', 0)).start()
+        args.elastic = standin.url
+    directory = tempfile.mkdtemp()
+    try:
+        app, token = load_app(directory)
+        results = run(
+            app, token, build_stores(directory, args.elastic), args.sizes,
+            HTTPTransport if args.wsgi else TestClientTransport
+        )
+    finally:
+        shutil.rmtree(directory)
+        if standin:
+            standin.stop()
+
+    output = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'transport': 'wsgi' if args.wsgi else 'test_client',
+        'timestamp': time.time(),
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(output, json_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as json_file:
+            compare(json.load(json_file), output['transport'], results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Synthetic shell history shared by the archelond benchmarks
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import random
+import time
+
+from six.moves import range  # pylint: disable=import-error,redefined-builtin
+
+PROGRAMS = [
+    ('git', ['status', 'diff', 'log --oneline', 'commit -am', 'push origin',
+             'checkout -b', 'rebase -i HEAD~3', 'pull --rebase']),
+    ('docker', ['ps -a', 'images', 'run --rm -it', 'logs -f', 'exec -it',
+                'compose up -d', 'build -t']),
+    ('pip', ['install -e .', 'install -r requirements.txt', 'freeze',
+             'uninstall -y', 'list --outdated']),
+    ('ls', ['-la', '-lh', '-R', '-1']),
+    ('cd', ['..', '~', '/var/log', '/etc/nginx', '-']),
+    ('vim', ['README.rst', 'setup.py', 'tox.ini', '/etc/hosts']),
+    ('ssh', ['prod-web-01', 'prod-db-02', 'bastion', 'build-agent-7']),
+    ('kubectl', ['get pods', 'describe pod', 'logs -f', 'apply -f',
+                 'rollout status deployment']),
+    ('grep', ['-rn TODO .', '-i error /var/log/syslog', '-v grep']),
+    ('make', ['test', 'install', 'clean', 'docs', 'release']),
+]
+
+WORDS = [
+    'archelon', 'turtle', 'history', 'server', 'client', 'index',
+    'elastic', 'search', 'config', 'backup', 'deploy', 'staging',
+    'feature', 'bugfix', 'release', 'worker', 'queue', 'cache',
+]
+
+SEARCH_TERMS = [
+    'gi', 'git', 'git st', 'docker', 'install', 'ssh prod', 'kubectl get',
+    'log', 'turtle', 'nginx', 'release', 'nomatchatall',
+]
+
+
+def generate_commands(count, seed=0):
+    """Build a deterministic list of unique, realistic looking commands.
+
+    A handful of programs and subcommands dominate, the way real
+    shell history does, with random arguments to keep the commands
+    unique.
+
+    Args:
+        count (int): Number of commands to generate
+        seed (int): Random seed so runs are comparable
+
+    Returns:
+        list: ``count`` unique command strings
+    """
+    rand = random.Random(seed)
+    commands = []
+    for number in range(count):
+        program, subcommands = rand.choice(PROGRAMS)
+        commands.append('{0} {1} {2}-{3}'.format(
+            program,
+            rand.choice(subcommands),
+            rand.choice(WORDS),
+            number
+        ))
+    return commands
+
+
+def time_calls(function, arguments, repeat=1):
+    """Time a function over a list of argument tuples.
+
+    Args:
+        function (callable): The function being measured
+        arguments (list): Argument tuples to call ``function`` with
+        repeat (int): Times to run through all of ``arguments``
+
+    Returns:
+        list: Latency in seconds of every call made
+    """
+    latencies = []
+    for _ in range(repeat):
+        for args in arguments:
+            start = time.time()
+            function(*args)
+            latencies.append(time.time() - start)
+    return latencies
+
+
+def percentile(latencies, fraction):
+    """Nearest rank percentile of a list of latencies.
+
+    Args:
+        latencies (list): Measured latencies
+        fraction (float): Percentile wanted between 0 and 1
+
+    Returns:
+        float: The latency at that percentile
+    """
+    ordered = sorted(latencies)
+    if not ordered:
+        return 0.0
+    rank = int(round(fraction * (len(ordered) - 1)))
+    return ordered[rank]
@@ -0,0 +1,14 @@
+"""
+Leave what needs Python 3.5 or newer out of test runs, and their
+pep8 and pylint checks, on older Pythons, which can't parse it.
+"""
+import sys
+
+collect_ignore = []  # pylint: disable=invalid-name
+if sys.version_info < (3, 5):
+    collect_ignore.extend([
+        'archelond/aio',
+        'archelond/tests/aio_helpers.py',
+        'archelond/tests/test_aio.py',
+        'benchmarks/api_load.py',
+    ])
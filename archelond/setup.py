@@ -43,8 +43,12 @@ setup(
         'cssmin',
         'jsmin',
         ],
+    extras_require={
+        'aio': ['aiohttp'],
+    },
     entry_points={'console_scripts': [
         'archelond = archelond.web:run_server',
+        'archelond-bootstrap = archelond.web:bootstrap',
     ]},
     zip_safe=False,
 )
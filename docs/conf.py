@@ -12,6 +12,8 @@
 # All configuration values have a default; values that are commented out
 # serve to show the default.
 
+import sys
+
 from docutils.utils import get_source_line
 import sphinx.environment
 import sphinx_bootstrap_theme
@@ -131,3 +133,24 @@ texinfo_documents = [
      u'Carson Gee', 'Archelon', 'One line description of project.',
      'Miscellaneous'),
 ]
+
+
+def skip_aio_api(app, docname, source):
+    """
+    Leave the asyncio API out of builds on Pythons that can't import
+    it, instead of failing to.
+    """
+    # pylint: disable=unused-argument
+    if docname == 'd-aio-api':
+        source[0] = source[0].split('\n\n')[0] + (
+            '\n\nBuild the docs with Python 3.5 or newer to include the '
+            'asyncio data stores and ASGI application.\n'
+        )
+
+
+def setup(app):
+    """
+    Hook into the build.
+    """
+    if sys.version_info < (3, 5):
+        app.connect('source-read', skip_aio_api)